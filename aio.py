@@ -0,0 +1,404 @@
+"""Asyncio versions of the collection and search API, on redis.asyncio
+
+Same key layout and the same Expr trees as the synchronous API. Expression evaluation
+only queues commands, so it runs unchanged on an asyncio pipeline, and many searches can
+run concurrently over a shared connection pool. What needs answers from the server
+before or while evaluating (cardinalities for the planner, tokens for approximate
+matches, loading scripts) is awaited beforehand.
+
+Searches are always pipelined and are not cached. Documents are updated and deleted under
+WATCH / MULTI as in the synchronous API.
+
+    red = redis.asyncio.Redis()
+    col = await AsyncCollection( red ).configure( cfg )
+    ids = await run_search( col, ContainsToken('rum') )
+"""
+import sys
+import time
+from typing import Dict, List, Tuple, Optional, Callable, Iterable, Set, TypeVar, Sequence
+
+from redis.asyncio import Redis as AsyncRedis
+from redis.exceptions import NoScriptError
+
+import indexing as idx
+import fuzzy
+import scripts
+import search as sch
+from common import (Doc, DocId, Key, Field, CollectionConfig, batches_from_iter,
+                    bump_generation, key_current_version, key_doc_len, key_ordinals)
+from collection import (Collection, VERSION_CHECK_SECS, EMPTY_MEMBERS, decode_docs,
+                        decode_all_docs, pins_reader, queue_update, queue_delete,
+                        watched_keys)
+from search import Expr, Empty, SearchContext, SearchPage, ContainsApprox
+
+from log_util import debug_log_fun
+
+l_dbg = debug_log_fun("search", sys.stdout )  # pylint: disable=invalid-name
+
+T_ = TypeVar("T_")
+
+
+class AsyncCollection( Collection ):
+    """Collection on an asyncio connection. Configure it with
+    `col = await AsyncCollection( red ).configure( cfg )`.
+
+    The current version is re-read from the server (at most every VERSION_CHECK_SECS)
+    when a search or write starts, not when accessing cfg or name. Replicas, if given,
+    are asyncio clients too, see Collection"""
+
+    def __init__(self, redis_conn: AsyncRedis, replicas: Optional[List[AsyncRedis]] = None,
+                 read_policy: str = 'round_robin', read_your_writes_secs: float = 0.0):
+        super().__init__( redis_conn, replicas, read_policy, read_your_writes_secs )
+
+    async def configure(self, cfg: CollectionConfig, version: Optional[int] = None):
+        """set the config, optionally fixing the version used instead of the current one"""
+        super().configure( cfg, version )
+        await self.check_version( force=True )
+        return self
+
+    def refresh_version(self, force: bool = False) -> Optional[int]:
+        """Version in use, without going to the server, see check_version"""
+        return self.version
+
+    async def check_version(self, force: bool = False) -> Optional[int]:
+        """Pick up the version currently served, checking the server at most every
+        VERSION_CHECK_SECS unless forced"""
+        if self.base_cfg is None or self.pinned:
+            return self.version
+
+        now = time.monotonic()
+        if force or now - self._checked_at >= VERSION_CHECK_SECS:
+            self._checked_at = now
+            cur = await self.redis.get( key_current_version( self.base_name ) )
+            self._set_version( int( cur or 0 ) )
+
+        return self.version
+
+    async def index_document(self, doc: Doc):
+        """index a document"""
+        return await index_document( self, doc )
+
+    async def update_document(self, doc: Doc):
+        """index a new version of a document"""
+        return await update_document( self, doc )
+
+    async def delete_document(self, doc_id: str) -> bool:
+        """remove a document from the index"""
+        return await delete_document( self, doc_id )
+
+    async def get_docs(self, doc_ids: List, fields: Optional[List[str]] = None) -> List[Doc]:
+        """get documents by id"""
+        return await get_docs( self, doc_ids, fields )
+
+    async def get_all_docs(self) -> Dict[DocId, Doc]:
+        """get dict of { doc_id -> Doc }"""
+        await self.check_version()
+        parts = idx.doc_parts( self.cfg )
+        async with self.reader().pipeline( transaction=False ) as pipe:
+            for part in parts:
+                pipe.hgetall( idx.doc_part_key( self.cfg, part ) )
+            stored = await pipe.execute()
+
+        return decode_all_docs( self.cfg, parts, stored )
+
+
+async def index_document( col: AsyncCollection, doc: Doc ):
+    """Index a single document in a single transaction"""
+    await index_documents( col, [doc] )
+
+
+async def index_documents( col: AsyncCollection, docs: Iterable[Doc], batch_size=1000,
+                           bulk: bool = False ):
+    """insert documents in batches, one pipeline per batch, see collection.index_documents"""
+    await col.check_version()
+    cfg = col.cfg
+    for batch in batches_from_iter( docs, batch_size=batch_size ):
+        ordinals = await assign_ordinals( col, [ col.x_id( doc ) for doc in batch ] )
+        if bulk:
+            agg = idx.aggregate_documents( cfg, batch, ordinals )
+            tokens = idx.batch_tokens( agg, cfg )
+            if len(tokens) > 0:
+                known = await col.redis.smismember( f'{cfg.name}/text_tokens', tokens )
+                idx.index_new_token_pats( agg, cfg, tokens, known )
+
+        async with col.redis.pipeline() as pipe:
+            if bulk:
+                agg.flush( pipe )
+            else:
+                for doc, ordinal in zip( batch, ordinals ):
+                    idx.index_document_pipe( pipe, cfg, doc, ordinal=ordinal )
+            bump_generation( pipe, cfg.name )
+            await pipe.execute()
+        col.mark_written()
+
+
+async def update_document( col: AsyncCollection, doc: Doc ):
+    """Replace a (possibly not yet indexed) document with a new version, see
+    collection.update_document"""
+    await col.check_version()
+    cfg = col.cfg
+    doc_id = col.x_id( doc )
+    ordinal = ( await assign_ordinals( col, [doc_id] ) )[0]
+    new, agg = idx.doc_members( cfg, doc, ordinal )
+
+    async def update( pipe ):
+        old = await stored_doc_members( col, doc_id )
+        old_len = await pipe.zscore( key_doc_len( col.name ), doc_id ) \
+            if cfg.scored_text else None
+        pipe.multi()
+        queue_update( col, pipe, doc, ordinal, old, old_len, new, agg )
+
+    await col.redis.transaction( update, *watched_keys( col, doc_id ) )
+    col.mark_written()
+
+
+async def delete_document( col: AsyncCollection, doc_id: str ) -> bool:
+    """Remove a document and all its memberships, in a single MULTI, see
+    collection.delete_document. Returns whether the document existed"""
+    await col.check_version()
+    cfg = col.cfg
+    doc_id = str( doc_id )
+    ordinal = None
+    if cfg.bitmap:
+        ordinal = await col.redis.hget( key_ordinals( col.name ), doc_id )
+        ordinal = None if ordinal is None else int( ordinal )
+    # position of the HDEL of the docs hash in the results of the MULTI
+    hdel_idx = 0
+
+    async def delete( pipe ):
+        nonlocal hdel_idx
+        # with bitmap postings a document without ordinal was never indexed
+        old = EMPTY_MEMBERS if cfg.bitmap and ordinal is None else \
+            await stored_doc_members( col, doc_id )
+        old_len = await pipe.zscore( key_doc_len( col.name ), doc_id ) \
+            if cfg.scored_text else None
+        pipe.multi()
+        hdel_idx = queue_delete( col, pipe, doc_id, ordinal, old, old_len )
+
+    res = await col.redis.transaction( delete, *watched_keys( col, doc_id ) )
+    col.mark_written()
+    return res[hdel_idx] == 1
+
+
+async def stored_doc_members( col: AsyncCollection, doc_id: str ) -> Dict[str, Set[str]]:
+    """Current members of the reverse sets of a document, see
+    indexing.stored_doc_members"""
+    async with col.redis.pipeline( transaction=False ) as pipe:
+        idx.queue_stored_members_reads( pipe, col.cfg, doc_id )
+        return idx.stored_members_from( col.cfg, await pipe.execute() )
+
+
+async def assign_ordinals( col: AsyncCollection, doc_ids: List[str] ) -> List[Optional[int]]:
+    """Ordinals of documents for bitmap postings, see indexing.assign_ordinals"""
+    if not col.cfg.bitmap or len(doc_ids) == 0:
+        return [ None ] * len(doc_ids)
+
+    await scripts.REGISTRY.ensure_loaded_async( col.redis, ['assign_ordinals'] )
+    return await col.redis.evalsha( scripts.REGISTRY.shas['assign_ordinals'], 3,
+                                    *idx.ordinal_keys( col.cfg ), *doc_ids )
+
+
+async def get_docs( col: AsyncCollection, doc_ids: List,
+                    fields: Optional[List[str]] = None ) -> List[Doc]:
+    """Documents with the given ids, in that order, fetched with one HMGET per stored part"""
+    if len(doc_ids) == 0:
+        return []
+
+    await col.check_version()
+    parts = idx.doc_parts( col.cfg, fields )
+    async with col.reader().pipeline( transaction=False ) as pipe:
+        for part in parts:
+            pipe.hmget( idx.doc_part_key( col.cfg, part ), doc_ids )
+        raws_by_part = await pipe.execute()
+
+    return decode_docs( col.cfg, parts, raws_by_part, fields )
+
+
+class AsyncSearchContext( SearchContext ):
+    """SearchContext on an asyncio pipeline. Commands are queued while evaluating and
+    sent together by the run methods, which need to be awaited"""
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.cleanup()
+
+    def is_pipelined(self) -> bool:
+        return True
+
+    async def run(self, expr: Expr) -> Set[Key]:
+        key = self.eval( expr )
+        ret = (await self._read( [ self.members_read( key ) ] ))[0]
+        return set( ret ) if self.bitmap else ret
+
+    async def run_page(self, expr: Expr, offset: int = 0, limit: Optional[int] = None,
+                       sort_zkey: Optional[Key] = None, desc: bool = False,
+                       with_scores: bool = False) -> Tuple[int, List[Key]]:
+        key = self.eval( expr )
+        res = await self._read( self.page_reads( key, offset, limit, sort_zkey, desc,
+                                                 with_scores ) )
+        return res[0], res[1] if len(res) > 1 else []
+
+    async def run_script(self, expr: Expr, name: str, args: List, keys: Sequence[Key] = ()):
+        key = self.eval( expr )
+        reads = [ lambda pipe: scripts.REGISTRY.call( pipe, name, [key, *keys], args ) ]
+        return (await self._read( reads ))[0]
+
+    async def _read(self, reads: List[Callable]) -> List:
+        res_idx = len( self.pipe )
+        for read in reads:
+            read( self.pipe )
+        end_idx = len( self.pipe )
+        if self.track_bytes:
+            for tmp_key in self.tmp_keys:
+                self.pipe.memory_usage( tmp_key )
+        if len(self.tmp_keys) > 0:
+            self.pipe.unlink( *self.tmp_keys )
+
+        ret = await self.pipe.execute()
+        if self.track_bytes:
+            sizes = ret[end_idx:end_idx + len(self.tmp_keys)]
+            self.tmp_bytes += sum( size or 0 for size in sizes )
+        self.n_deleted = len(self.tmp_keys)
+        return ret[res_idx:end_idx]
+
+    async def cleanup(self):
+        pending = self.tmp_keys[self.n_deleted:]
+        if len(pending) > 0:
+            await self.red.unlink( *pending )
+        self.n_deleted = len(self.tmp_keys)
+
+
+async def expand_approx( col: AsyncCollection, expr: Expr ) -> Expr:
+    """Replace approximate matches that find their tokens from the client (all engines
+    but 'lua', unless postings are bitmaps) by the exact matches of those tokens"""
+    if isinstance( expr, ContainsApprox ) and ( expr.engine != 'lua' or col.cfg.bitmap ):
+        return expr.expand_tokens( await matching_tokens( col, expr ) )
+
+    children = expr.sub_exprs()
+    if len(children) == 0:
+        return expr
+
+    return expr.with_children( [ await expand_approx( col, child ) for child in children ] )
+
+
+async def matching_tokens( col: AsyncCollection, expr: ContainsApprox ) -> List[str]:
+    """Tokens in the collection matching an approximate match"""
+    if expr.engine == 'symspell':
+        index = await fuzzy.get_index_async( col, expr.max_typos )
+        return index.lookup( expr.fuzzy_word( col.cfg ), expr.max_typos )
+
+    tokens = set()
+    red = col.reader()
+    for pat in expr.patterns:
+        async for tok in red.sscan_iter( expr.scan_key( col.name, pat ), match=pat,
+                                               count=10000 ):
+            tokens.add( tok.decode('utf8') )
+
+    return sorted( tokens )
+
+
+async def plan_expr( col: AsyncCollection, expr: Expr ) -> Expr:
+    """Same as search.plan_expr, with approximate matches expanded first"""
+    flat = ( await expand_approx( col, expr.flatten() ) ).flatten()
+    keys = sch.leaf_keys( col, flat )
+    if len(keys) < 2:
+        return flat
+
+    async with col.reader().pipeline( transaction=False ) as pipe:
+        for key in keys:
+            sch.queue_card( pipe, col.cfg, key )
+        cards = dict( zip( keys, await pipe.execute() ) )
+
+    planned, card = flat.plan( col, cards )
+    l_dbg( f"plan: {planned}  est. card={card}" )
+    return planned
+
+
+@pins_reader
+async def run_search( col: AsyncCollection, search_expr: Expr, planned: bool = True,
+                      stats: Optional[Dict] = None, track_bytes: bool = False ) -> Set[Key]:
+    """run search on a collection based on an expression, in one pipeline, see
+    search.run_search"""
+    search_expr = await _prepare( col, search_expr, planned )
+    if isinstance( search_expr, Empty ):
+        return set()
+
+    return await _run_in_context( col, lambda ctx: ctx.run( search_expr ), stats,
+                                  track_bytes )
+
+
+@pins_reader
+async def search_page( col: AsyncCollection, search_expr: Expr, offset: int = 0,
+                       limit: Optional[int] = 20, sort_by: Optional[Field] = None,
+                       desc: bool = False, hydrate: bool = True,
+                       fields: Optional[List[str]] = None, planned: bool = True,
+                       stats: Optional[Dict] = None, track_bytes: bool = False ) -> SearchPage:
+    """Run search returning only a page of results, see search.search_page"""
+    sch.check_page( offset, limit )
+    search_expr = await _prepare( col, search_expr, planned )
+    sort_zkey = sch.sort_key( col, sort_by )
+    if isinstance( search_expr, Empty ):
+        return SearchPage( 0, [], [] if hydrate else None )
+
+    total, ids = await _run_in_context(
+        col, lambda ctx: ctx.run_page( search_expr, offset, limit, sort_zkey, desc ),
+        stats, track_bytes )
+    docs = await get_docs( col, ids, fields ) if hydrate else None
+    return SearchPage( total, ids, docs )
+
+
+@pins_reader
+async def facet_counts( col: AsyncCollection, search_expr: Optional[Expr],
+                        fields: List[Field], top_n: Optional[int] = 10,
+                        planned: bool = True, stats: Optional[Dict] = None,
+                        track_bytes: bool = False ) -> Dict[str, List[Tuple[str, int]]]:
+    """Most frequent values of facet fields among matching documents, see
+    search.facet_counts"""
+    await col.check_version()
+    args = sch.facet_counts_args( col, fields, top_n )
+    script = sch.facet_counts_script( col )
+    if search_expr is None:
+        red = col.reader()
+        await scripts.REGISTRY.ensure_loaded_async( red, [script] )
+        res = await red.evalsha( scripts.REGISTRY.shas[script], 0, *args )
+        return sch.parse_facet_counts( fields, res )
+
+    search_expr = await _prepare( col, search_expr, planned )
+    if isinstance( search_expr, Empty ):
+        return { str(fld): [] for fld in fields }
+
+    res = await _run_in_context(
+        col, lambda ctx: ctx.run_script( search_expr, script, args ), stats, track_bytes )
+    return sch.parse_facet_counts( fields, res )
+
+
+async def _prepare( col: AsyncCollection, search_expr: Expr, planned: bool ) -> Expr:
+    await col.check_version()
+    if planned:
+        return await plan_expr( col, search_expr )
+
+    return await expand_approx( col, search_expr )
+
+
+async def _run_in_context( col: AsyncCollection, run: Callable[[AsyncSearchContext], T_],
+                           stats: Optional[Dict] = None, track_bytes: bool = False ):
+    """Awaited result of run on a fresh AsyncSearchContext on a pipeline, with all scripts
+    loaded beforehand, updating stats with the context's stats if given. Runs on the
+    connection picked by col.reader()"""
+    red = col.reader()
+    for attempt in range( 2 ):
+        await scripts.REGISTRY.ensure_loaded_async( red )
+        try:
+            start = time.perf_counter()
+            async with red.pipeline() as pipe, \
+                    AsyncSearchContext( col, pipe, track_bytes=track_bytes, red=red ) as ctx:
+                ret = await run( ctx )
+            col.router.observe( red, time.perf_counter() - start )
+            return sch.report_stats( ret, ctx, stats )
+        except NoScriptError:
+            if attempt > 0:
+                raise
+            # scripts were flushed from the server since we loaded them, do it again
+            scripts.REGISTRY.invalidate( red )
@@ -3,44 +3,174 @@
 Redis stored information
 
 key template     | type | key    | contents / value  | functions
-{col}/docs       | hash | doc_id | json docs         | load_document
+{col}/docs       | hash | doc_id | docs encoded with cfg.codec, see doc_codec.py | store_doc
+{col}/doc_fld/{fld} | hash | doc_id | field {fld} of docs, if in cfg.separate_flds | store_doc
 {col}/text_tokens | set  |        | text tokens from all docs | index_text
 {col}/docs/t:{tk} | set |    | doc_ids that contain  token {tk} in some text field |
 {col}/docs/f:{fld}/v:{val} | set |  | doc_ids that contain {val} in field {fld}
+{col}/docs/n:{fld} | zset | | doc_ids scored by the value of numeric field {fld} | index_numeric
 {col_name}/doc_facets/{doc_id}' | set |  Set of 'f:{fld}/v:{val}'  for a given doc_id
+{col}/facet_vals/{fld} | set |  | all values ever indexed in facet field {fld} | index_facet
+{col}/doc_toks/{doc_id} | set |  | Set of 't:{tok}' for tokens in text fields of doc_id
+{col}/doc_num/{doc_id} | set |   | Set of 'n:{fld}' for numeric fields of doc_id
+{col}/docs/tf:{tk} | zset | | doc_ids scored by occurrences of {tk}, if cfg.scored_text | index_term_freqs
+{col}/doc_len    | zset |        | doc_ids scored by number of text tokens, if cfg.scored_text
+{col}/text_stats | hash | total_len | sum of doc_len, if cfg.scored_text
+{col}/ord        | hash | doc_id | ordinal of doc, only with bitmap postings | assign_ordinals
+{col}/ord_ids    | hash | ordinal | doc_id with that ordinal, only with bitmap postings
+{col}/last_ord   | str  |        | number of ordinals handed out, only with bitmap postings
+{col}/all_ids    | set  |        | ids of all docs, for NOT     | index_document_pipe
+{col}/gen        | str  |        | generation counter, incremented on every write |
+{col}/epoch      | str  |        | random token set by the first write, see key_epoch |
+{col}/cache/{digest} | str |    | json cached search results, see result_cache.py
+
+With bitmap postings (cfg.postings == 'bitmap') the docs/t: and docs/f: keys are bitmaps
+with the bits of the ordinals of their docs set, and docs/n: members are ordinals.
+
+{col} above is the prefix of the version in use, {name}/v{n}, see versions.py. Under
+{name} itself:
+{name}/current   | str  |        | version currently served, 0 or missing = unversioned keys
+{name}/last_version | str |     | last version number handed out
 
 """
 # TODO: aproximate search of tokens
-# TODO: search numeric fields
-# TODO: way to update a document
 # TODO: in index document make all validation first then commit
 
-from typing import List, Dict, Optional, TypeVar
+from typing import Dict, Optional, TypeVar, Iterable, List, Any, Callable
+from contextlib import contextmanager
+from contextvars import ContextVar
+import functools
+import inspect
+import time
 from redis import Redis
-from common import Doc, DocId, CollectionConfig, batches_from_list
+from common import (Doc, DocId, CollectionConfig, batches_from_iter, bump_generation,
+                    key_current_version, versioned_name, key_doc_len, key_text_stats,
+                    key_all_ids)
 import indexing as idx
+from replicas import ReadRouter
 
 # %%
 T_ = TypeVar("T_")
 
+# seconds between checks of which version of a collection is current
+VERSION_CHECK_SECS = 1.0
+
+# members of the reverse sets of a document that isn't indexed
+EMPTY_MEMBERS = { kind: frozenset() for kind in idx.REVERSE_KINDS }
+
+# (collection, connection its reads are pinned to, config of the version in use) in the
+# current thread / task
+_PINNED_READER: ContextVar[Optional[tuple]] = ContextVar( "pinned_reader", default=None )
+
 
 
 class Collection:
-    """basic collection methods"""
-    def __init__(self, redis_conn: Redis):
+    """basic collection methods
+
+    Keys of a collection live under a versioned prefix, {name}/v{n} (see versions.py),
+    the version served being the one in {name}/current. cfg and name are those of that
+    version, re-read from the server at most every VERSION_CHECK_SECS, unless the
+    collection was configured for a fixed version.
+
+    Writes always go to redis_conn, the primary. Searches and document reads go to one of
+    the replicas if given, picked by read_policy (see replicas.py, replicas must accept
+    writes of temporary keys). For read_your_writes_secs after a write through this
+    collection reads go to the primary instead"""
+    # whether searches are evaluated in process rather than on Redis, see memory.py
+    is_local = False
+
+    def __init__(self, redis_conn: Redis, replicas: Optional[List[Redis]] = None,
+                 read_policy: str = 'round_robin', read_your_writes_secs: float = 0.0):
         self.redis = redis_conn
-        self.cfg: Optional[CollectionConfig] = None
+        self.router = ReadRouter( replicas or [], read_policy )
+        self.read_your_writes_secs = read_your_writes_secs
+        self._written_at: Optional[float] = None
+        self.base_cfg: Optional[CollectionConfig] = None
         self.id_fld = None
-        self.name = None
+        self.version: Optional[int] = None
+        self.pinned = False
+        self._cfg: Optional[CollectionConfig] = None
+        self._checked_at = 0.0
 
-    def configure(self, cfg: CollectionConfig):
-        """set the config"""
-        self.cfg = cfg
-        self.id_fld = self.cfg.id_fld
-        self.name = self.cfg.name
+    def configure(self, cfg: CollectionConfig, version: Optional[int] = None):
+        """set the config, optionally fixing the version used instead of the current one"""
+        self.base_cfg = cfg
+        self.id_fld = self.base_cfg.id_fld
+        self.pinned = version is not None
+        if self.pinned:
+            self._set_version( version )
+        else:
+            self.refresh_version( force=True )
 
         return self
 
+    @property
+    def cfg(self) -> Optional[CollectionConfig]:
+        """config of the version in use, its name is the prefix of all keys. Within
+        pinned_reader that is the version current when the block started"""
+        pinned = _PINNED_READER.get()
+        if pinned is not None and pinned[0] is self:
+            return pinned[2]
+        self.refresh_version()
+        return self._cfg
+
+    @property
+    def name(self) -> Optional[str]:
+        """prefix of the keys of the version in use"""
+        cfg = self.cfg
+        return None if cfg is None else cfg.name
+
+    @property
+    def base_name(self) -> Optional[str]:
+        """name of the collection regardless of version"""
+        return None if self.base_cfg is None else self.base_cfg.name
+
+    def refresh_version(self, force: bool = False) -> Optional[int]:
+        """Pick up the version currently served, checking the server at most every
+        VERSION_CHECK_SECS unless forced"""
+        if self.base_cfg is None or self.pinned:
+            return self.version
+
+        now = time.monotonic()
+        if force or now - self._checked_at >= VERSION_CHECK_SECS:
+            self._checked_at = now
+            self._set_version( int( self.redis.get( key_current_version( self.base_name ) )
+                                    or 0 ) )
+
+        return self.version
+
+    def _set_version(self, version: int):
+        if version != self.version or self._cfg is None:
+            self.version = version
+            self._cfg = self.base_cfg.with_name( versioned_name( self.base_name, version ) )
+
+    def reader(self) -> Any:
+        """Connection read-only requests go to: a replica, or the primary if there are
+        none or the collection was written to less than read_your_writes_secs ago"""
+        pinned = _PINNED_READER.get()
+        if pinned is not None and pinned[0] is self:
+            return pinned[1]
+        if self._written_at is not None and \
+                time.monotonic() - self._written_at < self.read_your_writes_secs:
+            return self.redis
+        replica = self.router.pick()
+        return self.redis if replica is None else replica
+
+    @contextmanager
+    def pinned_reader(self):
+        """Within the block, reads of this collection in the same thread / task all go to
+        the same connection, so they see the same data even if replicas lag differently,
+        and to the same version, even if another one is switched to meanwhile"""
+        token = _PINNED_READER.set( (self, self.reader(), self.cfg) )
+        try:
+            yield
+        finally:
+            _PINNED_READER.reset( token )
+
+    def mark_written(self):
+        """Record a write, for read-your-writes routing"""
+        self._written_at = time.monotonic()
+
     def x_id(self, doc: Doc) -> str:
         """extract the id from a document"""
         return str(doc[self.id_fld])
@@ -49,29 +179,219 @@ class Collection:
         """index a document"""
         return index_document( self, doc )
 
+    def update_document(self, doc: Doc):
+        """index a new version of a document"""
+        return update_document( self, doc )
+
+    def delete_document(self, doc_id: str) -> bool:
+        """remove a document from the index"""
+        return delete_document( self, doc_id )
+
+    def get_docs(self, doc_ids: List, fields: Optional[List[str]] = None) -> List[Doc]:
+        """get documents by id"""
+        return get_docs( self, doc_ids, fields )
+
     def get_all_docs(self) -> Dict[DocId, Doc]:
         """get dict of { doc_id -> Doc }"""
         return get_all_docs( self )
 
 
+def pins_reader( fun: Callable ) -> Callable:
+    """Decorator for (sync or async) functions taking a collection as first argument,
+    making all their reads go to the same connection and version, see
+    Collection.pinned_reader. Async functions take aio.AsyncCollection's, whose version
+    is checked before pinning it"""
+    if inspect.iscoroutinefunction( fun ):
+        @functools.wraps( fun )
+        async def async_wrapper( col, *args, **kwargs ):
+            await col.check_version()
+            with col.pinned_reader():
+                return await fun( col, *args, **kwargs )
+        return async_wrapper
+
+    @functools.wraps( fun )
+    def wrapper( col, *args, **kwargs ):
+        with col.pinned_reader():
+            return fun( col, *args, **kwargs )
+    return wrapper
+
+
 def index_document( col: Collection, doc: Doc ):
     """Index a single document in a single transaction"""
     with col.redis.pipeline() as pipe:
-        idx.index_document_pipe( pipe, col.cfg, doc )
+        idx.index_documents_pipe( col.redis, pipe, col.cfg, [doc] )
+        bump_generation( pipe, col.name )
         pipe.execute()
+    col.mark_written()
 
 
-def index_documents( col: Collection, docs: List[Doc], batch_size=1000 ):
-    """insert documents in batches"""
-    for batch in batches_from_list(docs, batch_size=batch_size):
+def index_documents( col: Collection, docs: Iterable[Doc], batch_size=1000, bulk: bool = False ):
+    """insert documents in batches. docs can be any iterable, e.g. a generator, and is
+    consumed one batch at a time.
+    With bulk=True writes of each batch are coalesced per key, see
+    indexing.index_documents_bulk_pipe"""
+    for batch in batches_from_iter(docs, batch_size=batch_size):
         with col.redis.pipeline() as pipe:
-            for doc in batch:
-                idx.index_document_pipe( pipe, col.cfg, doc )
+            if bulk:
+                idx.index_documents_bulk_pipe( col.redis, pipe, col.cfg, batch )
+            else:
+                idx.index_documents_pipe( col.redis, pipe, col.cfg, batch )
+            bump_generation( pipe, col.name )
             pipe.execute()
+        col.mark_written()
+
+
+def update_document( col: Collection, doc: Doc ):
+    """Replace a (possibly not yet indexed) document with a new version.
+
+    The document's current memberships are read from its reverse sets and only the
+    memberships that differ from the new version's are removed / added, in a single
+    MULTI. The reverse sets (and with cfg.scored_text the document lengths) are WATCHed
+    so concurrent changes to the same document make the update start over"""
+    cfg = col.cfg
+    doc_id = col.x_id( doc )
+    ordinal = idx.assign_ordinals( col.redis, cfg, [doc_id] )[0]
+    new, agg = idx.doc_members( cfg, doc, ordinal )
+    len_key = key_doc_len( col.name )
+
+    def update( pipe ):
+        old = idx.stored_doc_members( col.redis, cfg, doc_id )
+        old_len = pipe.zscore( len_key, doc_id ) if cfg.scored_text else None
+        pipe.multi()
+        queue_update( col, pipe, doc, ordinal, old, old_len, new, agg )
+
+    col.redis.transaction( update, *watched_keys( col, doc_id ) )
+    col.mark_written()
+
+
+def queue_update( col: Collection, pipe, doc: Doc, ordinal: Optional[int],
+                  old: Dict, old_len: Optional[float], new: Dict, agg: idx.KeyAggregator ):
+    """Queue the writes of update_document, given the document's old members and length
+    (read under WATCH) and its new members and writes (from indexing.doc_members)"""
+    cfg = col.cfg
+    doc_id = col.x_id( doc )
+    len_key = key_doc_len( col.name )
+    idx.apply_members_diff( pipe, cfg, doc_id, old, new, ordinal )
+    for key, scores in agg.zsets.items():
+        if key != len_key:
+            pipe.zadd( key, scores )
+    if cfg.scored_text:
+        set_doc_len( col, pipe, doc_id, old_len, agg.zsets[len_key][doc_id] )
+    idx.store_doc( pipe, cfg, doc_id, doc, replace=True )
+    idx.add_posting( pipe, key_all_ids( col.name ), doc_id, ordinal )
+    bump_generation( pipe, col.name )
+
+
+def delete_document( col: Collection, doc_id: str ) -> bool:
+    """Remove a document and all its memberships, in a single MULTI.
+    Returns whether the document existed"""
+    cfg = col.cfg
+    doc_id = str( doc_id )
+    ordinal = idx.doc_ordinal( col.redis, cfg, doc_id )
+    # position of the HDEL of the docs hash in the results of the MULTI
+    hdel_idx = 0
+
+    def delete( pipe ):
+        nonlocal hdel_idx
+        # with bitmap postings a document without ordinal was never indexed
+        old = EMPTY_MEMBERS if cfg.bitmap and ordinal is None else \
+            idx.stored_doc_members( col.redis, cfg, doc_id )
+        old_len = pipe.zscore( key_doc_len( col.name ), doc_id ) if cfg.scored_text else None
+        pipe.multi()
+        hdel_idx = queue_delete( col, pipe, doc_id, ordinal, old, old_len )
+
+    res = col.redis.transaction( delete, *watched_keys( col, doc_id ) )
+    col.mark_written()
+    return res[hdel_idx] == 1
+
+
+def queue_delete( col: Collection, pipe, doc_id: str, ordinal: Optional[int], old: Dict,
+                  old_len: Optional[float] ) -> int:
+    """Queue the writes of delete_document, given the document's members and length read
+    under WATCH. Returns the position of the HDEL of the docs hash in the MULTI, whose
+    result tells whether the document existed"""
+    cfg = col.cfg
+    idx.apply_members_diff( pipe, cfg, doc_id, old, EMPTY_MEMBERS, ordinal )
+    if cfg.scored_text:
+        set_doc_len( col, pipe, doc_id, old_len, None )
+    if not ( cfg.bitmap and ordinal is None ):
+        idx.remove_posting( pipe, key_all_ids( col.name ), doc_id, ordinal )
+    hdel_idx = len( pipe )
+    idx.unstore_doc( pipe, cfg, doc_id )
+    bump_generation( pipe, col.name )
+    return hdel_idx
+
+
+def watched_keys( col: Collection, doc_id: str ) -> List:
+    """Keys to WATCH while replacing or removing a document: its reverse sets, and the
+    document lengths its old length is read from with cfg.scored_text"""
+    ret = [ idx.key_doc_reverse( col.name, kind, doc_id ) for kind in idx.REVERSE_KINDS ]
+    if col.cfg.scored_text:
+        ret.append( key_doc_len( col.name ) )
+    return ret
+
+
+def set_doc_len( col: Collection, pipe, doc_id: str, old_len: Optional[float],
+                 length: Optional[int] ):
+    """Queue setting (or removing if length is None) the length of a document, keeping
+    the collection total_len in step. old_len is the current length, read under WATCH"""
+    if length is None:
+        pipe.zrem( key_doc_len( col.name ), doc_id )
+    else:
+        pipe.zadd( key_doc_len( col.name ), { doc_id: length } )
+    pipe.hincrby( key_text_stats( col.name ), 'total_len',
+                  int( ( length or 0 ) - ( old_len or 0 ) ) )
+
+
+def get_docs( col: Collection, doc_ids: List, fields: Optional[List[str]] = None ) -> List[Doc]:
+    """Documents with the given ids, in that order, fetched with one HMGET per stored part.
+    Ids of documents that don't exist (anymore) are skipped. If fields are given only those
+    fields are kept in each document, and separately stored fields not among them are not
+    fetched at all"""
+    if len(doc_ids) == 0:
+        return []
+
+    parts = idx.doc_parts( col.cfg, fields )
+    with col.reader().pipeline( transaction=False ) as pipe:
+        for part in parts:
+            pipe.hmget( idx.doc_part_key( col.cfg, part ), doc_ids )
+        raws_by_part = pipe.execute()
+
+    return decode_docs( col.cfg, parts, raws_by_part, fields )
+
+
+def decode_docs( cfg: CollectionConfig, parts: List[Optional[str]],
+                 raws_by_part: List[List[Optional[bytes]]],
+                 fields: Optional[List[str]] = None ) -> List[Doc]:
+    """Documents from the stored parts (see indexing.doc_parts) of each, skipping missing
+    ones and keeping only fields if given"""
+    ret = []
+    for raws in zip( *raws_by_part ):
+        doc = idx.decode_doc( cfg, parts, raws )
+        if doc is None:
+            continue
+        if fields is not None:
+            doc = { fld: doc[fld] for fld in fields if fld in doc }
+        ret.append( doc )
+
+    return ret
 
 
 def get_all_docs( col: Collection ) -> Dict:
-    """get all docs in collection as dict"""
+    """get all docs in collection as dict { doc_id -> Doc }"""
     # %%
-    return col.redis.hgetall( f"{col.name}/docs" )
+    parts = idx.doc_parts( col.cfg )
+    with col.reader().pipeline( transaction=False ) as pipe:
+        for part in parts:
+            pipe.hgetall( idx.doc_part_key( col.cfg, part ) )
+        stored = pipe.execute()
+
+    return decode_all_docs( col.cfg, parts, stored )
     # %%
+
+
+def decode_all_docs( cfg: CollectionConfig, parts: List[Optional[str]],
+                     stored: List[Dict[bytes, bytes]] ) -> Dict:
+    """{ doc_id -> Doc } from the whole hash of each stored part"""
+    return { doc_id: idx.decode_doc( cfg, parts, [ by_id.get( doc_id ) for by_id in stored ] )
+             for doc_id in stored[0] }
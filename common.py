@@ -1,7 +1,13 @@
 """common classes and functions used throughout"""
 
-from typing import Dict, Any, Union, List, TypeVar
+from typing import Dict, Any, Union, List, TypeVar, Iterable, Iterator, Optional
+from itertools import islice
+import copy
 import datetime as dt
+import secrets
+
+from tokenizer import Tokenizer
+from doc_codec import DocCodec, get_codec
 
 Doc = Dict[str, Any]
 DocId = int
@@ -23,9 +29,25 @@ def f( name ) -> Field:
 
 class CollectionConfig:
     """Configuration for a collection"""
+    POSTINGS = ('set', 'bitmap')
+
     def __init__(self, name: str,
                  id_fld: str, facet_flds: List[str], text_flds: List[str],
-                 number_flds: List[str], stop_words: List[str]):
+                 number_flds: List[str], stop_words: List[str], scored_text: bool = False,
+                 postings: str = 'set', codec: Union[str, DocCodec] = 'json',
+                 separate_flds: Iterable[str] = ()):
+        """scored_text: whether to also store term frequencies and document lengths for
+        relevance ranked search (search.ranked_search)
+        postings: format of the token and facet value doc sets, 'set' for Redis sets of doc
+        ids or 'bitmap' for bitmaps over dense document ordinals (see indexing.py)
+        codec: how documents are stored, a doc_codec.DocCodec or the name of one
+        separate_flds: (large) fields stored apart from the rest of the document, in
+        {col}/doc_fld/{fld}, so that they are only fetched when asked for"""
+        if postings not in self.POSTINGS:
+            raise ValueError( f"Unknown postings format: {postings}" )
+        separate_flds = list( separate_flds )
+        if id_fld in separate_flds:
+            raise ValueError( f"The id field can't be stored separately: {id_fld}" )
 
         self.name = name
         self.id_fld = id_fld
@@ -33,7 +55,24 @@ class CollectionConfig:
         self.facet_flds = facet_flds
         self.number_flds = number_flds
         self.stop_words = set( stop_words )
+        self.scored_text = scored_text
+        self.postings = postings
+        self.codec = get_codec( codec )
+        self.separate_flds = separate_flds
         self.transl_tbl = str.maketrans(dict(zip("áéíóúàèìòùñç", "aeiouaeiounc")))
+        self.tokenizer = Tokenizer( self.transl_tbl, self.stop_words )
+
+    @property
+    def bitmap(self) -> bool:
+        """Whether postings are bitmaps"""
+        return self.postings == 'bitmap'
+
+    def with_name(self, name: str) -> 'CollectionConfig':
+        """Copy of this config whose keys live under another name, e.g. a collection
+        version"""
+        ret = copy.copy( self )
+        ret.name = name
+        return ret
 
 
 def x_id(doc: Doc, id_fld: str):
@@ -62,12 +101,108 @@ def key_facet_fld_val( col_name: str, fld: str, val: Scalar ) -> Key:
     return f'{col_name}/docs/f:{fld}/v:{val}'.encode('utf8')
 
 
+def key_all_ids( col_name: str ) -> Key:
+    """Redis Key of set (bitmap with bitmap postings) of the ids of all documents, the
+    universe NOT is evaluated against"""
+    return f'{col_name}/all_ids'.encode('utf8')
+
+
+def key_doc_field( col_name: str, fld: str ) -> str:
+    """Key of hash with the values of a field stored apart from the documents, by doc_id"""
+    return f'{col_name}/doc_fld/{fld}'
+
+
+def key_ordinals( col_name: str ) -> Key:
+    """Redis Key of hash mapping doc ids to their ordinals, for bitmap postings"""
+    return f'{col_name}/ord'.encode('utf8')
+
+
+def key_ordinal_ids( col_name: str ) -> Key:
+    """Redis Key of hash mapping ordinals back to doc ids, for bitmap postings"""
+    return f'{col_name}/ord_ids'.encode('utf8')
+
+
+def key_last_ordinal( col_name: str ) -> Key:
+    """Redis Key of counter of ordinals handed out, for bitmap postings"""
+    return f'{col_name}/last_ord'.encode('utf8')
+
+
+def key_term_freqs( col_name: str, tok: str ) -> Key:
+    """Redis Key of sorted set of ids of documents containing token {tok} in their text
+    fields, scored by the number of times it occurs"""
+    return f'{col_name}/docs/tf:{tok}'.encode('utf8')
+
+
+def key_doc_len( col_name: str ) -> Key:
+    """Redis Key of sorted set of doc ids scored by the number of tokens in their text
+    fields"""
+    return f'{col_name}/doc_len'.encode('utf8')
+
+
+def key_text_stats( col_name: str ) -> Key:
+    """Redis Key of hash with collection wide text statistics (total_len)"""
+    return f'{col_name}/text_stats'.encode('utf8')
+
+
+def key_facet_values( col_name: str, fld: str ) -> Key:
+    """Redis Key of set with all the values ever indexed in facet field {fld}"""
+    return f'{col_name}/facet_vals/{fld}'.encode('utf8')
+
+
 def key_numeric_fld( col_name: str, fld: str ) -> Key:
     """Redis Key of sorted set containing doc ids of documents and values for the given
      numeric field"""
     return f'{col_name}/docs/n:{fld}'.encode("utf8")
 
 
+def key_generation( col_name: str ) -> Key:
+    """Redis Key of counter that gets incremented every time documents are written to the
+    collection"""
+    return f'{col_name}/gen'.encode("utf8")
+
+
+def key_epoch( col_name: str ) -> Key:
+    """Redis Key of string with a random token set by the first write to the collection
+    (after it was created or cleared), so that a generation counter restarted by
+    util.clear_collection is not mistaken for the one before"""
+    return f'{col_name}/epoch'.encode("utf8")
+
+
+def bump_generation( pipe, col_name: str ):
+    """Queue the two commands that mark a write to the collection: incrementing its
+    generation and setting its epoch if it has none"""
+    pipe.incr( key_generation( col_name ) )
+    pipe.set( key_epoch( col_name ), secrets.token_hex( 8 ), nx=True )
+
+
+def generation_stamp( gen: Optional[bytes], epoch: Optional[bytes] ) -> str:
+    """Value identifying the state of a collection from the stored values of its
+    key_generation and key_epoch, changes on every write and never repeats after a clear"""
+    return f"{(epoch or b'').decode('utf8')}:{int( gen or 0 )}"
+
+
+def key_result_cache( col_name: str, digest: str ) -> Key:
+    """Redis Key of string holding cached search results for the expression with the given
+    digest"""
+    return f'{col_name}/cache/{digest}'.encode("utf8")
+
+
+def key_current_version( base_name: str ) -> Key:
+    """Redis Key of string holding the version of a collection that is currently served"""
+    return f'{base_name}/current'.encode("utf8")
+
+
+def key_last_version( base_name: str ) -> Key:
+    """Redis Key of counter holding the last version number handed out for a collection"""
+    return f'{base_name}/last_version'.encode("utf8")
+
+
+def versioned_name( base_name: str, version: int ) -> str:
+    """Prefix of the keys of a given version of a collection. Version 0 stands for
+    collections created before versions existed, whose keys are directly under base_name"""
+    return base_name if version == 0 else f'{base_name}/v{version}'
+
+
 def as_list( doc: Doc, fld: str ):
     """If value of field is list return as is, otherwise return single element list [ doc[fld] ] """
     val0 = doc[fld]
@@ -87,6 +222,17 @@ def batches_from_list(a_list: List[T_], batch_size: int ):
         yield a_list[ndx:min(ndx + batch_size, l_len)]
 
 
+def batches_from_iter(an_iter: Iterable[T_], batch_size: int ) -> Iterator[List[T_]]:
+    """Generate successive batchs of at most batch_size elements from any iterable,
+    consuming it lazily so only one batch is held in memory at a time"""
+    iterator = iter( an_iter )
+    while True:
+        batch = list( islice( iterator, batch_size ) )
+        if len(batch) == 0:
+            return
+        yield batch
+
+
 def timeit( fun ):
     t0 = dt.datetime.now()
     ret = fun()
@@ -0,0 +1,121 @@
+"""Codecs for documents stored in the {col}/docs hash
+
+The codec of a collection is set in its CollectionConfig, either by name or as an instance:
+
+- 'json': json.dumps as is, the format of collections created before codecs existed
+- 'compact_json': json without whitespace and with non ascii characters as utf8
+- 'zlib': compact json compressed with raw deflate. Small documents compress much better
+  with a shared dictionary of the strings common to all of them, see train_zdict
+- 'marshal': Python's marshal format, fastest to decode but only readable from Python
+
+Stored documents are not tagged with their codec: changing the codec of a collection means
+reindexing it, e.g. into a new version (see versions.reindex).
+"""
+import abc
+import json
+import marshal
+import re
+import zlib
+from collections import Counter
+from typing import Any, Dict, Iterable, Union
+
+# raw deflate, without the zlib header and checksum (6 bytes per document)
+DEFLATE_WBITS = -15
+
+
+class DocCodec( abc.ABC ):
+    """Turns documents (or any value found in one) into bytes and back"""
+
+    @abc.abstractmethod
+    def encode(self, obj: Any) -> bytes:
+        """Stored form of obj"""
+
+    @abc.abstractmethod
+    def decode(self, raw: bytes) -> Any:
+        """Object from its stored form"""
+
+
+class JsonCodec( DocCodec ):
+    """Json text, compact: without whitespace and with non ascii characters as utf8"""
+
+    def __init__(self, compact: bool = False):
+        self.compact = compact
+
+    def encode(self, obj: Any) -> bytes:
+        if self.compact:
+            return json.dumps( obj, separators=(',', ':'), ensure_ascii=False ).encode('utf8')
+        return json.dumps( obj ).encode('utf8')
+
+    def decode(self, raw: bytes) -> Any:
+        return json.loads( raw )
+
+
+class MarshalCodec( DocCodec ):
+    """Python's marshal serialization"""
+
+    def encode(self, obj: Any) -> bytes:
+        return marshal.dumps( obj )
+
+    def decode(self, raw: bytes) -> Any:
+        return marshal.loads( raw )
+
+
+class ZlibCodec( DocCodec ):
+    """Compact json compressed with deflate, optionally primed with a shared dictionary
+    (zdict). Documents must be decoded with the same zdict they were encoded with"""
+
+    def __init__(self, zdict: bytes = b'', level: int = 6):
+        self.zdict = zdict
+        self.level = level
+        self.inner = JsonCodec( compact=True )
+
+    def encode(self, obj: Any) -> bytes:
+        comp = zlib.compressobj( self.level, zlib.DEFLATED, DEFLATE_WBITS, zdict=self.zdict ) \
+            if self.zdict else zlib.compressobj( self.level, zlib.DEFLATED, DEFLATE_WBITS )
+        return comp.compress( self.inner.encode( obj ) ) + comp.flush()
+
+    def decode(self, raw: bytes) -> Any:
+        decomp = zlib.decompressobj( DEFLATE_WBITS, zdict=self.zdict ) \
+            if self.zdict else zlib.decompressobj( DEFLATE_WBITS )
+        return self.inner.decode( decomp.decompress( raw ) + decomp.flush() )
+
+
+CODECS: Dict[str, DocCodec] = {
+    'json': JsonCodec(),
+    'compact_json': JsonCodec( compact=True ),
+    'zlib': ZlibCodec(),
+    'marshal': MarshalCodec(),
+}
+
+# pieces of compact json worth putting in a dictionary: keys, short strings and words
+_FRAGMENT_RE = re.compile( rb'"[^"\\]{1,40}":|"[^"\\]{1,24}"|\w{3,}\W?' )
+
+
+def train_zdict( docs: Iterable[Dict], size: int = 16384 ) -> bytes:
+    """Shared dictionary for ZlibCodec from sample documents: the fragments of their
+    compact json that save the most bytes (occurrences times length), up to size bytes.
+    The most frequent go last, where deflate reaches them with the shortest distances"""
+    counts = Counter()
+    encoder = CODECS['compact_json']
+    for doc in docs:
+        counts.update( _FRAGMENT_RE.findall( encoder.encode( doc ) ) )
+
+    chosen = []
+    n_bytes = 0
+    for frag, n_occ in sorted( counts.items(), key=lambda item: -item[1] * len(item[0]) ):
+        if n_occ < 2 or n_bytes + len(frag) > size:
+            continue
+        chosen.append( (n_occ, frag) )
+        n_bytes += len(frag)
+
+    chosen.sort()
+    return b''.join( frag for _, frag in chosen )
+
+
+def get_codec( codec: Union[str, DocCodec] ) -> DocCodec:
+    """Codec instance from a codec or the name of one"""
+    if isinstance( codec, DocCodec ):
+        return codec
+    if codec not in CODECS:
+        raise ValueError( f"Unknown document codec: {codec!r}, known ones: {list(CODECS)}" )
+    return CODECS[codec]
@@ -0,0 +1,167 @@
+"""In-process index for approximate (typo tolerant) token lookup
+
+Uses the deletion neighbourhood approach of SymSpell: every token is stored under all
+the strings obtained by deleting up to max_dist of its characters. Two words within edit
+distance k share at least one such string, so a lookup only generates the deletions of
+the query word, collects the tokens stored under them and verifies the few candidates
+with an actual edit distance computation.
+"""
+import threading
+import weakref
+from itertools import combinations
+from typing import Dict, List, Set, Iterable, Optional
+
+from common import key_generation, key_epoch, generation_stamp
+from collection import Collection
+
+# { connection pool of the collection -> { collection name -> index } }: collections with
+# the same name on different servers (e.g. the shards of a sharding.ShardedCollection)
+# each have their own index
+_INDEXES: 'weakref.WeakKeyDictionary[object, Dict[str, FuzzyIndex]]' = \
+    weakref.WeakKeyDictionary()
+_INDEXES_LOCK = threading.Lock()
+
+
+class FuzzyIndex:
+    """Deletion neighbourhood index over a set of tokens"""
+
+    def __init__(self, max_dist: int = 2):
+        self.max_dist = max_dist
+        self.tokens: Set[str] = set()
+        self.deletes: Dict[str, List[str]] = {}
+        # generation_stamp of the collection when last refreshed
+        self.stamp: Optional[str] = None
+        self.lock = threading.Lock()
+
+    def add_tokens(self, tokens: Iterable[str]) -> int:
+        """Add tokens not yet in the index, returns how many were new"""
+        n_new = 0
+        for tok in tokens:
+            if tok in self.tokens:
+                continue
+            self.tokens.add( tok )
+            n_new += 1
+            for variant in deletions( tok, self.max_dist ):
+                self.deletes.setdefault( variant, [] ).append( tok )
+
+        return n_new
+
+    def lookup(self, word: str, max_dist: int) -> List[str]:
+        """Tokens within edit distance max_dist of word, sorted by distance then token"""
+        if max_dist > self.max_dist:
+            raise ValueError( f"Index built for distances up to {self.max_dist}, "
+                              f"got {max_dist}" )
+
+        candidates = set()
+        for variant in deletions( word, max_dist ):
+            candidates.update( self.deletes.get( variant, () ) )
+
+        dists = [ (edit_distance( word, tok, max_dist ), tok) for tok in candidates ]
+        return [ tok for dist, tok in sorted( dists ) if dist <= max_dist ]
+
+    def clear(self):
+        """Forget all tokens"""
+        self.tokens = set()
+        self.deletes = {}
+
+    def refresh(self, col: Collection, force: bool = False) -> int:
+        """Pick up tokens added to the collection since the last refresh. The collection
+        generation is checked on every call (one MGET), so lookups never miss tokens of
+        documents already written and results cached under that generation are complete,
+        tokens are only read when it changed. If the collection was cleared since, the
+        tokens are loaded from scratch. Returns number of new tokens"""
+        with self.lock:
+            red = col.reader()
+            stamp = generation_stamp( *red.mget( key_generation( col.name ),
+                                                 key_epoch( col.name ) ) )
+            if not force and stamp == self.stamp:
+                return 0
+
+            tokens = ( tok.decode('utf8') for tok in
+                       red.sscan_iter( f"{col.name}/text_tokens", count=10000 ) )
+            self._clear_if_new_epoch( stamp )
+            n_new = self.add_tokens( tokens )
+            self.stamp = stamp
+            return n_new
+
+    async def refresh_async(self, col, force: bool = False) -> int:
+        """Same as refresh for a collection on an asyncio connection (aio.AsyncCollection)"""
+        red = col.reader()
+        stamp = generation_stamp( *await red.mget( key_generation( col.name ),
+                                                   key_epoch( col.name ) ) )
+        if not force and stamp == self.stamp:
+            return 0
+
+        tokens = [ tok.decode('utf8') async for tok in
+                   red.sscan_iter( f"{col.name}/text_tokens", count=10000 ) ]
+        with self.lock:
+            self._clear_if_new_epoch( stamp )
+            n_new = self.add_tokens( tokens )
+            self.stamp = stamp
+        return n_new
+
+    def _clear_if_new_epoch(self, stamp: str):
+        """Drop the tokens of a collection that has been cleared since the last refresh"""
+        if self.stamp is not None and stamp.split(':')[0] != self.stamp.split(':')[0]:
+            self.clear()
+
+
+def get_index( col: Collection, max_dist: int = 2 ) -> FuzzyIndex:
+    """The process wide fuzzy index for a collection, loaded on first use and refreshed
+    with new tokens as documents are indexed"""
+    index = _registered_index( col, max_dist )
+    index.refresh( col )
+    return index
+
+
+async def get_index_async( col, max_dist: int = 2 ) -> FuzzyIndex:
+    """Same as get_index for a collection on an asyncio connection"""
+    index = _registered_index( col, max_dist )
+    await index.refresh_async( col )
+    return index
+
+
+def _registered_index( col: Collection, max_dist: int ) -> FuzzyIndex:
+    with _INDEXES_LOCK:
+        indexes = _INDEXES.setdefault( col.redis.connection_pool, {} )
+        index = indexes.get( col.name )
+        if index is None or index.max_dist < max_dist:
+            index = FuzzyIndex( max_dist=max(max_dist, 2) )
+            indexes[col.name] = index
+
+    return index
+
+
+def deletions( word: str, max_dist: int ) -> Set[str]:
+    """All strings obtained by deleting at most max_dist characters from word,
+    including word itself"""
+    ret = { word }
+    for n_del in range( 1, min( max_dist, len(word) ) + 1 ):
+        for positions in combinations( range( len(word) ), n_del ):
+            ret.add( ''.join( ch for i, ch in enumerate(word) if i not in positions ) )
+
+    return ret
+
+
+def edit_distance( word1: str, word2: str, max_dist: int ) -> int:
+    """Damerau-Levenshtein (optimal string alignment) distance, counting
+    insertions, deletions, substitutions and transpositions of adjacent characters.
+    Returns max_dist + 1 as soon as the distance is known to exceed max_dist"""
+    if abs( len(word1) - len(word2) ) > max_dist:
+        return max_dist + 1
+
+    prev2: List[int] = []
+    prev = list( range( len(word2) + 1 ) )
+    for i in range( 1, len(word1) + 1 ):
+        cur = [i] + [0] * len(word2)
+        for j in range( 1, len(word2) + 1 ):
+            cost = 0 if word1[i - 1] == word2[j - 1] else 1
+            cur[j] = min( prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + cost )
+            if i > 1 and j > 1 and word1[i - 1] == word2[j - 2] and word1[i - 2] == word2[j - 1]:
+                cur[j] = min( cur[j], prev2[j - 2] + 1 )
+
+        if min( cur ) > max_dist:
+            return max_dist + 1
+        prev2, prev = prev, cur
+
+    return min( prev[-1], max_dist + 1 )
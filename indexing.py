@@ -1,29 +1,154 @@
-"""Core functions for indexing"""
-from typing import List, Set, TypeVar
+"""Core functions for indexing
 
-import json
+Doc sets of tokens and facet values (postings) are either Redis sets of doc ids or, for
+collections configured with postings='bitmap', bitmaps with one bit per document. Each
+document then gets a dense integer ordinal (see assign_ordinals), which is the bit it
+sets in bitmaps and its member in numeric sorted sets. Functions writing postings take
+that ordinal, which is None for set postings.
+"""
+from typing import List, Set, Dict, TypeVar, Union, Optional, Tuple
+from collections import defaultdict, Counter
+
+import scripts
 from redis import Redis
 from redis.client import Pipeline
 
 from common import ( Doc, Scalar, key_facet_fld_val, key_token, key_numeric_fld,
+                     key_facet_values, key_term_freqs, key_doc_len, key_text_stats,
+                     key_ordinals, key_ordinal_ids, key_last_ordinal, key_all_ids,
+                     key_doc_field,
                      CollectionConfig, is_scalar, is_number, as_list, x_id )
-import re
+from tokenizer import Tokenizer
 
 T_ = TypeVar("T_")
 
+# Kinds of per document reverse sets, {col}/{kind}/{doc_id}. Their members are the
+# suffixes, relative to {col}/docs/, of the keys the document was added to
+REVERSE_KINDS = ('doc_toks', 'doc_facets', 'doc_num')
+
+
+class KeyAggregator:
+    """Stands in for a pipeline while indexing, accumulating the members written to each
+    key so that each key gets a single variadic SADD / ZADD / HSET when flushed"""
+    # max members per command when flushing, so no single command blocks the server
+    CHUNK_SIZE = 10000
+
+    def __init__(self):
+        self.sets: Dict[Union[str, bytes], Set] = defaultdict(set)
+        self.zsets: Dict[Union[str, bytes], Dict] = defaultdict(dict)
+        self.hashes: Dict[Union[str, bytes], Dict] = defaultdict(dict)
+        self.counters: Dict[tuple, int] = defaultdict(int)
+        self.bits: Dict[Union[str, bytes], Dict[int, int]] = defaultdict(dict)
+
+    def sadd(self, key, *members):
+        """Queue members to be added to set"""
+        self.sets[key].update( members )
+
+    def zadd(self, key, mapping: Dict):
+        """Queue members and scores to be added to sorted set"""
+        self.zsets[key].update( mapping )
+
+    def hset(self, key, field, value):
+        """Queue field to be set in hash"""
+        self.hashes[key][field] = value
+
+    def setbit(self, key, offset: int, value: int):
+        """Queue bit to be set in bitmap"""
+        self.bits[key][offset] = value
+
+    def hincrby(self, key, field, amount: int = 1):
+        """Queue increment of hash field"""
+        self.counters[(key, field)] += amount
+
+    def flush(self, pipe: Pipeline):
+        """Queue the accumulated writes on a real pipeline"""
+        chunk = self.CHUNK_SIZE
+        for key, members in self.hashes.items():
+            items = list( members.items() )
+            for i in range( 0, len(items), chunk ):
+                pipe.hset( key, mapping=dict( items[i:i + chunk] ) )
+
+        for key, members in self.sets.items():
+            members = list( members )
+            for i in range( 0, len(members), chunk ):
+                pipe.sadd( key, *members[i:i + chunk] )
+
+        for key, members in self.zsets.items():
+            items = list( members.items() )
+            for i in range( 0, len(items), chunk ):
+                pipe.zadd( key, dict( items[i:i + chunk] ) )
+
+        for (key, field), amount in self.counters.items():
+            pipe.hincrby( key, field, amount )
+
+        for key, bits in self.bits.items():
+            items = list( bits.items() )
+            for i in range( 0, len(items), chunk ):
+                ops = pipe.bitfield( key )
+                for offset, value in items[i:i + chunk]:
+                    ops.set( 'u1', offset, value )
+                ops.execute()
+
+
+def add_posting( pipe: Pipeline, key: Union[str, bytes], doc_id: str, ordinal: Optional[int] ):
+    """Add a document to a doc set, a bitmap if ordinal is given"""
+    if ordinal is None:
+        pipe.sadd( key, doc_id )
+    else:
+        pipe.setbit( key, ordinal, 1 )
+
+
+def remove_posting( pipe: Pipeline, key: Union[str, bytes], doc_id: str,
+                    ordinal: Optional[int] ):
+    """Remove a document from a doc set, a bitmap if ordinal is given"""
+    if ordinal is None:
+        pipe.srem( key, doc_id )
+    else:
+        pipe.setbit( key, ordinal, 0 )
+
 
-def index_text( pipe: Pipeline, cfg: CollectionConfig,  doc_id: str, text: str):
+def assign_ordinals( red: Redis, cfg: CollectionConfig, doc_ids: List[str] ) -> List[Optional[int]]:
+    """Ordinals of documents for bitmap postings, handing out new ones to documents that
+    don't have one yet, in one round-trip. All None for set postings"""
+    if not cfg.bitmap or len(doc_ids) == 0:
+        return [ None ] * len(doc_ids)
+
+    return scripts.REGISTRY.call( red, 'assign_ordinals', ordinal_keys( cfg ), doc_ids )
+
+
+def ordinal_keys( cfg: CollectionConfig ) -> List[bytes]:
+    """Keys of the assign_ordinals script"""
+    return [ key_ordinals( cfg.name ), key_ordinal_ids( cfg.name ), key_last_ordinal( cfg.name ) ]
+
+
+def doc_ordinal( red: Redis, cfg: CollectionConfig, doc_id: str ) -> Optional[int]:
+    """Ordinal of a document for bitmap postings, None if it has none or postings are sets"""
+    if not cfg.bitmap:
+        return None
+
+    ordinal = red.hget( key_ordinals( cfg.name ), doc_id )
+    return None if ordinal is None else int( ordinal )
+
+
+def index_text( pipe: Pipeline, cfg: CollectionConfig,  doc_id: str, text: str,
+                with_pats: bool = True, ordinal: Optional[int] = None ):
     """Index text from text field"""
-    tokens = tokenize(text, cfg.transl_tbl, cfg.stop_words)
+    index_tokens( pipe, cfg, doc_id, cfg.tokenizer.tokenize( text ), with_pats, ordinal )
 
+
+def index_tokens( pipe: Pipeline, cfg: CollectionConfig,  doc_id: str, tokens: List[str],
+                  with_pats: bool = True, ordinal: Optional[int] = None ):
+    """Index the tokens of a text field"""
     if len(tokens) == 0:
         return
 
     pipe.sadd(f'{cfg.name}/text_tokens', *tokens)
+    pipe.sadd(f'{cfg.name}/doc_toks/{doc_id}', *[ f't:{tok}' for tok in tokens ])
 
     for tok in tokens:
-        index_pats(pipe, cfg, tok)
-        pipe.sadd( key_token( cfg.name, tok), doc_id)
+        if with_pats:
+            index_pats(pipe, cfg, tok)
+        add_posting( pipe, key_token( cfg.name, tok), doc_id, ordinal )
 
 
 def index_pats( pipe: Pipeline, cfg: CollectionConfig, tok: str ):
@@ -47,41 +172,62 @@ def index_pats( pipe: Pipeline, cfg: CollectionConfig, tok: str ):
         pipe.sadd(f'{cfg.name}/e_pat/{tok[-4]}?{tok[-2]}?', tok)
 
 
-def tokenize(text: str, trans_tabl: str, stop_words: Set[str]) -> List[str]:
-    """Produce a list of tokens from a text"""
-    text1 = text.lower().translate( trans_tabl )
-    # print("text1 = ", text1 )
-    text2 = re.sub('[^a-z0-9]', ' ', text1)
-    # print("text2 = ", text2 )
-    tokens = [ tok for tok in text2.split(" ") if (tok != '' and tok not in stop_words) ]
-
-    return tokens
+def tokenize(text: str, trans_tabl: Dict[int, str], stop_words: Set[str]) -> List[str]:
+    """Produce a list of tokens from a text. Prefer cfg.tokenizer.tokenize"""
+    return Tokenizer( trans_tabl, stop_words ).tokenize( text )
     # %%
 
 
-def index_facet( red: Redis, col_name: str, doc_id: str, fld: str, val: Scalar ):
+def index_term_freqs( pipe: Pipeline, cfg: CollectionConfig, doc_id: str, tokens: List[str] ):
+    """Index the number of occurrences of every token in a doc's text fields, and its
+    length, for relevance ranking"""
+    for tok, n_occ in Counter( tokens ).items():
+        pipe.zadd( key_term_freqs( cfg.name, tok ), { doc_id: n_occ } )
+    pipe.zadd( key_doc_len( cfg.name ), { doc_id: len(tokens) } )
+    pipe.hincrby( key_text_stats( cfg.name ), 'total_len', len(tokens) )
+
+
+def index_facet( red: Redis, col_name: str, doc_id: str, fld: str, val: Scalar,
+                 ordinal: Optional[int] = None ):
     """Index the fact that doc has a facet value in given field"""
-    red.sadd(key_facet_fld_val( col_name, fld, val), doc_id )
+    add_posting( red, key_facet_fld_val( col_name, fld, val), doc_id, ordinal )
     red.sadd(f'{col_name}/doc_facets/{doc_id}', f'f:{fld}/v:{val}')
+    red.sadd(key_facet_values( col_name, fld ), str(val) )
 
 
-def index_numeric( red: Redis, col_name: str, doc_id: str, fld: str, val: float ):
+def index_numeric( red: Redis, col_name: str, doc_id: str, fld: str, val: float,
+                   ordinal: Optional[int] = None ):
     """Index the fact that doc has a facet value in given field"""
-    red.zadd(key_numeric_fld( col_name, fld), { doc_id: val } )
-    red.sadd(f'{col_name}/doc_num/{doc_id}', f'n:{val}')
+    member = doc_id if ordinal is None else str( ordinal )
+    red.zadd(key_numeric_fld( col_name, fld), { member: val } )
+    red.sadd(f'{col_name}/doc_num/{doc_id}', f'n:{fld}')
 
 
-def index_document_pipe( pipe: Pipeline, cfg: CollectionConfig, doc: Doc ):
-    """Push a document into the index"""
+def index_document_pipe( pipe: Pipeline, cfg: CollectionConfig, doc: Doc,
+                         with_pats: bool = True,
+                         fld_tokens: Optional[Dict[str, List[str]]] = None,
+                         ordinal: Optional[int] = None ):
+    """Push a document into the index. fld_tokens, if given, holds the already computed
+    tokens of the doc's text fields. ordinal is required for bitmap postings"""
+    assert ordinal is not None or not cfg.bitmap, "bitmap postings need the doc ordinal"
     # doc_id = doc[ col.id_fld ]
     doc_id = x_id(doc, cfg.id_fld)
 
-    pipe.hset( f'{cfg.name}/docs', doc_id, json.dumps(doc) )
+    store_doc( pipe, cfg, doc_id, doc )
+    add_posting( pipe, key_all_ids( cfg.name ), doc_id, ordinal )
 
+    doc_tokens = []
     for fld in cfg.text_flds:
         if fld in doc:
-            text = doc[fld]
-            index_text( pipe, cfg, doc_id, text)
+            if fld_tokens is not None:
+                tokens = fld_tokens[fld]
+            else:
+                tokens = cfg.tokenizer.tokenize( doc[fld] )
+            index_tokens( pipe, cfg, doc_id, tokens, with_pats, ordinal )
+            doc_tokens.extend( tokens )
+
+    if cfg.scored_text:
+        index_term_freqs( pipe, cfg, doc_id, doc_tokens )
 
     for fld in cfg.facet_flds:
         if fld not in doc:
@@ -91,7 +237,7 @@ def index_document_pipe( pipe: Pipeline, cfg: CollectionConfig, doc: Doc ):
             assert is_scalar(val), f"Found non scalar value ({val}) in field '{fld}' of " \
                                    f"document with id {doc_id}"
 
-            index_facet( pipe, cfg.name, doc_id, fld, val )
+            index_facet( pipe, cfg.name, doc_id, fld, val, ordinal )
 
     for fld in cfg.number_flds:
         if fld not in doc:
@@ -103,4 +249,204 @@ def index_document_pipe( pipe: Pipeline, cfg: CollectionConfig, doc: Doc ):
             assert is_number(val), f"Found non numeric value ({val}) in field '{fld}' of " \
                                    f"document with id {doc_id}"
 
-            index_numeric(pipe, cfg.name, doc_id, fld, val)
+            index_numeric(pipe, cfg.name, doc_id, fld, val, ordinal)
+
+
+def index_documents_bulk_pipe( red: Redis, pipe: Pipeline, cfg: CollectionConfig,
+                               docs: List[Doc] ):
+    """Push a batch of documents into the index coalescing writes per key: the whole
+    batch is tokenized in memory first (with one tokenize_many call) and every key gets
+    a single variadic command.
+    Start / end patterns are only indexed for tokens not in {col}/text_tokens yet, which
+    costs one SMISMEMBER round-trip on red, plus one to assign ordinals with bitmap postings"""
+    ordinals = assign_ordinals( red, cfg, [ x_id( doc, cfg.id_fld ) for doc in docs ] )
+    agg = aggregate_documents( cfg, docs, ordinals )
+    tokens = batch_tokens( agg, cfg )
+    if len(tokens) > 0:
+        index_new_token_pats( agg, cfg, tokens,
+                              red.smismember( f'{cfg.name}/text_tokens', tokens ) )
+
+    agg.flush( pipe )
+
+
+def index_documents_pipe( red: Redis, pipe: Pipeline, cfg: CollectionConfig,
+                          docs: List[Doc] ):
+    """Push a batch of documents into the index one by one, assigning their ordinals
+    first (on red) with bitmap postings"""
+    ordinals = assign_ordinals( red, cfg, [ x_id( doc, cfg.id_fld ) for doc in docs ] )
+    for doc, ordinal in zip( docs, ordinals ):
+        index_document_pipe( pipe, cfg, doc, ordinal=ordinal )
+
+
+def doc_parts( cfg: CollectionConfig, fields: Optional[List[str]] = None
+               ) -> List[Optional[str]]:
+    """Stored parts of documents needed to get fields (all of them if None): None stands
+    for the {col}/docs hash, always first as it tells whether a document exists, the
+    others are the separately stored fields among fields"""
+    if fields is None:
+        return [ None ] + cfg.separate_flds
+    return [ None ] + [ fld for fld in cfg.separate_flds if fld in fields ]
+
+
+def doc_part_key( cfg: CollectionConfig, part: Optional[str] ) -> str:
+    """Key of the hash holding a part of documents, see doc_parts"""
+    return f'{cfg.name}/docs' if part is None else key_doc_field( cfg.name, part )
+
+
+def store_doc( pipe: Pipeline, cfg: CollectionConfig, doc_id: str, doc: Doc,
+               replace: bool = False ):
+    """Queue storing a document with the collection's codec, its separate fields apart.
+    With replace, separate fields of a previous version missing in doc are removed"""
+    main = { fld: val for fld, val in doc.items() if fld not in cfg.separate_flds }
+    for fld in cfg.separate_flds:
+        if fld in doc:
+            pipe.hset( key_doc_field( cfg.name, fld ), doc_id, cfg.codec.encode( doc[fld] ) )
+        elif replace:
+            pipe.hdel( key_doc_field( cfg.name, fld ), doc_id )
+    pipe.hset( f'{cfg.name}/docs', doc_id, cfg.codec.encode( main ) )
+
+
+def unstore_doc( pipe: Pipeline, cfg: CollectionConfig, doc_id: str ):
+    """Queue removing a stored document, the HDEL of the docs hash goes first so its
+    result (whether the document existed) is at the pipeline length before the call"""
+    pipe.hdel( f'{cfg.name}/docs', doc_id )
+    for fld in cfg.separate_flds:
+        pipe.hdel( key_doc_field( cfg.name, fld ), doc_id )
+
+
+def decode_doc( cfg: CollectionConfig, parts: List[Optional[str]],
+                raws: List[Optional[bytes]] ) -> Optional[Doc]:
+    """Document from its stored parts (see doc_parts), None if it doesn't exist"""
+    if raws[0] is None:
+        return None
+
+    doc = {}
+    for part, raw in zip( parts, raws ):
+        if raw is None:
+            continue
+        if part is None:
+            doc.update( cfg.codec.decode( raw ) )
+        else:
+            doc[part] = cfg.codec.decode( raw )
+    return doc
+
+
+def aggregate_documents( cfg: CollectionConfig, docs: List[Doc],
+                         ordinals: List[Optional[int]] ) -> KeyAggregator:
+    """Writes indexing a batch of documents, without start / end patterns, tokenizing all
+    of them with one tokenize_many call"""
+    texts = [ doc[fld] for doc in docs for fld in cfg.text_flds if fld in doc ]
+    all_tokens = iter( cfg.tokenizer.tokenize_many( texts ) )
+
+    agg = KeyAggregator()
+    for doc, ordinal in zip( docs, ordinals ):
+        fld_tokens = { fld: next( all_tokens ) for fld in cfg.text_flds if fld in doc }
+        index_document_pipe( agg, cfg, doc, with_pats=False, fld_tokens=fld_tokens,
+                             ordinal=ordinal )
+
+    return agg
+
+
+def batch_tokens( agg: KeyAggregator, cfg: CollectionConfig ) -> List[str]:
+    """Distinct tokens written by an aggregated batch"""
+    return list( agg.sets.get( f'{cfg.name}/text_tokens', () ) )
+
+
+def index_new_token_pats( agg: KeyAggregator, cfg: CollectionConfig, tokens: List[str],
+                          known: List[bool] ):
+    """Add start / end patterns of those tokens not known to the collection yet"""
+    for tok, is_known in zip( tokens, known ):
+        if not is_known:
+            index_pats( agg, cfg, tok )
+
+
+def key_doc_reverse( col_name: str, kind: str, doc_id: str ) -> str:
+    """Key of reverse set of given kind for a document"""
+    return f'{col_name}/{kind}/{doc_id}'
+
+
+def doc_members( cfg: CollectionConfig, doc: Doc, ordinal: Optional[int] = None
+                 ) -> Tuple[Dict[str, Set[str]], KeyAggregator]:
+    """Members that indexing doc would add to each of its reverse sets, by kind, together
+    with the aggregated writes themselves"""
+    doc_id = x_id( doc, cfg.id_fld )
+    agg = KeyAggregator()
+    index_document_pipe( agg, cfg, doc, with_pats=False, ordinal=ordinal )
+
+    members = { kind: set( agg.sets.get( key_doc_reverse( cfg.name, kind, doc_id ), () ) )
+                for kind in REVERSE_KINDS }
+    return members, agg
+
+
+def stored_doc_members( red: Redis, cfg: CollectionConfig, doc_id: str ) -> Dict[str, Set[str]]:
+    """Current members of the reverse sets of a document, in one round-trip.
+    Documents indexed before token reverse sets existed have their members recomputed
+    from the stored document instead"""
+    with red.pipeline(transaction=False) as pipe:
+        queue_stored_members_reads( pipe, cfg, doc_id )
+        return stored_members_from( cfg, pipe.execute() )
+
+
+def queue_stored_members_reads( pipe: Pipeline, cfg: CollectionConfig, doc_id: str ):
+    """Queue the reads of stored_doc_members: the reverse sets and the stored document"""
+    for kind in REVERSE_KINDS:
+        pipe.smembers( key_doc_reverse( cfg.name, kind, doc_id ) )
+    for part in doc_parts( cfg ):
+        pipe.hget( doc_part_key( cfg, part ), doc_id )
+
+
+def stored_members_from( cfg: CollectionConfig, res: List ) -> Dict[str, Set[str]]:
+    """stored_doc_members from the results of the reads queued by
+    queue_stored_members_reads"""
+    members = { kind: { mem.decode('utf8') for mem in mems }
+                for kind, mems in zip( REVERSE_KINDS, res ) }
+    parts = doc_parts( cfg )
+    stored = res[len(REVERSE_KINDS):]
+    if stored[0] is not None and len( members['doc_toks'] ) == 0:
+        # keep the stored members too, so that old style ones get removed as well
+        # (members don't depend on the ordinal)
+        recomputed, _ = doc_members( cfg, decode_doc( cfg, parts, stored ),
+                                     ordinal=0 if cfg.bitmap else None )
+        for kind in REVERSE_KINDS:
+            members[kind] |= recomputed[kind]
+
+    return members
+
+
+def apply_members_diff( pipe: Pipeline, cfg: CollectionConfig, doc_id: str,
+                        old: Dict[str, Set[str]], new: Dict[str, Set[str]],
+                        ordinal: Optional[int] = None ):
+    """Queue the writes taking a document from the old to the new memberships,
+    touching only those that changed. Numeric scores of the new doc are not written here.
+    ordinal is required for bitmap postings"""
+    num_member = doc_id if ordinal is None else str( ordinal )
+    for kind in REVERSE_KINDS:
+        removed = old[kind] - new[kind]
+        added = new[kind] - old[kind]
+        rev_key = key_doc_reverse( cfg.name, kind, doc_id )
+
+        for suffix in removed:
+            if kind == 'doc_num':
+                pipe.zrem( f'{cfg.name}/docs/{suffix}', num_member )
+            else:
+                remove_posting( pipe, f'{cfg.name}/docs/{suffix}', doc_id, ordinal )
+            if kind == 'doc_toks' and cfg.scored_text:
+                pipe.zrem( key_term_freqs( cfg.name, suffix[2:] ), doc_id )
+        if len(removed) > 0:
+            pipe.srem( rev_key, *removed )
+
+        if kind != 'doc_num':
+            for suffix in added:
+                add_posting( pipe, f'{cfg.name}/docs/{suffix}', doc_id, ordinal )
+        if kind == 'doc_facets':
+            for suffix in added:
+                fld, val = suffix[2:].split( '/v:', 1 )
+                pipe.sadd( key_facet_values( cfg.name, fld ), val )
+        if len(added) > 0:
+            pipe.sadd( rev_key, *added )
+
+    new_tokens = [ suffix[2:] for suffix in new['doc_toks'] - old['doc_toks'] ]
+    if len(new_tokens) > 0:
+        pipe.sadd( f'{cfg.name}/text_tokens', *new_tokens )
+        for tok in new_tokens:
+            index_pats( pipe, cfg, tok )
@@ -0,0 +1,212 @@
+"""Parallel and streaming ingestion of large corpora
+
+Documents are split in batches that a pool of worker processes tokenize and write,
+each worker through its own Redis connection and pipelines, so preparing documents
+is no longer bound to a single core.
+
+Input can be any iterable, including files streamed line by line (index_jsonl,
+index_lines): only a bounded number of batches is ever held in memory.
+"""
+import sys
+import json
+import queue
+import multiprocessing as mp
+from typing import List, Dict, Optional, Callable, NamedTuple, Any, Iterable, Iterator
+
+from redis import Redis, ConnectionPool
+
+import indexing as idx
+import collection as coll
+from common import Doc, CollectionConfig, batches_from_iter, bump_generation
+from collection import Collection
+from log_util import info_log_fun
+from logging import INFO, getLogger
+
+l_info = info_log_fun("ingest", sys.stdout )  # pylint: disable=invalid-name
+getLogger("ingest").setLevel(INFO)
+
+# connection parameters passed on to workers when none are given explicitly
+CONN_KWARGS = ('host', 'port', 'db', 'username', 'password', 'path', 'client_name',
+               'socket_timeout', 'socket_connect_timeout')
+
+
+class BatchResult(NamedTuple):
+    """Outcome of indexing one batch, error is None if it succeeded"""
+    batch_no: int
+    n_docs: int
+    error: Optional[str]
+
+
+# per worker process state, set by _init_worker
+_WORKER: Dict[str, Any] = {}
+
+
+def index_documents_parallel( col: Collection, docs: Iterable[Doc],
+                              n_workers: Optional[int] = None, batch_size: int = 1000,
+                              bulk: bool = True, ordered: bool = False,
+                              progress: Optional[Callable[[BatchResult, int], None]] = None,
+                              conn_kwargs: Optional[Dict] = None,
+                              max_in_flight: Optional[int] = None ) -> List[BatchResult]:
+    """Index documents in batches spread over n_workers processes (default: one per core).
+
+    docs can be any iterable and is consumed lazily: at most max_in_flight batches
+    (default: twice the number of workers) are submitted and not yet reported at any time.
+    A batch that fails is reported in its BatchResult and doesn't stop the others.
+    With ordered=True results (and progress calls) come in batch order, otherwise as
+    batches complete. progress, if given, is called in this process after every batch
+    with its result and the total number of documents done so far.
+    conn_kwargs are the arguments workers use to connect to Redis, taken from col.redis
+    by default"""
+    if conn_kwargs is None:
+        conn_kwargs = worker_conn_kwargs( col.redis )
+    conn_class = col.redis.connection_pool.connection_class
+    n_workers = n_workers or mp.cpu_count()
+    max_in_flight = max_in_flight or 2 * n_workers
+
+    report = _Reporter( ordered, progress )
+    done: queue.Queue = queue.Queue()
+    with mp.Pool( n_workers, initializer=_init_worker,
+                  initargs=(conn_class, conn_kwargs, col.cfg, bulk) ) as pool:
+        for batch_no, batch in enumerate( batches_from_iter( docs, batch_size=batch_size ) ):
+            while report.n_in_flight >= max_in_flight:
+                report.add( done.get() )
+
+            pool.apply_async( _index_batch, ((batch_no, batch),), callback=done.put,
+                              error_callback=lambda exc, no=batch_no: done.put(
+                                  BatchResult( no, 0, f"{type(exc).__name__}: {exc}" ) ) )
+            report.n_in_flight += 1
+
+        while report.n_in_flight > 0:
+            report.add( done.get() )
+
+    col.mark_written()
+    return report.finish()
+
+
+def index_jsonl( col: Collection, path: str, batch_size: int = 1000, n_workers: int = 1,
+                 encoding: str = "utf8", **kwargs ) -> List[BatchResult]:
+    """Index a file with one json document per line, streaming it from disk.
+    Lines that can't be decoded are logged and skipped.
+    With n_workers > 1 batches are indexed in parallel (see index_documents_parallel,
+    which gets the remaining kwargs), otherwise sequentially in this process"""
+    return index_stream( col, _read_jsonl( path, encoding ), batch_size, n_workers, **kwargs )
+
+
+def index_lines( col: Collection, path: str, to_doc: Callable[[int, str], Doc],
+                 batch_size: int = 1000, n_workers: int = 1, encoding: str = "utf8",
+                 **kwargs ) -> List[BatchResult]:
+    """Index a text file turning every line into a document with to_doc(line_num, line),
+    streaming it from disk. Otherwise like index_jsonl"""
+    docs = ( to_doc( i, line ) for i, line in enumerate( _read_lines( path, encoding ) ) )
+    return index_stream( col, docs, batch_size, n_workers, **kwargs )
+
+
+def index_stream( col: Collection, docs: Iterable[Doc], batch_size: int = 1000,
+                  n_workers: int = 1, bulk: bool = True, ordered: bool = True,
+                  progress: Optional[Callable[[BatchResult, int], None]] = None,
+                  **kwargs ) -> List[BatchResult]:
+    """Index documents from an iterable one batch at a time, in this process if
+    n_workers == 1 and with index_documents_parallel otherwise. Either way failed
+    batches are reported without stopping the load"""
+    if n_workers > 1:
+        return index_documents_parallel( col, docs, n_workers, batch_size, bulk, ordered,
+                                         progress, **kwargs )
+
+    report = _Reporter( ordered=True, progress=progress )
+    for batch_no, batch in enumerate( batches_from_iter( docs, batch_size=batch_size ) ):
+        try:
+            coll.index_documents( col, batch, batch_size=len(batch), bulk=bulk )
+            res = BatchResult( batch_no, len(batch), None )
+        except Exception as exc:  # pylint: disable=broad-except
+            res = BatchResult( batch_no, 0, f"{type(exc).__name__}: {exc}" )
+        report.n_in_flight += 1
+        report.add( res )
+
+    return report.finish()
+
+
+class _Reporter:
+    """Collects batch results, calling progress on them in batch order if ordered"""
+    def __init__(self, ordered: bool, progress: Optional[Callable[[BatchResult, int], None]]):
+        self.ordered = ordered
+        self.progress = progress
+        self.n_in_flight = 0
+        self.n_done = 0
+        self.next_no = 0
+        self.waiting: Dict[int, BatchResult] = {}
+        self.results: List[BatchResult] = []
+
+    def add(self, res: BatchResult):
+        """Record a finished batch, it stays in flight until reported"""
+        if not self.ordered:
+            self._report( res )
+            return
+
+        self.waiting[res.batch_no] = res
+        while self.next_no in self.waiting:
+            self._report( self.waiting.pop( self.next_no ) )
+            self.next_no += 1
+
+    def _report(self, res: BatchResult):
+        self.n_in_flight -= 1
+        self.n_done += res.n_docs
+        if res.error is not None:
+            l_info( f"batch {res.batch_no} failed: {res.error}" )
+        if self.progress is not None:
+            self.progress( res, self.n_done )
+        self.results.append( res )
+
+    def finish(self) -> List[BatchResult]:
+        """All results, after logging a summary"""
+        n_failed = sum( 1 for res in self.results if res.error is not None )
+        l_info( f"indexed {self.n_done} docs in {len(self.results)} batches, "
+                f"{n_failed} failed" )
+        return self.results
+
+
+def _read_lines( path: str, encoding: str ) -> Iterator[str]:
+    with open( path, "rt", encoding=encoding ) as f_in:
+        for line in f_in:
+            yield line
+
+
+def _read_jsonl( path: str, encoding: str ) -> Iterator[Doc]:
+    for i, line in enumerate( _read_lines( path, encoding ) ):
+        if line.strip() == "":
+            continue
+        try:
+            yield json.loads( line )
+        except ValueError as exc:
+            l_info( f"{path}:{i + 1}: skipping line that is not valid json: {exc}" )
+
+
+def worker_conn_kwargs( red: Redis ) -> Dict:
+    """Picklable connection arguments for workers to reconnect to the same server"""
+    kwargs = red.connection_pool.connection_kwargs
+    return { key: val for key, val in kwargs.items()
+             if key in CONN_KWARGS or (key.startswith('ssl_') and isinstance( val, (str, bool) )) }
+
+
+def _init_worker( conn_class, conn_kwargs: Dict, cfg: CollectionConfig, bulk: bool ):
+    pool = ConnectionPool( connection_class=conn_class, **conn_kwargs )
+    _WORKER['redis'] = Redis( connection_pool=pool )
+    _WORKER['cfg'] = cfg
+    _WORKER['bulk'] = bulk
+
+
+def _index_batch( numbered_batch ) -> BatchResult:
+    """Index one batch in a worker, in a single pipeline"""
+    batch_no, batch = numbered_batch
+    red, cfg = _WORKER['redis'], _WORKER['cfg']
+    try:
+        with red.pipeline() as pipe:
+            if _WORKER['bulk']:
+                idx.index_documents_bulk_pipe( red, pipe, cfg, batch )
+            else:
+                idx.index_documents_pipe( red, pipe, cfg, batch )
+            bump_generation( pipe, cfg.name )
+            pipe.execute()
+    except Exception as exc:  # pylint: disable=broad-except
+        return BatchResult( batch_no, 0, f"{type(exc).__name__}: {exc}" )
+
+    return BatchResult( batch_no, len(batch), None )
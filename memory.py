@@ -0,0 +1,437 @@
+"""In-process collections, searched without a Redis server
+
+A MemoryCollection keeps the same keys as a Redis collection (with set postings) in
+Python dicts: sets of doc ids, numeric fields as { doc_id: score } plus sorted arrays
+built on first use, and the docs hash. Expr trees are evaluated unchanged by
+MemoryContext, which implements the SearchContext methods with Python set operations,
+so search.run_search, search_page, facet_counts and ranked_search work on it as on any
+collection, with no round-trips at all. Results can be cached in a ResultCache with a
+local LRU, keyed by the generation the collection keeps itself (generation_stamp).
+
+It is filled either by indexing documents or from a snapshot of a Redis collection:
+
+    mcol = MemoryCollection().configure( cfg )
+    mcol.index_documents( docs )
+    mcol = load_snapshot( col )       # copy of Redis collection col
+    ids = run_search( mcol, ContainsToken('rum') )
+"""
+import copy
+import fnmatch
+import math
+import re
+import secrets
+import threading
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, Counter
+from typing import Dict, List, Set, Tuple, Optional, Iterable, Union, Sequence
+
+import indexing as idx
+from collection import Collection, decode_docs, decode_all_docs
+from common import (Doc, DocId, Key, CollectionConfig, key_all_ids, key_doc_len,
+                    key_text_stats, key_ordinal_ids)
+from fuzzy import FuzzyIndex
+from search import SearchContext, ContainsApprox, Expr
+from util import glob_escape
+
+
+class MemoryCollection( Collection ):
+    """Collection held in this process. Writes and searches are serialized by a lock,
+    so it can be shared between threads"""
+    is_local = True
+
+    def __init__(self):
+        super().__init__( None )
+        self.sets: Dict[bytes, Set[bytes]] = defaultdict( set )
+        self.zsets: Dict[bytes, Dict[bytes, float]] = defaultdict( dict )
+        self.hashes: Dict[bytes, Dict[bytes, bytes]] = defaultdict( dict )
+        self.fuzzy = FuzzyIndex()
+        self.gen = 0
+        # tells apart collections with the same name in a shared ResultCache
+        self.epoch = secrets.token_hex( 8 )
+        self.lock = threading.RLock()
+        # (scores, ids) of numeric fields sorted by score, for range lookups
+        self._sorted: Dict[bytes, Tuple[List[float], List[bytes]]] = {}
+
+    def configure(self, cfg: CollectionConfig, version: Optional[int] = None):
+        """set the config, postings are always sets in memory and there are no versions"""
+        cfg = copy.copy( cfg )
+        cfg.postings = 'set'
+        return super().configure( cfg, version=0 )
+
+    def context(self) -> 'MemoryContext':
+        """A fresh context to evaluate expressions in"""
+        return MemoryContext( self )
+
+    def generation_stamp(self) -> str:
+        """Value changing on every write, as common.generation_stamp for Redis collections"""
+        return f"{self.epoch}:{self.gen}"
+
+    def cards(self, keys: List[Key]) -> Dict[Key, int]:
+        """Number of docs in each of the given keys"""
+        return { key: len( self.members( key ) ) for key in keys }
+
+    def members(self, key: Key) -> Set[bytes]:
+        """Doc ids in a set key, empty if there is no such key"""
+        return self.sets.get( _b( key ), set() )
+
+    def scores(self, zkey: Key) -> Dict[bytes, float]:
+        """Scores by doc id of a sorted set key, empty if there is no such key"""
+        return self.zsets.get( _b( zkey ), {} )
+
+    def sorted_scores(self, zkey: Key) -> Tuple[List[float], List[bytes]]:
+        """Scores of a sorted set in increasing order, and the ids with those scores"""
+        zkey = _b( zkey )
+        ret = self._sorted.get( zkey )
+        if ret is None:
+            items = sorted( ( score, doc_id ) for doc_id, score in
+                            self.scores( zkey ).items() )
+            ret = ( [ score for score, _ in items ], [ doc_id for _, doc_id in items ] )
+            self._sorted[zkey] = ret
+        return ret
+
+    def index_document(self, doc: Doc):
+        """index a document, replacing the previous version if there is one"""
+        self.index_documents( [doc] )
+
+    def index_documents(self, docs: Iterable[Doc]):
+        """index documents, replacing previous versions of those already indexed"""
+        docs = list( docs )
+        with self.lock:
+            for doc in docs:
+                self._remove( self.x_id( doc ) )
+            self._apply( idx.aggregate_documents( self.cfg, docs, [ None ] * len(docs) ) )
+
+    def update_document(self, doc: Doc):
+        """index a new version of a document"""
+        self.index_documents( [doc] )
+
+    def delete_document(self, doc_id: str) -> bool:
+        """remove a document from the index, returns whether it existed"""
+        with self.lock:
+            existed = self._remove( str( doc_id ) )
+            self._written()
+        return existed
+
+    def get_docs(self, doc_ids: List, fields: Optional[List[str]] = None) -> List[Doc]:
+        """get documents by id, skipping missing ones"""
+        parts = idx.doc_parts( self.cfg, fields )
+        stored = [ self.hashes.get( _b( idx.doc_part_key( self.cfg, part ) ), {} )
+                   for part in parts ]
+        return decode_docs( self.cfg, parts,
+                            [ [ by_id.get( _b( doc_id ) ) for doc_id in doc_ids ]
+                              for by_id in stored ], fields )
+
+    def get_all_docs(self) -> Dict[DocId, Doc]:
+        """get dict of { doc_id -> Doc }"""
+        parts = idx.doc_parts( self.cfg )
+        return decode_all_docs( self.cfg, parts,
+                                [ self.hashes.get( _b( idx.doc_part_key( self.cfg, part ) ), {} )
+                                  for part in parts ] )
+
+    def _apply(self, agg: idx.KeyAggregator):
+        """Carry out the writes collected while indexing"""
+        for key, members in agg.sets.items():
+            self.sets[_b( key )].update( _b( member ) for member in members )
+        for key, scores in agg.zsets.items():
+            self.zsets[_b( key )].update( ( _b( member ), float( score ) )
+                                          for member, score in scores.items() )
+        for key, fields in agg.hashes.items():
+            self.hashes[_b( key )].update( ( _b( fld ), _b( val ) )
+                                           for fld, val in fields.items() )
+        for (key, fld), amount in agg.counters.items():
+            fields = self.hashes[_b( key )]
+            fields[_b( fld )] = str( int( fields.get( _b( fld ), 0 ) ) + amount ).encode()
+
+        self.fuzzy.add_tokens( idx.batch_tokens( agg, self.cfg ) )
+        self._written()
+
+    def _remove(self, doc_id: str) -> bool:
+        """Remove a document from every key it is in, using its reverse sets"""
+        docs = self.hashes[_b( f"{self.name}/docs" )]
+        if docs.pop( _b( doc_id ), None ) is None:
+            return False
+
+        member = _b( doc_id )
+        for fld in self.cfg.separate_flds:
+            self.hashes[_b( idx.doc_part_key( self.cfg, fld ) )].pop( member, None )
+        prefix = f"{self.name}/docs/"
+        for kind in idx.REVERSE_KINDS:
+            reverse_key = _b( idx.key_doc_reverse( self.name, kind, doc_id ) )
+            for suffix in self.sets.pop( reverse_key, () ):
+                key = _b( prefix ) + suffix
+                if kind == 'doc_num':
+                    self.zsets[key].pop( member, None )
+                    continue
+                self.sets[key].discard( member )
+                if kind == 'doc_toks':
+                    # t:{tok} -> tf:{tok}
+                    self.zsets[_b( prefix ) + b'tf' + suffix[1:]].pop( member, None )
+
+        self.sets[key_all_ids( self.name )].discard( member )
+        length = self.zsets[key_doc_len( self.name )].pop( member, None )
+        if length is not None:
+            stats = self.hashes[key_text_stats( self.name )]
+            stats[b'total_len'] = str( int( stats.get( b'total_len', 0 ) ) -
+                                       int( length ) ).encode()
+        return True
+
+    def _written(self):
+        self.gen += 1
+        self._sorted.clear()
+
+
+def load_snapshot( col: Collection, batch_size: int = 1000 ) -> MemoryCollection:
+    """MemoryCollection with a copy of the current version of a Redis collection. Keys are
+    read with SCAN and pipelined batches, bitmap postings are turned into sets of ids"""
+    red = col.reader()
+    mcol = MemoryCollection().configure( col.base_cfg )
+    ord_ids = red.hgetall( key_ordinal_ids( col.name ) ) if col.cfg.bitmap else {}
+    postings = re.compile( r'docs/[tf]:|all_ids$' )
+    numeric = re.compile( r'docs/n:' )
+    skip = re.compile( r'v\d+/|current$|last_version$|cache/|[se]_pat/|ord$|ord_ids$|'
+                       r'last_ord$|gen$' )
+
+    prefix = col.name + '/'
+    keys = [ key for key in red.scan_iter( match=glob_escape( prefix ) + '*', count=batch_size )
+             if skip.match( key.decode( 'utf8', 'replace' )[len(prefix):] ) is None ]
+
+    for i in range( 0, len(keys), batch_size ):
+        batch = keys[i:i + batch_size]
+        with red.pipeline( transaction=False ) as pipe:
+            for key in batch:
+                pipe.type( key )
+            types = pipe.execute()
+
+            readers = { b'set': pipe.smembers, b'hash': pipe.hgetall, b'string': pipe.get,
+                        b'zset': lambda key: pipe.zrange( key, 0, -1, withscores=True ) }
+            for key, typ in zip( batch, types ):
+                # keys deleted since the SCAN are just checked for existence
+                readers.get( typ, pipe.exists )( key )
+            values = pipe.execute()
+
+        for key, typ, value in zip( batch, types, values ):
+            suffix = key.decode( 'utf8' )[len(prefix):]
+            mkey = _b( mcol.name + '/' + suffix )
+            if typ == b'set':
+                mcol.sets[mkey] = set( value )
+            elif typ == b'hash':
+                mcol.hashes[mkey] = dict( value )
+            elif typ == b'zset':
+                bitmap_num = col.cfg.bitmap and numeric.match( suffix )
+                mcol.zsets[mkey] = { ( ord_ids[member] if bitmap_num else member ): score
+                                     for member, score in value
+                                     if not bitmap_num or member in ord_ids }
+            elif typ == b'string' and postings.match( suffix ):
+                mcol.sets[mkey] = { ord_ids[ordinal] for ordinal in bitmap_ordinals( value )
+                                    if ordinal in ord_ids }
+
+    mcol.fuzzy.add_tokens( tok.decode( 'utf8' ) for tok in
+                           mcol.sets.get( _b( f"{mcol.name}/text_tokens" ), () ) )
+    return mcol
+
+
+def bitmap_ordinals( bitmap: bytes ) -> List[bytes]:
+    """Offsets of the bits set in a bitmap, as Redis hash fields (ascii digits)"""
+    ret = []
+    for i, byte in enumerate( bitmap ):
+        if byte == 0:
+            continue
+        for j in range( 8 ):
+            if byte & ( 0x80 >> j ):
+                ret.append( str( i * 8 + j ).encode() )
+    return ret
+
+
+class MemoryContext( SearchContext ):
+    """SearchContext evaluating expressions on a MemoryCollection. Keys are the same as
+    in Redis, temporary results are kept in dicts for the duration of the search.
+
+    The scripts expressions and searches run (approx_match, num_range, facet_counts, bm25)
+    have Python versions here, others raise ValueError"""
+
+    def __init__(self, col: MemoryCollection):
+        super().__init__( col, None )
+        self.tmp: Dict[Key, Set[bytes]] = {}
+        self.tmp_scores: Dict[Key, Dict[bytes, float]] = {}
+
+    def __enter__(self):
+        self.col.lock.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+        self.col.lock.release()
+
+    def is_pipelined(self) -> bool:
+        return False
+
+    def members(self, key: Key) -> Set[bytes]:
+        """Doc ids in a key, temporary or of the collection"""
+        ret = self.tmp.get( key )
+        return self.col.members( key ) if ret is None else ret
+
+    def _put(self, ids: Set[bytes]) -> Key:
+        key = self.gen_key()
+        self.tmp[key] = ids
+        return key
+
+    def inter(self, keys: List[Key]) -> Key:
+        sets = sorted( ( self.members( key ) for key in keys ), key=len )
+        return self._put( set( sets[0] ).intersection( *sets[1:] ) )
+
+    def union(self, keys: List[Key]) -> Key:
+        return self._put( set().union( *( self.members( key ) for key in keys ) ) )
+
+    def diff(self, key: Key, exclude: List[Key]) -> Key:
+        return self._put( set( self.members( key ) ).difference(
+            *( self.members( key ) for key in exclude ) ) )
+
+    def num_range(self, zkey: Key, min_: str, max_: str, within: Optional[Key] = None) -> Key:
+        """Ids with scores in [min_, max_] (ZRANGEBYSCORE syntax), looked up by bisection
+        in the sorted scores, or by checking the scores of the ids in within if fewer"""
+        low, low_excl = _bound( min_ )
+        high, high_excl = _bound( max_ )
+        scores, ids = self.col.sorted_scores( zkey )
+        start = ( bisect_right if low_excl else bisect_left )( scores, low )
+        end = ( bisect_left if high_excl else bisect_right )( scores, high )
+
+        if within is None:
+            return self._put( set( ids[start:end] ) )
+
+        candidates = self.members( within )
+        if len(candidates) < end - start:
+            zset = self.col.scores( zkey )
+            return self._put( { doc_id for doc_id in candidates
+                                if doc_id in zset and
+                                _in_range( zset[doc_id], low, low_excl, high, high_excl ) } )
+        return self._put( candidates.intersection( ids[start:end] ) )
+
+    def scored(self, key: Key, zkey: Key) -> Key:
+        zset = self.col.scores( zkey )
+        dst = self.gen_key()
+        self.tmp_scores[dst] = { doc_id: zset[doc_id] for doc_id in self.members( key )
+                                 if doc_id in zset }
+        return dst
+
+    def script_store(self, name: str, keys: List[Key], args: List) -> Key:
+        if name == 'approx_match':
+            tokens = _match_tokens( self.col, args[1:] )
+            return self.union( [ f"{self.col.name}/docs/t:{tok}" for tok in tokens ] )
+        if name == 'num_range':
+            return self.num_range( keys[0], args[0], args[1], keys[1] if len(keys) > 1 else None )
+        raise ValueError( f"Script {name} has no in-process version" )
+
+    def approx_tokens(self, expr: ContainsApprox) -> List[str]:
+        if expr.engine != 'symspell':
+            return _match_tokens( self.col, expr.patterns )
+        if expr.max_typos > self.col.fuzzy.max_dist:
+            index = FuzzyIndex( max_dist=expr.max_typos )
+            index.add_tokens( self.col.fuzzy.tokens )
+            self.col.fuzzy = index
+        return self.col.fuzzy.lookup( expr.fuzzy_word( self.col.cfg ), expr.max_typos )
+
+    def run(self, expr: Expr) -> Set[Key]:
+        return set( self.members( self.eval( expr ) ) )
+
+    def run_many(self, exprs: List[Expr]) -> List[Set[Key]]:
+        return [ set( self.members( self.eval( expr ) ) ) for expr in exprs ]
+
+    def run_page(self, expr: Expr, offset: int = 0, limit: Optional[int] = None,
+                 sort_zkey: Optional[Key] = None, desc: bool = False,
+                 with_scores: bool = False) -> Tuple[int, List[Key]]:
+        key = self.eval( expr )
+        ids = self.members( key )
+        end = None if limit is None else offset + limit
+        if limit == 0:
+            return len(ids), []
+        if sort_zkey is None:
+            return len(ids), sorted( ids )[offset:end]
+
+        scored = self.tmp_scores[self.scored( key, sort_zkey )]
+        items = sorted( ( ( score, doc_id ) for doc_id, score in scored.items() ),
+                        reverse=desc )[offset:end]
+        if with_scores:
+            return len(ids), [ ( doc_id, score ) for score, doc_id in items ]
+        return len(ids), [ doc_id for _, doc_id in items ]
+
+    def run_script(self, expr: Expr, name: str, args: List, keys: Sequence[Key] = ()):
+        ids = self.members( self.eval( expr ) )
+        if name == 'facet_counts':
+            return _facet_counts( self.col, ids, int( args[1] ), args[2:] )
+        if name == 'bm25':
+            return _bm25( self.col, ids, int( args[1] ), float( args[2] ), float( args[3] ),
+                          args[4:] )
+        raise ValueError( f"Script {name} has no in-process version" )
+
+    def cleanup(self):
+        self.tmp.clear()
+        self.tmp_scores.clear()
+        self.n_deleted = len(self.tmp_keys)
+
+
+def _facet_counts( col: MemoryCollection, ids: Set[bytes], top_n: int,
+                   fields: List[str] ) -> List[List]:
+    """Same result as the facet_counts script"""
+    ret = []
+    for fld in fields:
+        counts = Counter()
+        for val in col.sets.get( _b( f"{col.name}/facet_vals/{fld}" ), () ):
+            val = val.decode( 'utf8' )
+            n_docs = len( ids & col.members( f"{col.name}/docs/f:{fld}/v:{val}" ) )
+            if n_docs > 0:
+                counts[val] = n_docs
+        items = sorted( counts.items(), key=lambda item: (-item[1], item[0]) )
+        items = items if top_n < 0 else items[:top_n]
+        ret.append( [ x for val, n_docs in items for x in ( val.encode( 'utf8' ), n_docs ) ] )
+    return ret
+
+
+def _bm25( col: MemoryCollection, ids: Set[bytes], top_k: int, k1: float, b: float,
+           tokens: List[str] ) -> List:
+    """Same result as the bm25 script"""
+    doc_len = col.scores( key_doc_len( col.name ) )
+    n_docs = len(doc_len)
+    if n_docs == 0:
+        return []
+    total_len = int( col.hashes.get( key_text_stats( col.name ), {} ).get( b'total_len', 0 ) )
+    avg_len = total_len / n_docs if total_len > 0 else 1
+
+    scores = defaultdict( float )
+    for tok in tokens:
+        postings = col.scores( f"{col.name}/docs/tf:{tok}" )
+        n_tok = len(postings)
+        if n_tok == 0:
+            continue
+        idf = math.log( 1 + ( n_docs - n_tok + 0.5 ) / ( n_tok + 0.5 ) )
+        for doc_id in ( ids & postings.keys() ):
+            tf = postings[doc_id]
+            norm = tf + k1 * ( 1 - b + b * doc_len.get( doc_id, avg_len ) / avg_len )
+            scores[doc_id] += idf * tf * ( k1 + 1 ) / norm
+
+    items = sorted( scores.items(), key=lambda item: (-item[1], item[0]) )[:top_k]
+    return [ x for doc_id, score in items for x in ( doc_id, repr( score ) ) ]
+
+
+def _match_tokens( col: MemoryCollection, patterns: Iterable[str] ) -> List[str]:
+    """Tokens of the collection matching any of the glob patterns"""
+    return sorted( { tok for tok in col.fuzzy.tokens
+                     if any( fnmatch.fnmatchcase( tok, pat ) for pat in patterns ) } )
+
+
+def _bound( bound: str ) -> Tuple[float, bool]:
+    """Value and exclusiveness of a ZRANGEBYSCORE bound"""
+    if bound.startswith( '(' ):
+        return float( bound[1:] ), True
+    return float( bound ), False
+
+
+def _in_range( score: float, low: float, low_excl: bool, high: float, high_excl: bool ) -> bool:
+    return ( score > low if low_excl else score >= low ) and \
+           ( score < high if high_excl else score <= high )
+
+
+def _b( val: Union[str, bytes, int, float] ) -> bytes:
+    """Keys and members as bytes, as read from Redis"""
+    if isinstance( val, bytes ):
+        return val
+    return str( val ).encode( 'utf8' )
@@ -1,12 +1,21 @@
 """Parse search expressions"""
 
+import threading
+from functools import lru_cache
+from typing import List, Optional, Set
+
+from arpeggio import PTNodeVisitor, visit_parse_tree
 from arpeggio.cleanpeg import ParserPEG
 
+import search as sch
+from common import CollectionConfig, Key, f
+from collection import Collection
+
 # Non standard precedence!
 # OR binds more tightly than AND!
 # ( x AND y OR z AND a OR b ) -> ( x AND (y OR z) AND (a OR b) )
 
-peg_grammar = """
+peg_grammar = r"""
 lit_number = r'\d+(\.\d*)?|\d+'
 lit_str = r'[A-Za-z0-9-]+' / r'"[A-Za-z0-9 ]*"'
 lit_bool = 'true' / 'false'
@@ -21,15 +30,151 @@ num_filter_expr =  fld_name cmp_operator lit_number
 tag_expr = lit_str
 filter_expr = match_expr / num_filter_expr / tag_expr
 
-filter_clause = ('NOT' filter_expr) / filter_expr / '(' expr ')'
+filter_clause = (r'NOT\b' filter_clause) / filter_expr / '(' expr ')'
 
-term = filter_clause ("OR" filter_clause)*
-expr = term ("AND" term)*
+term = filter_clause (r'OR\b' filter_clause)*
+expr = term (r'AND\b' term)*
 
 search_expr = expr EOF
 """
 # %%
 
+# max number of distinct (config, query string) pairs whose compiled expression is kept
+QUERY_CACHE_SIZE = 4096
+
+_PARSER: Optional[ParserPEG] = None
+_PARSER_LOCK = threading.Lock()
+
+
+def parse( query: str ):
+    """Parse tree for a query string. The parser is built once per process"""
+    global _PARSER  # pylint: disable=global-statement
+    with _PARSER_LOCK:
+        if _PARSER is None:
+            _PARSER = ParserPEG(peg_grammar, root_rule_name='search_expr')
+        return _PARSER.parse( query )
+
+
+class ExprBuilder( PTNodeVisitor ):
+    """Turns a parse tree into a search.Expr for a given collection config.
+
+    fld:val becomes a FacetEq for facet fields, an equality NumCmp for numeric fields and
+    a token search for text fields, fld:x TO y a NumRange and fld < x a NumCmp.
+    Bare words and quoted strings are token searches. Terms that consist only of stop
+    words are dropped"""
+    def __init__(self, cfg: CollectionConfig):
+        super().__init__()
+        self.cfg = cfg
+
+    def tokens_expr(self, text: str ) -> Optional[sch.Expr]:
+        """Expression matching documents containing all tokens in text"""
+        tokens = self.cfg.tokenizer.tokenize( text )
+        if len(tokens) == 0:
+            return None
+        elif len(tokens) == 1:
+            return sch.ContainsToken( tokens[0] )
+        else:
+            return sch.ContainsTokens( tokens )
+
+    def visit_lit_number(self, node, children):
+        return node.value
+
+    def visit_lit_str(self, node, children):
+        return node.flat_str().strip('"')
+
+    def visit_lit_val(self, node, children):
+        return children[0]
+
+    def visit_fld_name(self, node, children):
+        return node.value
+
+    def visit_cmp_operator(self, node, children):
+        return node.flat_str()
+
+    def visit_range(self, node, children):
+        return ( children[0], children[1] )
+
+    def visit_match_expr(self, node, children):
+        fld, val = children[0], children[1]
+        if fld in self.cfg.number_flds:
+            if isinstance( val, tuple ):
+                return sch.NumRange( f(fld), _number( val[0] ), _number( val[1] ) )
+            return sch.NumCmp( f(fld), '=', _number( val ) )
+        elif isinstance( val, tuple ):
+            raise ValueError( f"Range on field '{fld}' which is not a numeric field" )
+        elif fld in self.cfg.facet_flds:
+            return sch.FacetEq( f(fld), val )
+        elif fld in self.cfg.text_flds:
+            return self.tokens_expr( val )
+        else:
+            raise ValueError( f"Field '{fld}' is neither a facet nor a text field "
+                              f"of collection {self.cfg.name}" )
+
+    def visit_num_filter_expr(self, node, children):
+        fld, op, val = children
+        if fld not in self.cfg.number_flds:
+            raise ValueError( f"Comparison on field '{fld}' which is not a numeric field" )
+        return sch.NumCmp( f(fld), op, _number( val ) )
+
+    def visit_tag_expr(self, node, children):
+        return self.tokens_expr( children[0] )
+
+    def visit_filter_expr(self, node, children):
+        return children[0] if len(children) > 0 else None
+
+    def visit_filter_clause(self, node, children):
+        if node[0].flat_str() == 'NOT' and len(children) == 2:
+            # negating a clause that has no searchable terms drops the clause
+            return None if children[1] is None else sch.Not( children[1] )
+        return children[0] if len(children) > 0 else None
+
+    def visit_term(self, node, children):
+        return _combine( sch.Or, children )
+
+    def visit_expr(self, node, children):
+        return _combine( sch.And, children )
+
+    def visit_search_expr(self, node, children):
+        if len(children) == 0 or not isinstance( children[0], sch.Expr ):
+            raise ValueError( "Query has no searchable terms" )
+        return children[0]
+
+
+def _number( text: str ) -> float:
+    """Numeric literal from query, as int if it has no decimals"""
+    return float( text ) if '.' in text else int( text )
+
+
+def _combine( typ: type, children: List ) -> Optional[sch.Expr]:
+    """Single expression from children that are expressions (keywords are skipped)"""
+    exprs = [ child for child in children if isinstance( child, sch.Expr ) ]
+    if len(exprs) == 0:
+        return None
+    elif len(exprs) == 1:
+        return exprs[0]
+    else:
+        return typ( exprs )
+
+
+@lru_cache(maxsize=QUERY_CACHE_SIZE)
+def compile_query( cfg: CollectionConfig, query: str ) -> sch.Expr:
+    """Expression for a query string, already flattened. Results are kept in a bounded
+    LRU so repeated queries skip parsing altogether. Returned expressions are shared
+    and must not be modified"""
+    return visit_parse_tree( parse( query ), ExprBuilder( cfg ) ).flatten()
+
+
+def search_string( col: Collection, query: str, **kwargs ) -> Set[Key]:
+    """Run a search given as a query string, e.g.
+    'price < 10 AND (category:Book OR NOT category:Ebook)'
+    kwargs are passed on to search.run_search"""
+    return sch.run_search( col, compile_query( col.cfg, query ), **kwargs )
+
+
+def search_string_page( col: Collection, query: str, **kwargs ) -> sch.SearchPage:
+    """Like search_string, returning a page of results, see search.search_page for kwargs"""
+    return sch.search_page( col, compile_query( col.cfg, query ), **kwargs )
+
 
 def interactive_testing():
     # %%
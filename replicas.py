@@ -0,0 +1,60 @@
+"""Routing of read-only requests to read replicas
+
+Searches write their temporary keys on the connection they run on, so replicas used for
+searching must accept writes: configure them with `replica-read-only no`. Keys written on a
+replica stay local to it and expire there like on the primary.
+"""
+import itertools
+import threading
+import time
+from typing import Dict, List, Optional, Any
+
+READ_POLICIES = ('round_robin', 'least_latency')
+
+# weight of the latest observation in the moving average of a replica's latency
+LATENCY_ALPHA = 0.2
+
+# with least_latency, a replica not used for this many seconds is picked again so that
+# its latency estimate doesn't go stale
+LATENCY_REFRESH_SECS = 5.0
+
+
+class ReadRouter:
+    """Picks the replica each read goes to, round-robin or the one with least latency.
+    Latencies are moving averages of the durations reported with observe().
+    Connections can be sync or asyncio clients, the router makes no requests itself"""
+
+    def __init__(self, replicas: List[Any], policy: str = 'round_robin'):
+        if policy not in READ_POLICIES:
+            raise ValueError( f"read policy must be one of {READ_POLICIES}, got {policy!r}" )
+        self.replicas = list( replicas )
+        self.policy = policy
+        self.latency: Dict[int, float] = { i: 0.0 for i in range( len(self.replicas) ) }
+        self.used_at: Dict[int, float] = { i: 0.0 for i in range( len(self.replicas) ) }
+        self._turn = itertools.count()
+        self.lock = threading.Lock()
+
+    def pick(self) -> Optional[Any]:
+        """Replica for the next read, None if there are no replicas"""
+        if len(self.replicas) == 0:
+            return None
+        if self.policy == 'round_robin':
+            return self.replicas[ next( self._turn ) % len(self.replicas) ]
+
+        now = time.monotonic()
+        with self.lock:
+            stale = [ i for i, used_at in self.used_at.items()
+                      if now - used_at >= LATENCY_REFRESH_SECS ]
+            best = stale[0] if len(stale) > 0 else min( self.latency, key=self.latency.get )
+            self.used_at[best] = now
+        return self.replicas[best]
+
+    def observe(self, replica: Any, secs: float):
+        """Record how long a read on replica took"""
+        for i, red in enumerate( self.replicas ):
+            if red is replica:
+                with self.lock:
+                    prev = self.latency[i]
+                    self.latency[i] = secs if prev == 0.0 else \
+                        ( 1 - LATENCY_ALPHA ) * prev + LATENCY_ALPHA * secs
+                return
@@ -0,0 +1,119 @@
+"""Opt-in cache of search results
+
+Entries are keyed by the canonical form of the (flattened) search expression, so
+And/Or's with the same children in a different order share an entry. Every entry
+records the collection generation (see common.generation_stamp) current when it was
+computed, and is only served while that generation is still current, i.e. until
+documents are written to the collection again or it is cleared.
+
+Collections held in this process (memory.MemoryCollection) keep their generation
+themselves and can only be cached in the local LRU.
+"""
+import json
+import hashlib
+from collections import OrderedDict
+from typing import Optional, Set, Dict, Tuple, Callable
+
+from common import Key, key_generation, key_epoch, key_result_cache, generation_stamp
+
+
+class ResultCache:
+    """Cache of search results kept in a local LRU, in Redis keys with a TTL, or both"""
+
+    def __init__(self, max_entries: int = 1024, redis_ttl: Optional[int] = None,
+                 local: bool = True):
+        """max_entries: size of the local LRU
+        redis_ttl: if given, results are also stored in Redis for this many seconds and can
+           be shared with other processes
+        local: whether to keep the local LRU at all"""
+        assert local or redis_ttl is not None, "cache needs to be either local or in redis"
+        self.max_entries = max_entries
+        self.redis_ttl = redis_ttl
+        self.local: Optional[OrderedDict] = OrderedDict() if local else None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def stats(self) -> Dict[str, int]:
+        """Hit/miss/eviction counters, evictions only count the local LRU"""
+        return { "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                 "local_entries": len(self.local) if self.local is not None else 0 }
+
+    def get_or_compute(self, col, expr, compute: Callable[[], Set[Key]]) -> Set[Key]:
+        """Return cached results for expr or compute them and store them in the cache"""
+        canon = expr.flatten().canonical()
+        gen, ret = self.lookup( col, canon )
+        if ret is not None:
+            self.hits += 1
+            return set( ret )
+
+        self.misses += 1
+        ret = compute()
+        self.store( col, canon, gen, ret )
+        return ret
+
+    def lookup(self, col, canon: str) -> Tuple[str, Optional[frozenset]]:
+        """Current generation of the collection and cached results if still valid.
+        A single round-trip, also when entries are kept in Redis"""
+        if col.is_local:
+            if self.local is None:
+                raise ValueError( f"{col.name} is held in this process, it can only be "
+                                  "cached in a local LRU" )
+            res = [ None ]
+            gen = col.generation_stamp()
+        else:
+            with col.reader().pipeline(transaction=False) as pipe:
+                pipe.get( key_generation( col.name ) )
+                pipe.get( key_epoch( col.name ) )
+                if self.redis_ttl is not None:
+                    pipe.get( key_result_cache( col.name, digest( canon ) ) )
+                res = pipe.execute()
+            gen = generation_stamp( res[0], res[1] )
+
+        if self.local is not None:
+            entry = self.local.get( (col.name, canon) )
+            if entry is not None:
+                if entry[0] == gen:
+                    self.local.move_to_end( (col.name, canon) )
+                    return gen, entry[1]
+                del self.local[(col.name, canon)]
+
+        if self.redis_ttl is not None and not col.is_local and res[2] is not None:
+            entry = json.loads( res[2] )
+            if entry["gen"] == gen:
+                ret = frozenset( id_.encode("utf8") for id_ in entry["ids"] )
+                self._store_local( col, canon, gen, ret )
+                return gen, ret
+
+        return gen, None
+
+    def store(self, col, canon: str, gen: str, result: Set[Key]):
+        """Store results computed when collection was at generation gen"""
+        ret = frozenset( result )
+        self._store_local( col, canon, gen, ret )
+
+        if self.redis_ttl is not None and not col.is_local:
+            entry = { "gen": gen, "ids": [ id_.decode("utf8") for id_ in ret ] }
+            col.redis.set( key_result_cache( col.name, digest( canon ) ), json.dumps(entry),
+                           ex=self.redis_ttl )
+
+    def _store_local(self, col, canon: str, gen: str, result: frozenset):
+        if self.local is None:
+            return
+
+        self.local[(col.name, canon)] = (gen, result)
+        self.local.move_to_end( (col.name, canon) )
+        while len(self.local) > self.max_entries:
+            self.local.popitem( last=False )
+            self.evictions += 1
+
+    def clear(self):
+        """Drop all local entries, entries in Redis expire on their own"""
+        if self.local is not None:
+            self.local.clear()
+
+
+def digest( canon: str ) -> str:
+    """Short fixed length digest of a canonical expression, used in Redis key names"""
+    return hashlib.sha1( canon.encode("utf8") ).hexdigest()
@@ -0,0 +1,457 @@
+"""Registry of server side Lua scripts
+
+Scripts are sent to the server once with SCRIPT LOAD and afterwards called by their
+sha1 with EVALSHA. If the server answers NOSCRIPT (e.g. after a restart or SCRIPT FLUSH)
+the script is loaded again and the call retried.
+
+Scripts that store their result take the destination key as KEYS[1] and its expiry
+in seconds as ARGV[1].
+
+Scripts registered as single instance only build some key names from the collection name
+in ARGV instead of getting them in KEYS, because which keys they touch depends on what
+they read. That is fine on a standalone server (and on each server of a
+sharding.ShardedCollection, as every shard is one) but not on Redis Cluster, which
+routes and checks scripts by their KEYS.
+"""
+import hashlib
+import threading
+from typing import Dict, List, Set, Union, Optional
+
+from redis import Redis
+from redis.client import Pipeline
+from redis.asyncio import Redis as AsyncRedis
+from redis.asyncio.client import Pipeline as AsyncPipeline
+from redis.exceptions import NoScriptError
+
+# Stores the ids of sorted set KEYS[2] with scores within [ARGV[2], ARGV[3]] (ZRANGEBYSCORE
+# syntax) into set KEYS[1]. If KEYS[3] is given only ids that are also members of that set
+# are kept, iterating over whichever side is smaller.
+# With ARGV[4] == 'bits' ids are ordinals, KEYS[1] is stored as a bitmap and KEYS[3] is one
+NUM_RANGE = """
+local dst, zkey = KEYS[1], KEYS[2]
+local min, max = ARGV[2], ARGV[3]
+local bits = ARGV[4] == 'bits'
+
+local bound = function( s )
+    local excl = string.sub( s, 1, 1 ) == '('
+    if excl then s = string.sub( s, 2 ) end
+    if s == '-inf' then return -math.huge, excl end
+    if s == '+inf' or s == 'inf' then return math.huge, excl end
+    return tonumber( s ), excl
+end
+
+local add = function( ids )
+    if bits then
+        for _, id in ipairs( ids ) do redis.call( 'SETBIT', dst, id, 1 ) end
+        return
+    end
+    for i = 1, #ids, 5000 do
+        redis.call( 'SADD', dst, unpack( ids, i, math.min( i + 4999, #ids ) ) )
+    end
+end
+
+redis.call( 'DEL', dst )
+local ids
+if #KEYS == 3 and not bits and
+   redis.call( 'SCARD', KEYS[3] ) < redis.call( 'ZCOUNT', zkey, min, max ) then
+    local lo, lo_excl = bound( min )
+    local hi, hi_excl = bound( max )
+    ids = {}
+    for _, id in ipairs( redis.call( 'SMEMBERS', KEYS[3] ) ) do
+        local score = redis.call( 'ZSCORE', zkey, id )
+        if score then
+            score = tonumber( score )
+            if ( score > lo or ( score == lo and not lo_excl ) ) and
+               ( score < hi or ( score == hi and not hi_excl ) ) then
+                table.insert( ids, id )
+            end
+        end
+    end
+else
+    ids = redis.call( 'ZRANGEBYSCORE', zkey, min, max )
+    if #KEYS == 3 then
+        local kept = {}
+        for _, id in ipairs( ids ) do
+            local member
+            if bits then
+                member = redis.call( 'GETBIT', KEYS[3], id )
+            else
+                member = redis.call( 'SISMEMBER', KEYS[3], id )
+            end
+            if member == 1 then table.insert( kept, id ) end
+        end
+        ids = kept
+    end
+end
+
+add( ids )
+redis.call( 'EXPIRE', dst, ARGV[1] )
+return #ids
+"""
+
+# Tokens of collection ARGV[2] matching any of the glob patterns ARGV[3..], picking for
+# each pattern the most selective s_pat / e_pat bucket the same way
+# search.ContainsApprox.scan_tokens does (falling back to text_tokens). Matches are
+# de-duplicated. If KEYS[1] is given, the union of the docs/t:{tok} sets of all matching
+# tokens is stored there and the number of tokens is returned, otherwise the tokens.
+# Single instance only, see the module docstring
+APPROX_MATCH = """
+local col = ARGV[2]
+local s_pref = col .. '/s_pat/'
+local e_pref = col .. '/e_pat/'
+
+local bucket = function( pat )
+    local c = function( i ) return string.sub( pat, i, i ) end
+    local n = #pat
+    if n < 3 then return col .. '/text_tokens' end
+    if c(1) ~= '?' and c(2) ~= '?' then return s_pref .. c(1) .. c(2) end
+    if c(1) ~= '?' and c(3) ~= '?' then return s_pref .. c(1) .. '?' .. c(3) end
+    if c(2) ~= '?' and c(3) ~= '?' then return s_pref .. '?' .. c(2) .. c(3) end
+    if c(n) ~= '?' and c(n-1) ~= '?' then return e_pref .. c(n-1) .. c(n) end
+    if c(n) ~= '?' and c(n-2) ~= '?' then return e_pref .. c(n-2) .. '?' .. c(n) end
+    if c(n-1) ~= '?' and c(n-2) ~= '?' then return e_pref .. c(n-2) .. c(n-1) .. '?' end
+    return col .. '/text_tokens'
+end
+
+local seen = {}
+local tokens = {}
+for i = 3, #ARGV do
+    local pat = ARGV[i]
+    local key = bucket( pat )
+    local cur = '0'
+    repeat
+        local r = redis.call( 'SSCAN', key, cur, 'MATCH', pat, 'COUNT', 10000 )
+        cur = r[1]
+        for _, tok in ipairs( r[2] ) do
+            if not seen[tok] then
+                seen[tok] = true
+                table.insert( tokens, tok )
+            end
+        end
+    until cur == '0'
+end
+
+if #KEYS == 0 then
+    return tokens
+end
+
+local dst = KEYS[1]
+redis.call( 'DEL', dst )
+for i = 1, #tokens, 1000 do
+    local keys = {}
+    for j = i, math.min( i + 999, #tokens ) do
+        table.insert( keys, col .. '/docs/t:' .. tokens[j] )
+    end
+    if i > 1 then table.insert( keys, dst ) end
+    redis.call( 'SUNIONSTORE', dst, unpack( keys ) )
+end
+redis.call( 'EXPIRE', dst, ARGV[1] )
+return #tokens
+"""
+
+# Per field top ARGV[2] values (all if < 0) of table counts[fld][val] as flat lists of
+# values and counts, for each field in list fields. Shared by the facet count scripts
+FACET_TOP_N = """
+local ret = {}
+for _, fld in ipairs( fields ) do
+    local items = {}
+    for val, n in pairs( counts[fld] ) do table.insert( items, { val, n } ) end
+    table.sort( items, function( a, b )
+        if a[2] ~= b[2] then return a[2] > b[2] end
+        return a[1] < b[1]
+    end )
+    local flat = {}
+    local n_top = #items
+    if top_n >= 0 then n_top = math.min( top_n, n_top ) end
+    for i = 1, n_top do
+        table.insert( flat, items[i][1] )
+        table.insert( flat, items[i][2] )
+    end
+    table.insert( ret, flat )
+end
+return ret
+"""
+
+# Counts of the values of facet fields ARGV[3..] of collection ARGV[1] among the ids in set
+# KEYS[1] (all docs if no key is given). For each field returns a flat list of the ARGV[2]
+# most frequent values and their counts (all values if ARGV[2] < 0), zero counts left out.
+# Small results are counted by going through the doc_facets set of each id, large ones
+# by intersecting with each value's set, whichever touches fewer members. The
+# intersections are counted with SINTERCARD on Redis >= 7.0 and with SINTER on older
+# servers. Single instance only, see the module docstring
+FACET_COUNTS = """
+local col, top_n = ARGV[1], tonumber( ARGV[2] )
+local res_key = KEYS[1]
+
+local has_sintercard = true
+local inter_card = function( key1, key2 )
+    if has_sintercard then
+        local n = redis.pcall( 'SINTERCARD', 2, key1, key2 )
+        if type( n ) == 'number' then return n end
+        has_sintercard = false
+    end
+    return #redis.call( 'SINTER', key1, key2 )
+end
+
+local fields, counts, vals = {}, {}, {}
+local n_vals = 0
+for i = 3, #ARGV do
+    local fld = ARGV[i]
+    table.insert( fields, fld )
+    counts[fld] = {}
+    vals[fld] = redis.call( 'SMEMBERS', col .. '/facet_vals/' .. fld )
+    n_vals = n_vals + #vals[fld]
+end
+
+if res_key and redis.call( 'SCARD', res_key ) < n_vals then
+    for _, id in ipairs( redis.call( 'SMEMBERS', res_key ) ) do
+        for _, mem in ipairs( redis.call( 'SMEMBERS', col .. '/doc_facets/' .. id ) ) do
+            local fld, val = string.match( mem, '^f:(.-)/v:(.*)$' )
+            if fld and counts[fld] then
+                counts[fld][val] = ( counts[fld][val] or 0 ) + 1
+            end
+        end
+    end
+else
+    for _, fld in ipairs( fields ) do
+        local prefix = col .. '/docs/f:' .. fld .. '/v:'
+        for _, val in ipairs( vals[fld] ) do
+            local n
+            if res_key then
+                n = inter_card( res_key, prefix .. val )
+            else
+                n = redis.call( 'SCARD', prefix .. val )
+            end
+            if n > 0 then counts[fld][val] = n end
+        end
+    end
+end
+
+""" + FACET_TOP_N
+
+# Same as FACET_COUNTS for bitmap postings: BITCOUNT of the AND of result bitmap KEYS[1]
+# with each value's bitmap, done in scratch key KEYS[1]:fc. Single instance only
+FACET_COUNTS_BITS = """
+local col, top_n = ARGV[1], tonumber( ARGV[2] )
+local res_key = KEYS[1]
+local scratch = res_key and res_key .. ':fc'
+
+local fields, counts = {}, {}
+for i = 3, #ARGV do
+    local fld = ARGV[i]
+    table.insert( fields, fld )
+    counts[fld] = {}
+    local prefix = col .. '/docs/f:' .. fld .. '/v:'
+    for _, val in ipairs( redis.call( 'SMEMBERS', col .. '/facet_vals/' .. fld ) ) do
+        local n
+        if res_key then
+            redis.call( 'BITOP', 'AND', scratch, res_key, prefix .. val )
+            n = redis.call( 'BITCOUNT', scratch )
+        else
+            n = redis.call( 'BITCOUNT', prefix .. val )
+        end
+        if n > 0 then counts[fld][val] = n end
+    end
+end
+if scratch then redis.call( 'DEL', scratch ) end
+""" + FACET_TOP_N
+
+# Ordinals of doc ids ARGV[1..], handing out the next ones (counter KEYS[3]) to ids not
+# in hash KEYS[1] yet and recording them in hash KEYS[1] (id -> ordinal) and KEYS[2]
+# (ordinal -> id)
+ASSIGN_ORDINALS = """
+local ret = {}
+for i, id in ipairs( ARGV ) do
+    local ord = redis.call( 'HGET', KEYS[1], id )
+    if not ord then
+        ord = redis.call( 'INCR', KEYS[3] ) - 1
+        redis.call( 'HSET', KEYS[1], id, ord )
+        redis.call( 'HSET', KEYS[2], ord, id )
+    end
+    ret[i] = tonumber( ord )
+end
+return ret
+"""
+
+# Doc ids of the bits set in bitmap KEYS[1], in ordinal order, mapped through hash KEYS[2]
+# (ordinal -> id). Skips the first ARGV[1] and returns at most ARGV[2] (all if < 0)
+BITMAP_IDS = """
+local offset, limit = tonumber( ARGV[1] ), tonumber( ARGV[2] )
+local bitmap = redis.call( 'GET', KEYS[1] )
+if not bitmap or limit == 0 then return {} end
+
+local ords = {}
+local n_seen = 0
+for i = 1, #bitmap do
+    local byte = string.byte( bitmap, i )
+    local j = 0
+    while byte > 0 do
+        -- bit 0 of the bitmap is the most significant one of its first byte
+        if byte >= 128 then
+            n_seen = n_seen + 1
+            if n_seen > offset then table.insert( ords, ( i - 1 ) * 8 + j ) end
+        end
+        byte = ( byte % 128 ) * 2
+        j = j + 1
+    end
+    if limit > 0 and #ords >= limit then break end
+end
+if limit > 0 then
+    while #ords > limit do table.remove( ords ) end
+end
+
+local ret = {}
+for i = 1, #ords, 5000 do
+    local ids = redis.call( 'HMGET', KEYS[2], unpack( ords, i, math.min( i + 4999, #ords ) ) )
+    for _, id in ipairs( ids ) do
+        if id then table.insert( ret, id ) end
+    end
+end
+return ret
+"""
+
+# Okapi BM25 top ARGV[2] documents of collection ARGV[1] for query tokens ARGV[5..], with
+# parameters k1 = ARGV[3], b = ARGV[4], as a flat list of ids and scores (strings), best
+# first. KEYS are the doc_len sorted set, the text_stats hash and the tf: sorted set of
+# each token, in the order of the tokens, preceded by a filter set if given: only ids
+# in it are scored then, walking either the set or each token's postings, whichever is
+# smaller
+BM25 = """
+local top_k = tonumber( ARGV[2] )
+local k1, b = tonumber( ARGV[3] ), tonumber( ARGV[4] )
+local n_tok = #ARGV - 4
+local first, filter = 1, nil
+if #KEYS > n_tok + 2 then first, filter = 2, KEYS[1] end
+local len_key, stats_key = KEYS[first], KEYS[first + 1]
+
+local n_docs = redis.call( 'ZCARD', len_key )
+if n_docs == 0 then return {} end
+local avg_len = tonumber( redis.call( 'HGET', stats_key, 'total_len' ) or 0 ) / n_docs
+if avg_len <= 0 then avg_len = 1 end
+local n_filter = filter and redis.call( 'SCARD', filter )
+
+local scores = {}
+for i = 1, n_tok do
+    local tf_key = KEYS[first + 1 + i]
+    local df = redis.call( 'ZCARD', tf_key )
+    if df > 0 then
+        local idf = math.log( 1 + ( n_docs - df + 0.5 ) / ( df + 0.5 ) )
+        local add = function( id, tf )
+            local dl = tonumber( redis.call( 'ZSCORE', len_key, id ) or avg_len )
+            local norm = tf + k1 * ( 1 - b + b * dl / avg_len )
+            scores[id] = ( scores[id] or 0 ) + idf * tf * ( k1 + 1 ) / norm
+        end
+
+        if filter and n_filter < df then
+            for _, id in ipairs( redis.call( 'SMEMBERS', filter ) ) do
+                local tf = redis.call( 'ZSCORE', tf_key, id )
+                if tf then add( id, tonumber( tf ) ) end
+            end
+        else
+            local postings = redis.call( 'ZRANGE', tf_key, 0, -1, 'WITHSCORES' )
+            for j = 1, #postings, 2 do
+                local id = postings[j]
+                if not filter or redis.call( 'SISMEMBER', filter, id ) == 1 then
+                    add( id, tonumber( postings[j + 1] ) )
+                end
+            end
+        end
+    end
+end
+
+local items = {}
+for id, score in pairs( scores ) do table.insert( items, { id, score } ) end
+table.sort( items, function( x, y )
+    if x[2] ~= y[2] then return x[2] > y[2] end
+    return x[1] < y[1]
+end )
+
+local ret = {}
+for i = 1, math.min( top_k, #items ) do
+    table.insert( ret, items[i][1] )
+    table.insert( ret, string.format( '%.17g', items[i][2] ) )
+end
+return ret
+"""
+
+
+class ScriptRegistry:
+    """Named Lua scripts, loaded at most once per connection pool"""
+
+    def __init__(self):
+        self.sources: Dict[str, str] = {}
+        self.shas: Dict[str, str] = {}
+        self.loaded: Set[tuple] = set()
+        self.lock = threading.Lock()
+
+    def register(self, name: str, source: str) -> str:
+        """Add a script to the registry, returns its sha1"""
+        sha = hashlib.sha1( source.encode('utf8') ).hexdigest()
+        self.sources[name] = source
+        self.shas[name] = sha
+        return sha
+
+    def call(self, client: Union[Redis, Pipeline], name: str, keys: List, args: List):
+        """Run script by EVALSHA. On a pipeline the call is only queued, and the script
+        is loaded beforehand if it hasn't been on this connection pool yet.
+        On an asyncio pipeline scripts must have been loaded with ensure_loaded_async"""
+        sha = self.shas[name]
+        if isinstance( client, AsyncPipeline ):
+            return client.evalsha( sha, len(keys), *keys, *args )
+        if isinstance( client, Pipeline ):
+            self.ensure_loaded( client, name )
+            return client.evalsha( sha, len(keys), *keys, *args )
+
+        try:
+            return client.evalsha( sha, len(keys), *keys, *args )
+        except NoScriptError:
+            self.invalidate( client )
+            self.ensure_loaded( client, name )
+            return client.evalsha( sha, len(keys), *keys, *args )
+
+    def ensure_loaded(self, client: Union[Redis, Pipeline], name: str):
+        """SCRIPT LOAD the script unless already done for client's connection pool"""
+        pool = client.connection_pool
+        with self.lock:
+            if (id(pool), name) in self.loaded:
+                return
+
+            Redis( connection_pool=pool ).script_load( self.sources[name] )
+            self.loaded.add( (id(pool), name) )
+
+    async def ensure_loaded_async(self, client: Union[AsyncRedis, AsyncPipeline],
+                                  names: Optional[List[str]] = None):
+        """SCRIPT LOAD the named scripts (all by default) on an asyncio client's connection
+        pool, unless already done"""
+        pool = client.connection_pool
+        with self.lock:
+            missing = [ name for name in ( names or list( self.sources ) )
+                        if (id(pool), name) not in self.loaded ]
+
+        red = AsyncRedis( connection_pool=pool )
+        for name in missing:
+            await red.script_load( self.sources[name] )
+        with self.lock:
+            self.loaded.update( (id(pool), name) for name in missing )
+
+    def invalidate(self, client: Union[Redis, Pipeline]):
+        """Forget which scripts were loaded on client's connection pool, to be called
+        after a NOSCRIPT error"""
+        pool_id = id( client.connection_pool )
+        with self.lock:
+            self.loaded = { pair for pair in self.loaded if pair[0] != pool_id }
+
+
+REGISTRY = ScriptRegistry()
+REGISTRY.register( 'num_range', NUM_RANGE )
+# single instance only: the s_pat / e_pat buckets and docs/t: sets depend on the patterns
+# and the tokens found
+REGISTRY.register( 'approx_match', APPROX_MATCH )
+# single instance only: the facet value sets depend on the fields' values, the doc_facets
+# sets on the ids in the result
+REGISTRY.register( 'facet_counts', FACET_COUNTS )
+REGISTRY.register( 'bm25', BM25 )
+# single instance only, as facet_counts
+REGISTRY.register( 'facet_counts_bits', FACET_COUNTS_BITS )
+REGISTRY.register( 'assign_ordinals', ASSIGN_ORDINALS )
+REGISTRY.register( 'bitmap_ids', BITMAP_IDS )
@@ -1,20 +1,24 @@
 """Core classes to implement search filters"""
 
 import sys
-from typing import Union, List, Set
+from typing import Union, List, Set, Dict, Tuple, Optional, Callable, NamedTuple, TypeVar, Sequence
 import abc
 
 import os
+import time
 import uuid
 import datetime as dt
 
 from redis.client import Pipeline
 from redis import Redis
+from redis.exceptions import NoScriptError
 
 import common as com
-from common import Key, Field
-from collection import Collection
-from importlib import reload
+import fuzzy
+import scripts
+from common import Key, Field, Doc
+from collection import Collection, pins_reader
+from result_cache import ResultCache
 
 from log_util import info_log_fun, debug_log_fun
 from logging import DEBUG, getLogger
@@ -26,21 +30,71 @@ getLogger("search").setLevel(DEBUG)
 # %%
 
 LiteralVal = Union[str, int, float]
+T_ = TypeVar("T_")
+
+# cardinality estimate for expressions whose size can't be known before evaluating them
+UNKNOWN_CARD = 2 ** 62
+
+
+# seconds temporary keys live at most, in case the process dies before deleting them
+TMP_KEY_TTL = 60
+
+
+class SearchPage(NamedTuple):
+    """One page of search results. total is the number of matching documents, ids those
+    in the page, in order, and docs their documents if requested"""
+    total: int
+    ids: List[Key]
+    docs: Optional[List[Doc]]
 
 
 class SearchContext:
     """Package collection search is carried out on, together with pipeline and
-    temporary key generating funcionality"""
+    temporary key generating funcionality.
+
+    Every temporary key gets an expiry of tmp_ttl seconds set right after the command
+    creating it, on the same pipeline. Used as a context manager, all temporary keys are
+    deleted on exit, whether the search succeeded or not.
+
+    With track_bytes=True the size of every temporary key is measured with MEMORY USAGE
+    before deleting it, see stats()
 
-    def __init__(self, col: Collection, pipe: Pipeline ):
+    For collections with bitmap postings set operations become BITOPs and results are
+    decoded from bitmaps to doc ids on the server.
+
+    Expressions only evaluate through the methods of their context, so other backends
+    implement those, see memory.MemoryContext"""
+
+    def __init__(self, col: Collection, pipe: Union[Pipeline, Redis],
+                 tmp_ttl: int = TMP_KEY_TTL, track_bytes: bool = False,
+                 red: Optional[Redis] = None ):
         self.col = col
         self.pipe = pipe
+        # connection the pipeline is on, temporary keys are deleted there
+        self.red = col.redis if red is None else red
+        self.tmp_ttl = tmp_ttl
+        self.track_bytes = track_bytes
+        self.bitmap = col.cfg.bitmap
         self.tmp_keys = []
+        self.tmp_bytes = 0
+        self.n_deleted = 0
+        # result keys of the expressions evaluated so far, by canonical form
+        self.memo: Dict[str, Key] = {}
         # %%
         prefix0 = f"{uuid.getnode()}-{os.getpid()}-{dt.datetime.now().timestamp()}"
 
         self.tmp_key_prefix = str(hash( prefix0 ))
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.cleanup()
+
+    def is_pipelined(self) -> bool:
+        """Whether commands are being queued or executed right away"""
+        return isinstance( self.pipe, Pipeline )
+
     def gen_key(self) -> str:
         """generate first key and record it in tmp_keys"""
         next_i = len(self.tmp_keys)
@@ -48,6 +102,200 @@ class SearchContext:
         self.tmp_keys.append( key )
         return key
 
+    def inter(self, keys: List[Key]) -> Key:
+        """Store intersection of sets in a new temporary key"""
+        if self.bitmap:
+            return self._bitop( "AND", keys )
+        return self._store( "sinterstore", keys )
+
+    def union(self, keys: List[Key]) -> Key:
+        """Store union of sets in a new temporary key"""
+        if self.bitmap:
+            return self._bitop( "OR", keys )
+        return self._store( "sunionstore", keys )
+
+    def diff(self, key: Key, exclude: List[Key]) -> Key:
+        """Store the ids in key that are in none of the exclude sets in a new temporary
+        key. With bitmap postings that is key XOR (key AND excluded), BITOP NOT would
+        set the bits past the end of the shorter bitmaps"""
+        if not self.bitmap:
+            return self._store( "sdiffstore", [key] + exclude )
+
+        excluded = exclude[0] if len(exclude) == 1 else self._bitop( "OR", exclude )
+        return self._bitop( "XOR", [key, self._bitop( "AND", [key, excluded] )] )
+
+    def num_range(self, zkey: Key, min_: str, max_: str, within: Optional[Key] = None) -> Key:
+        """Store ids in sorted set zkey with scores in [min_, max_] in a new temporary key,
+        entirely on the server. If within is given only ids also in that set are kept"""
+        keys = [zkey] if within is None else [zkey, within]
+        args = [min_, max_, 'bits'] if self.bitmap else [min_, max_]
+        return self.script_store( 'num_range', keys, args )
+
+    def scored(self, key: Key, zkey: Key) -> Key:
+        """Store members of set key with their scores in sorted set zkey in a new temporary
+        sorted set. Members not in zkey are left out"""
+        if self.bitmap:
+            raise ValueError( "Sorting results is not supported with bitmap postings" )
+        dst = self.gen_key()
+        l_dbg( f"{dst} <- zinterstore {key} {zkey}" )
+        self.pipe.zinterstore( dst, { key: 0, zkey: 1 } )
+        self.pipe.expire( dst, self.tmp_ttl )
+        return dst
+
+    def script_store(self, name: str, keys: List[Key], args: List) -> Key:
+        """Run a registered script that stores its result in a new temporary key
+        (see scripts.py for the calling convention)"""
+        key = self.gen_key()
+        l_dbg( f"{key} <- {name} {keys} {args[:10]}" )
+        scripts.REGISTRY.call( self.pipe, name, [key] + keys, [self.tmp_ttl] + args )
+        if self.track_bytes and not self.is_pipelined():
+            self.tmp_bytes += self.pipe.memory_usage( key ) or 0
+
+        return key
+
+    def _bitop(self, op: str, keys: List[Key]) -> Key:
+        key = self.gen_key()
+        l_dbg( f"{key} <- bitop {op} {keys}" )
+        self.pipe.bitop( op, key, *keys )
+        self.pipe.expire( key, self.tmp_ttl )
+        return key
+
+    def _store(self, cmd: str, keys: List[Key]) -> Key:
+        key = self.gen_key()
+        l_dbg( f"{key} <- {cmd} {keys}" )
+        getattr( self.pipe, cmd )( key, *keys )
+        self.pipe.expire( key, self.tmp_ttl )
+        if self.track_bytes and not self.is_pipelined():
+            self.tmp_bytes += self.pipe.memory_usage( key ) or 0
+
+        return key
+
+    def eval(self, expr: 'Expr') -> Key:
+        """Key holding the result of expr. Expressions evaluate their sub-expressions
+        through here, so equal (sub-)expressions are only evaluated once per context"""
+        canon = expr.canonical()
+        key = self.memo.get( canon )
+        if key is None:
+            key = expr.eval( self )
+            self.memo[canon] = key
+        return key
+
+    def approx_tokens(self, expr: 'ContainsApprox') -> List[str]:
+        """Tokens in the collection matching an approximate match"""
+        return expr.matching_tokens( self.col )
+
+    def run(self, expr: 'Expr') -> Set[Key]:
+        """Evaluate expression and return the members of the resulting set.
+
+        When pipelined, the read of the result, the size of temporary keys (if tracked)
+        and their deletion are queued after all set operations and the whole pipeline
+        runs in a single round-trip"""
+        key = self.eval( expr )
+        l_dbg( f"key={key}")
+        ret = self._read( [ self.members_read( key ) ] )[0]
+        return set( ret ) if self.bitmap else ret
+
+    def run_many(self, exprs: List['Expr']) -> List[Set[Key]]:
+        """Evaluate expressions and return the members of each of their results, all read
+        in the same round-trip as run. Sub-expressions they have in common are evaluated
+        once and each distinct result key is read once"""
+        keys = [ self.eval( expr ) for expr in exprs ]
+        distinct = list( dict.fromkeys( keys ) )
+        rets = dict( zip( distinct, self._read( [ self.members_read( key )
+                                                  for key in distinct ] ) ) )
+        return [ set( rets[key] ) for key in keys ]
+
+    def run_page(self, expr: 'Expr', offset: int = 0, limit: Optional[int] = None,
+                 sort_zkey: Optional[Key] = None, desc: bool = False,
+                 with_scores: bool = False) -> Tuple[int, List[Key]]:
+        """Evaluate expression and return the number of results and the ids in the
+        page [offset, offset + limit), all in the same round-trip as run.
+
+        The page is cut on the server: sorted by the score in sort_zkey (results
+        without one are left out of pages), or else by SORT ... ALPHA so that pages are
+        stable. With with_scores sorted pages hold (id, score) pairs"""
+        key = self.eval( expr )
+        l_dbg( f"key={key}")
+        res = self._read( self.page_reads( key, offset, limit, sort_zkey, desc, with_scores ) )
+        return res[0], res[1] if len(res) > 1 else []
+
+    def members_read(self, key: Key) -> Callable:
+        """Read of all the doc ids in a result key, as a set"""
+        if not self.bitmap:
+            return lambda pipe: pipe.smembers( key )
+
+        return lambda pipe: self._bitmap_ids( pipe, key, 0, -1 )
+
+    def page_reads(self, key: Key, offset: int, limit: Optional[int],
+                   sort_zkey: Optional[Key], desc: bool,
+                   with_scores: bool = False) -> List[Callable]:
+        """Reads of the number of doc ids in a result key and of a page of them, see
+        run_page, only the former if limit is 0. With bitmap postings unsorted pages are in
+        ordinal order"""
+        count = ( lambda pipe: pipe.bitcount( key ) ) if self.bitmap else \
+                ( lambda pipe: pipe.scard( key ) )
+        if limit == 0:
+            return [ count ]
+        if sort_zkey is not None:
+            scored = self.scored( key, sort_zkey )
+            end = -1 if limit is None else offset + limit - 1
+            return [ count, lambda pipe: pipe.zrange( scored, offset, end, desc=desc,
+                                                      withscores=with_scores ) ]
+
+        num = -1 if limit is None else limit
+        if self.bitmap:
+            return [ count, lambda pipe: self._bitmap_ids( pipe, key, offset, num ) ]
+        return [ count, lambda pipe: pipe.sort( key, start=offset, num=num, alpha=True ) ]
+
+    def _bitmap_ids(self, pipe, key: Key, offset: int, num: int):
+        return scripts.REGISTRY.call( pipe, 'bitmap_ids',
+                                      [ key, com.key_ordinal_ids( self.col.name ) ],
+                                      [ offset, num ] )
+
+    def run_script(self, expr: 'Expr', name: str, args: List, keys: Sequence[Key] = ()):
+        """Evaluate expression and return the result of a registered script that reads
+        the resulting set as KEYS[1], followed by keys, in the same round-trip as run"""
+        key = self.eval( expr )
+        l_dbg( f"key={key} -> {name} {args[:10]}")
+        return self._read( [ lambda pipe: scripts.REGISTRY.call( pipe, name, [key, *keys],
+                                                                 args ) ] )[0]
+
+    def _read(self, reads: List[Callable]) -> List:
+        """Results of the reads, each a function issuing one command on the pipeline.
+        If pipelined they are queued together with the deletion of temporary keys"""
+        if not self.is_pipelined():
+            return [ read( self.pipe ) for read in reads ]
+
+        res_idx = len( self.pipe )
+        for read in reads:
+            read( self.pipe )
+        bytes_idx = len( self.pipe )
+        if self.track_bytes:
+            for tmp_key in self.tmp_keys:
+                self.pipe.memory_usage( tmp_key )
+        if len(self.tmp_keys) > 0:
+            self.pipe.unlink( *self.tmp_keys )
+
+        ret = self.pipe.execute()
+        if self.track_bytes:
+            sizes = ret[bytes_idx:bytes_idx + len(self.tmp_keys)]
+            self.tmp_bytes += sum( size or 0 for size in sizes )
+        self.n_deleted = len(self.tmp_keys)
+
+        return ret[res_idx:bytes_idx]
+
+    def cleanup(self):
+        """Delete temporary keys not deleted yet, directly on the connection since a pipeline
+        may have been left in an unusable state by an error"""
+        pending = self.tmp_keys[self.n_deleted:]
+        if len(pending) > 0:
+            self.red.unlink( *pending )
+        self.n_deleted = len(self.tmp_keys)
+
+    def stats(self) -> Dict[str, int]:
+        """Number of temporary keys and bytes created by this search"""
+        return { "tmp_keys": len(self.tmp_keys), "tmp_bytes": self.tmp_bytes }
+
 
 class Expr( abc.ABC ):
     """Abstract base class for all expressions"""
@@ -55,6 +303,64 @@ class Expr( abc.ABC ):
         """run a search within this context"""
         pass
 
+    def leaf_key(self, col: Collection) -> Optional[Key]:
+        """Key of the Redis set holding the result of this expression, when it can be
+        obtained without running any set operation. None otherwise"""
+        return None
+
+    def sub_exprs(self) -> List['Expr']:
+        """Direct sub-expressions of this one"""
+        return []
+
+    def flatten(self) -> 'Expr':
+        """Equivalent expression with nested And's / Or's merged into their parents"""
+        return self
+
+    def with_children(self, children: List['Expr']) -> 'Expr':
+        """Same kind of expression with sub_exprs replaced by children"""
+        return self
+
+    def plan(self, col: Collection, cards: Dict[Key, int]) -> Tuple['Expr', int]:
+        """Equivalent expression rewritten for cheap evaluation, together with an estimate
+        of its cardinality. cards maps leaf keys to their actual cardinality"""
+        key = self.leaf_key( col )
+        if key is None:
+            return self, UNKNOWN_CARD
+        return self, cards.get( key, UNKNOWN_CARD )
+
+    @abc.abstractmethod
+    def canonical(self) -> str:
+        """String that is equal for any two expressions matching the same documents
+        by construction. Only meaningful on flattened expressions"""
+
+
+class Empty( Expr ):
+    """Expression that matches no document. Produced by the planner"""
+    def eval(self, ctx: SearchContext) -> Key:
+        """A fresh temporary key that is never written to, i.e. an empty set"""
+        return ctx.gen_key()
+
+    def canonical(self) -> str:
+        return "empty"
+
+    def __str__(self) -> str:
+        return "empty"
+
+
+class AllDocs( Expr ):
+    """Expression that matches every document. Produced by the planner"""
+    def eval(self, ctx: SearchContext) -> Key:
+        return self.leaf_key( ctx.col )
+
+    def leaf_key(self, col: Collection) -> Optional[Key]:
+        return com.key_all_ids( col.name )
+
+    def canonical(self) -> str:
+        return "all"
+
+    def __str__(self) -> str:
+        return "all"
+
 
 class FacetEq( Expr ):
     """Represents a comparison such as f('name') == 'Teo' """
@@ -64,18 +370,80 @@ class FacetEq( Expr ):
 
     def eval(self, ctx: SearchContext) -> Key:
         """For facet fields get the key containing set of docs with this value in the field"""
-        col = ctx.col
+        ret = self.leaf_key( ctx.col )
+        if ret is None:
+            raise RuntimeError("FacetEq search not implemented for non facet flds")
+        l_dbg(f"{self} : ret = {ret}")
+        return ret
+
+    def leaf_key(self, col: Collection) -> Optional[Key]:
         if self.fld in col.cfg.facet_flds:
-            ret = com.key_facet_fld_val( col.name, self.fld, self.val )
-            l_dbg(f"{self} : ret = {ret}")
-            return ret
+            return com.key_facet_fld_val( col.name, self.fld, self.val )
         else:
-            raise RuntimeError("FacetEq search not implemented for non facet flds")
+            return None
+
+    def canonical(self) -> str:
+        return f"f:{self.fld!r}={str(self.val)!r}"
 
     def __str__(self) -> str:
         return f"{self.fld} == {self.val}"
 
 
+class NumRange( Expr ):
+    """Represents a filter such as low <= doc['fld'] <= high on a numeric field.
+    Either bound can be None (unbounded) and either can be made exclusive"""
+    def __init__(self, fld: Field, low: Optional[float] = None, high: Optional[float] = None,
+                 low_excl: bool = False, high_excl: bool = False ):
+        self.fld = fld
+        self.low = low
+        self.high = high
+        self.low_excl = low_excl
+        self.high_excl = high_excl
+
+    def bounds(self) -> Tuple[str, str]:
+        """min and max in ZRANGEBYSCORE syntax"""
+        min_ = "-inf" if self.low is None else f"{'(' if self.low_excl else ''}{self.low}"
+        max_ = "+inf" if self.high is None else f"{'(' if self.high_excl else ''}{self.high}"
+        return min_, max_
+
+    def eval(self, ctx: SearchContext, within: Optional[Key] = None) -> Key:
+        """Store ids of docs in range into a temporary key. If within is given, restrict to
+        ids in that set, without ever materializing the whole range"""
+        col = ctx.col
+        if self.fld not in col.cfg.number_flds:
+            raise RuntimeError("NumRange search not implemented for non numeric flds")
+
+        min_, max_ = self.bounds()
+        return ctx.num_range( com.key_numeric_fld( col.name, self.fld ), min_, max_, within )
+
+    def canonical(self) -> str:
+        min_, max_ = self.bounds()
+        return f"n:{self.fld!r}[{min_},{max_}]"
+
+    def __str__(self) -> str:
+        min_, max_ = self.bounds()
+        return f"{self.fld} in [{min_}, {max_}]"
+
+
+class NumCmp( NumRange ):
+    """Represents a comparison such as doc['fld'] < 10 on a numeric field"""
+    OPERATORS = ('=', '<', '<=', '>', '>=')
+
+    def __init__(self, fld: Field, op: str, val: float):
+        if op not in self.OPERATORS:
+            raise ValueError( f"Unknown comparison operator: {op}" )
+
+        super().__init__( fld,
+                          low=val if op in ('=', '>', '>=') else None,
+                          high=val if op in ('=', '<', '<=') else None,
+                          low_excl=op == '>', high_excl=op == '<' )
+        self.op = op
+        self.val = val
+
+    def __str__(self) -> str:
+        return f"{self.fld} {self.op} {self.val}"
+
+
 class ContainsToken( Expr ):
     """Represents a search   doc['fld'] contains 'word' """
     def __init__(self, tok: LiteralVal):
@@ -83,11 +451,16 @@ class ContainsToken( Expr ):
 
     def eval(self, ctx: SearchContext) -> Key:
         """For facet fields get the key containing set of docs with this value in the field"""
-        col = ctx.col
-        ret = com.key_token( col.name, self.tok )
+        ret = self.leaf_key( ctx.col )
         l_dbg(f"{self} : ret = {ret}")
         return ret
 
+    def leaf_key(self, col: Collection) -> Optional[Key]:
+        return com.key_token( col.name, self.tok )
+
+    def canonical(self) -> str:
+        return f"t:{str(self.tok)!r}"
+
     def __str__(self) -> str:
         return f"contains('{self.tok}')"
 
@@ -96,11 +469,32 @@ class ContainsTokens( Expr ):
     """Represents a search   doc['fld'] contains 'word' """
     def __init__(self, tokens: List[LiteralVal]):
         self.toks = tokens
-        self.expr = And( *[ ContainsToken(tok) for tok in tokens ] )
+        if len(tokens) == 1:
+            self.expr = ContainsToken( tokens[0] )
+        else:
+            self.expr = And( *[ ContainsToken(tok) for tok in tokens ] )
+
+    @classmethod
+    def from_text(cls, col: Collection, text: str) -> 'ContainsTokens':
+        """Search for docs containing all tokens of text, tokenized the same way
+        the collection's text fields are indexed"""
+        tokens = col.cfg.tokenizer.tokenize( text )
+        if len(tokens) == 0:
+            raise ValueError( f"No searchable tokens in: {text!r}" )
+        return cls( tokens )
 
     def eval(self, ctx: SearchContext) -> Key:
         """Run search"""
-        return self.expr.eval( ctx )
+        return ctx.eval( self.expr )
+
+    def sub_exprs(self) -> List[Expr]:
+        return [self.expr]
+
+    def flatten(self) -> Expr:
+        return self.expr.flatten()
+
+    def canonical(self) -> str:
+        return self.expr.canonical()
 
     def __str__(self) -> str:
         return f"doc contains all of {self.toks}"
@@ -108,62 +502,120 @@ class ContainsTokens( Expr ):
 
 class ContainsApprox( Expr ):
     """Will match a document that contains this word among its tokens
-    maybe even with typos"""
-    def __init__(self, word: LiteralVal, max_typos=2 ):
+    maybe even with typos.
+
+    Matching tokens are found with the in-process fuzzy index (engine='symspell', see
+    fuzzy.py) or by scanning the s_pat / e_pat sets with one wildcard pattern per
+    possible typo, either one SSCAN at a time from the client (engine='scan') or all
+    of them in a single server side script (engine='lua'). The first two evaluate as
+    an Or of ContainsToken's for the tokens found, 'lua' stores the union of their doc
+    sets directly on the server"""
+    ENGINES = ('symspell', 'scan', 'lua')
+
+    def __init__(self, word: LiteralVal, max_typos=2, engine: str = 'symspell' ):
+        if engine not in self.ENGINES:
+            raise ValueError( f"Unknown engine: {engine}" )
+
         self.word = str(word)
+        self.max_typos = max_typos
+        self.engine = engine
+        self._patterns: Optional[Set[str]] = None
 
-        patterns = { word }
+    @property
+    def patterns(self) -> Set[str]:
+        """Wildcard patterns matching the word with up to max_typos typos, generated on
+        first use as they are only needed by the scan engine"""
+        if self._patterns is None:
+            patterns = { self.word }
 
-        for i in range( max_typos ):
-            extends: List[Set[str]] = []
-            for pat in patterns:
-                extends.append( patterns1typo( pat ) )
+            for _ in range( self.max_typos ):
+                extends: List[Set[str]] = []
+                for pat in patterns:
+                    extends.append( patterns1typo( pat ) )
 
-            for ext in extends:
-                patterns = patterns.union( ext )
+                for ext in extends:
+                    patterns = patterns.union( ext )
 
-        self.patterns = patterns
+            self._patterns = patterns
 
-    def eval(self, ctx: SearchContext) -> List[Key]:
-        red = ctx.pipe
-        # col_name = ctx.col.name
-        s_pref = f"{ctx.col.name}/s_pat"
-        e_pref = f"{ctx.col.name}/e_pat"
+        return self._patterns
 
-        ret = []
-        for pat in self.patterns:
-            if len(pat) >= 3:
-                if pat[0] != '?' and pat[1] != '?':
-                    ret.extend( scan( red, f"{s_pref}/{pat[:2]}", pat ) )
-                elif pat[0] != '?' and pat[2] != '?':
-                    ret.extend(scan(red, f"{s_pref}/{pat[0]}?{pat[2]}", pat))
-                elif pat[1] != '?' and pat[2] != '?':
-                    ret.extend(scan(red, f"{s_pref}/?{pat[1]}{pat[2]}", pat))
-                # ending patterns
-                elif pat[-1] != '?' and pat[-2] != '?':
-                    ret.extend(scan(red, f"{e_pref}/{pat[-2]}{pat[-1]}", pat))
-                elif pat[-1] != '?' and pat[-3] != '?':
-                    ret.extend(scan(red, f"{e_pref}/{pat[-3]}?{pat[-1]}", pat))
-                elif pat[-2] != '?' and pat[-3] != '?':
-                    ret.extend(scan(red, f"{e_pref}/{pat[-3]}{pat[-2]}?", pat))
-                else:
-                    raise NotImplementedError( pat )
-            else:
-                raise NotImplementedError( pat )
+    def matching_tokens(self, col: Collection) -> List[str]:
+        """Tokens in the collection matching the word up to max_typos typos"""
+        if self.engine == 'symspell':
+            return fuzzy.get_index( col, self.max_typos ).lookup( self.fuzzy_word( col.cfg ),
+                                                                  self.max_typos )
+        elif self.engine == 'lua':
+            tokens = scripts.REGISTRY.call( col.reader(), 'approx_match', [],
+                                            [0, col.name] + sorted( self.patterns ) )
+            return sorted( tok.decode('utf8') for tok in tokens )
+        else:
+            return sorted( { tok.decode('utf8') for tok in self.scan_tokens( col ) } )
 
-        return ret
+    def fuzzy_word(self, cfg: com.CollectionConfig) -> str:
+        """The word normalized like indexed tokens, for lookup in the fuzzy index"""
+        return self.word.lower().translate( cfg.transl_tbl )
+
+    def expand(self, col: Collection) -> Expr:
+        """Equivalent expression in terms of exact token matches"""
+        return self.expand_tokens( self.matching_tokens( col ) )
+
+    def expand_tokens(self, tokens: List[str]) -> Expr:
+        """Equivalent expression given the matching tokens"""
+        l_dbg( f"{self} : {len(tokens)} tokens" )
+        if len(tokens) == 0:
+            return Empty()
+        elif len(tokens) == 1:
+            return ContainsToken( tokens[0] )
+        else:
+            return Or( [ ContainsToken(tok) for tok in tokens ] )
 
-    def eval0(self, ctx: SearchContext) -> Key:
-        """old version scanning text_tokens directly"""
-        red = ctx.pipe
-        tokens_key = f"{ctx.col.name}/text_tokens"
+    def eval(self, ctx: SearchContext) -> Key:
+        """Expand into exact token matches and evaluate those, or with the lua engine
+        find the tokens and store the union of their doc sets in one server side call"""
+        if self.engine == 'lua' and not ctx.bitmap:
+            return ctx.script_store( 'approx_match', [], [ctx.col.name] + sorted( self.patterns ) )
+        return ctx.eval( self.expand_tokens( ctx.approx_tokens( self ) ) )
+
+    def scan_tokens(self, col: Collection) -> List[Key]:
+        """Tokens matching any of the patterns, scanning the s_pat / e_pat sets"""
+        # scans need their results right away, so they can't be queued on a pipeline
+        red = col.reader()
 
         ret = []
         for pat in self.patterns:
-            ret.extend( list(red.sscan_iter(tokens_key, match=pat, count=100000)))
+            ret.extend( scan( red, self.scan_key( col.name, pat ), pat ) )
 
         return ret
 
+    @staticmethod
+    def scan_key( col_name: str, pat: str ) -> str:
+        """The s_pat / e_pat set to scan for tokens matching a pattern"""
+        s_pref = f"{col_name}/s_pat"
+        e_pref = f"{col_name}/e_pat"
+        if len(pat) >= 3:
+            if pat[0] != '?' and pat[1] != '?':
+                return f"{s_pref}/{pat[:2]}"
+            elif pat[0] != '?' and pat[2] != '?':
+                return f"{s_pref}/{pat[0]}?{pat[2]}"
+            elif pat[1] != '?' and pat[2] != '?':
+                return f"{s_pref}/?{pat[1]}{pat[2]}"
+            # ending patterns
+            elif pat[-1] != '?' and pat[-2] != '?':
+                return f"{e_pref}/{pat[-2]}{pat[-1]}"
+            elif pat[-1] != '?' and pat[-3] != '?':
+                return f"{e_pref}/{pat[-3]}?{pat[-1]}"
+            elif pat[-2] != '?' and pat[-3] != '?':
+                return f"{e_pref}/{pat[-3]}{pat[-2]}?"
+
+        raise NotImplementedError( pat )
+
+    def canonical(self) -> str:
+        return f"approx:{self.word!r}/{self.max_typos}/{self.engine}"
+
+    def __str__(self) -> str:
+        return f"approx('{self.word}', {self.max_typos})"
+
 
 def scan( redis: Redis, key: str, pat: str ):
     """Retrieve results from scaning a key and matching against a pattern"""
@@ -185,11 +637,52 @@ def patterns1typo( word: str ) -> Set[str]:
     # %%
 
 
+class Not( Expr ):
+    """Represents the documents not matching an expression.
+
+    On its own it is evaluated as the difference with the set of all documents. As a
+    child of an And it is instead subtracted from the intersection of the other
+    children, see And.eval"""
+    def __init__(self, child: Expr):
+        self.child = child
+
+    def eval(self, ctx: SearchContext) -> Key:
+        return ctx.diff( com.key_all_ids( ctx.col.name ), [ ctx.eval( self.child ) ] )
+
+    def sub_exprs(self) -> List[Expr]:
+        return [self.child]
+
+    def flatten(self) -> Expr:
+        child = self.child.flatten()
+        if isinstance( child, Not ):
+            return child.child
+        return Not( child )
+
+    def with_children(self, children: List[Expr]) -> Expr:
+        return Not( children[0] )
+
+    def plan(self, col: Collection, cards: Dict[Key, int]) -> Tuple[Expr, int]:
+        """Complements of empty expressions and of everything are known, other
+        complements can't be estimated without counting all documents"""
+        child, card = self.child.plan( col, cards )
+        if card == 0:
+            return AllDocs().plan( col, cards )
+        if isinstance( child, AllDocs ):
+            return Empty(), 0
+        return Not( child ), UNKNOWN_CARD
+
+    def canonical(self) -> str:
+        return f"not({self.child.canonical()})"
+
+    def __str__(self) -> str:
+        return f"NOT {self.child}"
+
+
 class Or( Expr ):
     """Represents disjunction of several expressions"""
     def __init__( self, arg1: Union[List, Expr], *args: Expr ):
         if isinstance( arg1, list ):
-            assert len(args) >= 2
+            assert len(arg1) >= 2 and len(args) == 0
             self.children = arg1
         elif isinstance( arg1, Expr):
             assert len(args) >= 1
@@ -199,53 +692,438 @@ class Or( Expr ):
 
     def eval(self, ctx: SearchContext):
         """Carry out set union of Redis sets and store result in temporary key"""
-        pipe = ctx.pipe
+        return ctx.union( [ ctx.eval( child ) for child in self.children ] )
 
-        key = self.children[0].eval( ctx )
-        for child in self.children[1:]:
-            key1 = child.eval( ctx )
-            key2 = ctx.gen_key()
-            l_dbg( f"{key2} <- {key} U {key1}" )
-            pipe.sunionstore( key2, key, key1 )
-            key = key2
+    def sub_exprs(self) -> List[Expr]:
+        return self.children
 
-        return key
+    def flatten(self) -> Expr:
+        return Or( _flat_children( self, Or ) )
+
+    def with_children(self, children: List[Expr]) -> Expr:
+        return Or( children )
+
+    def plan(self, col: Collection, cards: Dict[Key, int]) -> Tuple[Expr, int]:
+        """Drop children known to be empty, estimate is the sum of the children's"""
+        planned = [ pair for pair in (child.plan( col, cards ) for child in self.children)
+                    if pair[1] > 0 ]
+        if len(planned) == 0:
+            return Empty(), 0
+        if len(planned) == 1:
+            return planned[0]
+        for expr, card in planned:
+            if isinstance( expr, AllDocs ):
+                return expr, card
+
+        card = min( sum( card for _, card in planned ), UNKNOWN_CARD )
+        return Or( [ expr for expr, _ in planned ] ), card
+
+    def canonical(self) -> str:
+        return "or(" + ",".join( sorted( child.canonical() for child in self.children ) ) + ")"
+
+    def __str__(self) -> str:
+        return "(" + " OR ".join( str(child) for child in self.children ) + ")"
 
 
 class And( Expr ):
-    """Represents disjunction of several expressions"""
+    """Represents conjunction of several expressions"""
     def __init__( self, arg1: Union[List, Expr], *args: Expr ):
         if isinstance(arg1, list):
-            assert len(args) >= 2
+            assert len(arg1) >= 2 and len(args) == 0
             self.children = arg1
         else:
             assert len(args) >= 1
             self.children = [arg1] + list(args)
 
     def eval(self, ctx: SearchContext):
-        """Carry out set intersection of Redis sets and store result in temporary key"""
-        pipe = ctx.pipe
+        """Carry out set intersection of Redis sets and store result in temporary key.
 
-        key = self.children[0].eval( ctx )
-        for child in self.children[1:]:
-            key1 = child.eval( ctx )
-            key2 = ctx.gen_key()
-            l_dbg(f"{key2} <- {key} & {key1}")
-            pipe.sinterstore( key2, key, key1 )
-            key = key2
+        Numeric range children are applied next as filters on the intersection of the
+        others, so the ids in their ranges are never pulled out of the sorted sets.
+        Negated children are subtracted last, with a single difference. Only when all
+        children are negated is the set of all documents used to subtract from"""
+        ranges = [ child for child in self.children if isinstance( child, NumRange ) ]
+        negated = [ child.child for child in self.children if isinstance( child, Not ) ]
+        others = [ child for child in self.children
+                   if not isinstance( child, (NumRange, Not) ) ]
+
+        if len(others) == 0 and len(ranges) == 0:
+            key = com.key_all_ids( ctx.col.name )
+        elif len(others) == 0:
+            key = ctx.eval( ranges[0] )
+            ranges = ranges[1:]
+        elif len(others) == 1:
+            key = ctx.eval( others[0] )
+        else:
+            key = ctx.inter( [ ctx.eval( child ) for child in others ] )
+
+        for rng in ranges:
+            key = rng.eval( ctx, within=key )
+
+        if len(negated) > 0:
+            key = ctx.diff( key, [ ctx.eval( child ) for child in negated ] )
 
         return key
 
+    def sub_exprs(self) -> List[Expr]:
+        return self.children
 
-def run_search( col: Collection, search_expr: Expr ) -> List[Key]:
-    """run search on a collection based on an expression"""
-    # %%
-    red = col.redis
-    # with red.pipeline() as pipe:
-    ctx = SearchContext(col, col.redis )
-    key = search_expr.eval( ctx )
-    # ret = pipe.execute()
-    l_dbg( f"key={key}")
+    def flatten(self) -> Expr:
+        return And( _flat_children( self, And ) )
+
+    def with_children(self, children: List[Expr]) -> Expr:
+        return And( children )
+
+    def plan(self, col: Collection, cards: Dict[Key, int]) -> Tuple[Expr, int]:
+        """Order children smallest first, the whole conjunction is empty as soon as one
+        of them is. Children matching everything are dropped"""
+        planned = []
+        for child in self.children:
+            expr, card = child.plan( col, cards )
+            if card == 0:
+                return Empty(), 0
+            if not isinstance( expr, AllDocs ):
+                planned.append( (expr, card) )
+
+        if len(planned) == 0:
+            return AllDocs().plan( col, cards )
+        if len(planned) == 1:
+            return planned[0]
+
+        planned.sort( key=lambda pair: pair[1] )
+        return And( [ expr for expr, _ in planned ] ), planned[0][1]
+
+    def canonical(self) -> str:
+        return "and(" + ",".join( sorted( child.canonical() for child in self.children ) ) + ")"
+
+    def __str__(self) -> str:
+        return "(" + " AND ".join( str(child) for child in self.children ) + ")"
+
+
+def _flat_children( expr: Expr, typ: type ) -> List[Expr]:
+    """Flattened children of expr, grandchildren of the same type are pulled up"""
+    ret = []
+    for child in expr.sub_exprs():
+        child = child.flatten()
+        if isinstance( child, typ ):
+            ret.extend( child.children )
+        else:
+            ret.append( child )
+
+    return ret
+
+
+def leaf_keys( col: Collection, expr: Expr ) -> List[Key]:
+    """All distinct leaf keys in an expression tree"""
+    ret = {}
+    pending = [expr]
+    while len(pending) > 0:
+        expr = pending.pop()
+        key = expr.leaf_key( col )
+        if key is not None:
+            ret[key] = None
+        pending.extend( expr.sub_exprs() )
+
+    return list( ret )
+
+
+def plan_expr( col: Collection, expr: Expr ) -> Expr:
+    """Rewrite an expression for cheap evaluation.
+
+    Nested And's and Or's are flattened so that each one becomes a single multi-key
+    SINTERSTORE / SUNIONSTORE, the cardinalities of all leaf sets are fetched in one batch
+    of SCARDs, And children are ordered smallest first and conjunctions with an empty
+    leaf are replaced by Empty without touching the rest of their subtree"""
+    return plan_exprs( col, [expr] )[0]
+
+
+def plan_exprs( col: Collection, exprs: List[Expr] ) -> List[Expr]:
+    """plan_expr for several expressions, with the cardinalities of the leaves of all of
+    them fetched in the same batch"""
+    flats = [ expr.flatten() for expr in exprs ]
+    keys = list( dict.fromkeys( key for flat in flats for key in leaf_keys( col, flat ) ) )
+    if len(keys) < 2:
+        return flats
+
+    if col.is_local:
+        cards = col.cards( keys )
+    else:
+        with col.reader().pipeline(transaction=False) as pipe:
+            for key in keys:
+                queue_card( pipe, col.cfg, key )
+            cards = dict( zip( keys, pipe.execute() ) )
+
+    ret = []
+    for flat in flats:
+        planned, card = flat.plan( col, cards )
+        l_dbg( f"plan: {planned}  est. card={card}" )
+        ret.append( planned )
+    return ret
+
+
+def queue_card( pipe: Pipeline, cfg: com.CollectionConfig, key: Key ):
+    """Queue command getting the number of docs in a leaf key"""
+    if cfg.bitmap:
+        pipe.bitcount( key )
+    else:
+        pipe.scard( key )
+
+
+@pins_reader
+def run_search( col: Collection, search_expr: Expr,
+                pipelined: bool = True, planned: bool = True,
+                cache: Optional[ResultCache] = None, stats: Optional[Dict] = None,
+                track_bytes: bool = False ) -> Set[Key]:
+    """run search on a collection based on an expression.
+
+    If a cache is given results are looked up there first (see result_cache.py) and
+    stored in it after computing them.
+
+    With planned=True the expression is first rewritten by plan_expr, which costs one extra
+    round-trip of SCARDs when it has more than one leaf.
+
+    With pipelined=True the expression tree is walked once and every set operation, the final
+    SMEMBERS and the deletion of temporary keys are queued in a single pipeline that runs in
+    one round-trip. pipelined=False evaluates node by node on the raw connection (one
+    round-trip per And/Or node), which is handy for debugging with monitor.py.
+
+    Temporary keys are deleted before returning, also when the search fails.
+
+    If stats is given (a dict) it is updated with the number of temporary keys and bytes
+    the search created, see SearchContext.stats. Bytes are only measured with
+    track_bytes=True, with one MEMORY USAGE per temporary key. stats is left untouched if
+    no search had to run, e.g. when results came from the cache"""
+    if cache is not None:
+        return cache.get_or_compute(
+            col, search_expr, lambda: run_search( col, search_expr, pipelined, planned,
+                                                  stats=stats, track_bytes=track_bytes ) )
+
+    if planned:
+        search_expr = plan_expr( col, search_expr )
+        if isinstance( search_expr, Empty ):
+            return set()
+
+    return _run_in_context( col, pipelined, lambda ctx: ctx.run( search_expr ),
+                            stats, track_bytes )
+
+
+@pins_reader
+def msearch( col: Collection, search_exprs: List[Expr], planned: bool = True,
+             stats: Optional[Dict] = None, track_bytes: bool = False ) -> List[Set[Key]]:
+    """Run many searches at once, returning the ids matching each expression, in order.
+
+    With planned=True all expressions are planned with a single batch of SCARDs. They are
+    then evaluated in one pipeline, in which sub-expressions that several of them share
+    (same canonical form, e.g. the same And of two leaves) are computed only once.
+    Results are not cached. stats, track_bytes: see run_search"""
+    if planned:
+        search_exprs = plan_exprs( col, search_exprs )
+
+    ret = [ set() for _ in search_exprs ]
+    todo = [ i for i, expr in enumerate( search_exprs ) if not isinstance( expr, Empty ) ]
+    if len(todo) == 0:
+        return ret
+
+    results = _run_in_context(
+        col, True, lambda ctx: ctx.run_many( [ search_exprs[i] for i in todo ] ),
+        stats, track_bytes )
+    for i, res in zip( todo, results ):
+        ret[i] = res
+    return ret
+
+
+@pins_reader
+def search_page( col: Collection, search_expr: Expr, offset: int = 0,
+                 limit: Optional[int] = 20, sort_by: Optional[Field] = None,
+                 desc: bool = False, hydrate: bool = True, fields: Optional[List[str]] = None,
+                 pipelined: bool = True, planned: bool = True, stats: Optional[Dict] = None,
+                 track_bytes: bool = False ) -> SearchPage:
+    """Run search returning only a page of results instead of all matching ids.
+
+    The page is cut on the server, sorted by numeric field sort_by if given (descending
+    with desc=True; matches without a value for it are counted in total but left out of
+    pages) or by id otherwise. With hydrate=True the documents in the page are fetched in
+    one HMGET, projected to fields if given. Results are not cached.
+    stats, track_bytes: see run_search"""
+    total, ids = page_ids( col, search_expr, offset, limit, sort_by, desc,
+                           pipelined=pipelined, planned=planned, stats=stats,
+                           track_bytes=track_bytes )
+    docs = col.get_docs( ids, fields ) if hydrate else None
+    return SearchPage( total, ids, docs )
+
+
+@pins_reader
+def page_ids( col: Collection, search_expr: Expr, offset: int = 0,
+              limit: Optional[int] = 20, sort_by: Optional[Field] = None,
+              desc: bool = False, with_scores: bool = False,
+              pipelined: bool = True, planned: bool = True, stats: Optional[Dict] = None,
+              track_bytes: bool = False ) -> Tuple[int, List]:
+    """Number of matching documents and the ids in a page of them, see search_page.
+    With with_scores and sort_by the page holds (id, score) pairs"""
+    check_page( offset, limit )
+    sort_zkey = sort_key( col, sort_by )
+    if planned:
+        search_expr = plan_expr( col, search_expr )
+    if isinstance( search_expr, Empty ):
+        return 0, []
+
+    return _run_in_context(
+        col, pipelined,
+        lambda ctx: ctx.run_page( search_expr, offset, limit, sort_zkey, desc, with_scores ),
+        stats, track_bytes )
+
+
+def check_page( offset: int, limit: Optional[int] ):
+    """Raise ValueError unless offset and limit (None for all) describe a page"""
+    if offset < 0:
+        raise ValueError( f"offset can't be negative, got {offset}" )
+    if limit is not None and limit < 0:
+        raise ValueError( f"limit can't be negative, got {limit}" )
+
+
+def sort_key( col: Collection, sort_by: Optional[Field] ) -> Optional[Key]:
+    """Sorted set to sort search results by, if any"""
+    if sort_by is None:
+        return None
+    if sort_by not in col.cfg.number_flds:
+        raise ValueError( f"Can only sort by numeric fields, got {sort_by!r}" )
+    if col.cfg.bitmap:
+        raise ValueError( "Sorting results is not supported with bitmap postings" )
+
+    return com.key_numeric_fld( col.name, sort_by )
+
+
+@pins_reader
+def facet_counts( col: Collection, search_expr: Optional[Expr], fields: List[Field],
+                  top_n: Optional[int] = 10, pipelined: bool = True,
+                  planned: bool = True, stats: Optional[Dict] = None,
+                  track_bytes: bool = False ) -> Dict[str, List[Tuple[str, int]]]:
+    """Most frequent values of each of the facet fields among the documents matching
+    search_expr (all documents if None), as { fld: [(val, count), ...] } sorted by
+    decreasing count, at most top_n values per field (all if None).
+
+    Counted entirely on the server by the facet_counts script (see scripts.py), in the
+    same round-trip as the search itself. stats, track_bytes: see run_search"""
+    args = facet_counts_args( col, fields, top_n )
+    script = facet_counts_script( col )
+    if search_expr is None and col.is_local:
+        search_expr = AllDocs()
+    if search_expr is None:
+        res = scripts.REGISTRY.call( col.reader(), script, [], args )
+    else:
+        if planned:
+            search_expr = plan_expr( col, search_expr )
+        if isinstance( search_expr, Empty ):
+            return { str(fld): [] for fld in fields }
+
+        res = _run_in_context(
+            col, pipelined, lambda ctx: ctx.run_script( search_expr, script, args ),
+            stats, track_bytes )
+
+    return parse_facet_counts( fields, res )
+
+
+def facet_counts_script( col: Collection ) -> str:
+    """Name of the script counting facet values for the collection's postings"""
+    return 'facet_counts_bits' if col.cfg.bitmap else 'facet_counts'
+
+
+def facet_counts_args( col: Collection, fields: List[Field], top_n: Optional[int] ) -> List:
+    """Arguments of the facet_counts script"""
+    for fld in fields:
+        if fld not in col.cfg.facet_flds:
+            raise ValueError( f"Not a facet field: {fld!r}" )
+
+    return [ col.name, -1 if top_n is None else top_n ] + [ str(fld) for fld in fields ]
+
+
+def parse_facet_counts( fields: List[Field], res: List ) -> Dict[str, List[Tuple[str, int]]]:
+    """Result of the facet_counts script as { fld: [(val, count), ...] }"""
+    return { str(fld): [ (flat[i].decode('utf8'), int(flat[i + 1]))
+                         for i in range( 0, len(flat), 2 ) ]
+             for fld, flat in zip( fields, res ) }
+
+
+@pins_reader
+def ranked_search( col: Collection, text: str, k: int = 10,
+                   filter_expr: Optional[Expr] = None, require_all: bool = False,
+                   k1: float = 1.2, b: float = 0.75, pipelined: bool = True,
+                   stats: Optional[Dict] = None,
+                   track_bytes: bool = False ) -> List[Tuple[Key, float]]:
+    """Top k documents by BM25 relevance to the tokens of text, as (doc_id, score) pairs,
+    best first. Requires a collection configured with scored_text=True.
+
+    Documents matching any token are scored, or only those containing all of them with
+    require_all=True. If filter_expr is given only documents matching it are scored.
+    Scoring is done on the server by the bm25 script (see scripts.py), and only the top k
+    ids are sent back. stats, track_bytes: see run_search"""
+    if not col.cfg.scored_text:
+        raise ValueError( f"Collection {col.name} is not configured with scored_text=True" )
+    if col.cfg.bitmap and ( filter_expr is not None or require_all ):
+        raise ValueError( "Filtered ranked search is not supported with bitmap postings" )
+
+    tokens = list( dict.fromkeys( col.cfg.tokenizer.tokenize( text ) ) )
+    if len(tokens) == 0:
+        return []
+
+    if require_all:
+        tokens_expr = ContainsTokens( tokens )
+        filter_expr = tokens_expr if filter_expr is None else And( filter_expr, tokens_expr )
+
+    args = [ col.name, k, k1, b ] + tokens
+    keys = [ com.key_doc_len( col.name ), com.key_text_stats( col.name ) ] + \
+        [ com.key_term_freqs( col.name, tok ) for tok in tokens ]
+    if filter_expr is None and col.is_local:
+        filter_expr = AllDocs()
+    if filter_expr is None:
+        res = scripts.REGISTRY.call( col.reader(), 'bm25', keys, args )
+    else:
+        filter_expr = plan_expr( col, filter_expr )
+        if isinstance( filter_expr, Empty ):
+            return []
+
+        res = _run_in_context(
+            col, pipelined, lambda ctx: ctx.run_script( filter_expr, 'bm25', args, keys ),
+            stats, track_bytes )
+
+    return [ (res[i], float( res[i + 1] )) for i in range( 0, len(res), 2 ) ]
+
+
+def _run_in_context( col: Collection, pipelined: bool, run: Callable[[SearchContext], T_],
+                     stats: Optional[Dict] = None, track_bytes: bool = False ) -> T_:
+    """Result of run on a fresh SearchContext, pipelined or not, updating stats with the
+    context's stats if given. Runs on the connection picked by col.reader(), reporting how
+    long it took, or in process for local collections"""
+    if col.is_local:
+        with col.context() as ctx:
+            ret = run( ctx )
+        return report_stats( ret, ctx, stats )
+
+    red = col.reader()
+    start = time.perf_counter()
+    if not pipelined:
+        with SearchContext(col, red, track_bytes=track_bytes, red=red) as ctx:
+            ret = run( ctx )
+    else:
+        try:
+            with red.pipeline() as pipe, \
+                    SearchContext(col, pipe, track_bytes=track_bytes, red=red) as ctx:
+                ret = run( ctx )
+        except NoScriptError:
+            # scripts were flushed from the server since we loaded them, do it again
+            scripts.REGISTRY.invalidate( red )
+            with red.pipeline() as pipe, \
+                    SearchContext(col, pipe, track_bytes=track_bytes, red=red) as ctx:
+                ret = run( ctx )
+
+    col.router.observe( red, time.perf_counter() - start )
+    return report_stats( ret, ctx, stats )
 
-    return col.redis.smembers(key)
 
+def report_stats( ret: T_, ctx: SearchContext, stats: Optional[Dict] ) -> T_:
+    """ret, after logging the stats of ctx and adding them to stats if given"""
+    ctx_stats = ctx.stats()
+    l_dbg( f"search stats: {ctx_stats}" )
+    if stats is not None:
+        stats.update( ctx_stats )
+    return ret
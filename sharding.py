@@ -0,0 +1,238 @@
+"""Collections sharded across several Redis instances by document id
+
+Every document lives on exactly one shard, chosen by the crc32 of its id, and each shard is a
+plain Collection holding the same key layout for its own documents. A search is evaluated
+on all shards concurrently, one pipeline per shard, and their results are merged:
+
+- run_search: union of the ids found on each shard
+- search_page: sum of the totals, and the page cut from the merge of the first
+  offset + limit ids of every shard, so deep pages cost more than on a single instance
+- facet_counts: per value sum of the counts of all shards, cut to top_n after merging
+
+Expressions are planned on each shard with its own cardinalities. Ranked search is not
+available, BM25 needs collection-wide statistics that no single shard has.
+
+    shards = [ redis.Redis( port=port ) for port in (6380, 6381, 6382) ]
+    col = ShardedCollection( shards ).configure( cfg )
+    index_documents( col, docs )
+    ids = run_search( col, ContainsToken('rum') )
+"""
+import zlib
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple, Optional, Callable, Iterable, Set, TypeVar
+
+from redis import Redis
+
+import collection as coll
+import indexing as idx
+import search as sch
+from collection import Collection
+from common import Doc, DocId, Key, Field, CollectionConfig, batches_from_iter
+from search import Expr, SearchPage
+
+T_ = TypeVar("T_")
+
+
+class ShardedCollection:
+    """Collection whose documents are spread over several Redis connections, one
+    Collection per shard. Requests to the shards are sent concurrently from a thread
+    pool with one thread per shard"""
+
+    def __init__(self, redis_conns: List[Redis]):
+        assert len(redis_conns) > 0, "need at least one shard"
+        self.shards = [ Collection( red ) for red in redis_conns ]
+        self.pool = ThreadPoolExecutor( max_workers=len(redis_conns),
+                                        thread_name_prefix="shard" )
+        self.cfg: Optional[CollectionConfig] = None
+        self.id_fld = None
+
+    def configure(self, cfg: CollectionConfig, version: Optional[int] = None):
+        """set the config of all shards, optionally fixing the version used"""
+        self.cfg = cfg
+        self.id_fld = cfg.id_fld
+        for shard in self.shards:
+            shard.configure( cfg, version )
+        return self
+
+    @property
+    def name(self) -> Optional[str]:
+        """name of the collection"""
+        return None if self.cfg is None else self.cfg.name
+
+    def x_id(self, doc: Doc) -> str:
+        """extract the id from a document"""
+        return str(doc[self.id_fld])
+
+    def shard_idx(self, doc_id: DocId) -> int:
+        """Index of the shard a document id is routed to"""
+        if isinstance( doc_id, str ):
+            doc_id = doc_id.encode('utf8')
+        return zlib.crc32( doc_id ) % len(self.shards)
+
+    def shard_for(self, doc_id: DocId) -> Collection:
+        """Shard a document id is routed to"""
+        return self.shards[ self.shard_idx( doc_id ) ]
+
+    def scatter(self, fun: Callable[[int, Collection], T_]) -> List[T_]:
+        """Results of fun( i, shard ) for all shards, run concurrently, in shard order"""
+        futures = [ self.pool.submit( fun, i, shard ) for i, shard in enumerate( self.shards ) ]
+        return [ future.result() for future in futures ]
+
+    def close(self):
+        """Stop the threads of the pool, the Redis connections are left alone"""
+        self.pool.shutdown()
+
+    def index_document(self, doc: Doc):
+        """index a document on its shard"""
+        return self.shard_for( self.x_id( doc ) ).index_document( doc )
+
+    def update_document(self, doc: Doc):
+        """index a new version of a document on its shard"""
+        return self.shard_for( self.x_id( doc ) ).update_document( doc )
+
+    def delete_document(self, doc_id: str) -> bool:
+        """remove a document from its shard"""
+        return self.shard_for( doc_id ).delete_document( doc_id )
+
+    def get_docs(self, doc_ids: List, fields: Optional[List[str]] = None) -> List[Doc]:
+        """get documents by id"""
+        return get_docs( self, doc_ids, fields )
+
+    def get_all_docs(self) -> Dict[DocId, Doc]:
+        """get dict of { doc_id -> Doc } of all shards"""
+        ret = {}
+        for docs in self.scatter( lambda _, shard: shard.get_all_docs() ):
+            ret.update( docs )
+        return ret
+
+
+def split_by_shard( col: ShardedCollection, items: Iterable[T_],
+                    doc_id: Callable[[T_], DocId] ) -> List[List[T_]]:
+    """items grouped by the shard of their doc_id, in shard order"""
+    ret = [ [] for _ in col.shards ]
+    for item in items:
+        ret[ col.shard_idx( doc_id( item ) ) ].append( item )
+    return ret
+
+
+def index_documents( col: ShardedCollection, docs: Iterable[Doc], batch_size=1000,
+                     bulk: bool = False ):
+    """insert documents in batches. Each batch is split by shard and the pipelines of
+    all shards are sent concurrently, see collection.index_documents"""
+    for batch in batches_from_iter( docs, batch_size=batch_size ):
+        per_shard = split_by_shard( col, batch, col.x_id )
+        col.scatter( lambda i, shard: coll.index_documents( shard, per_shard[i],
+                                                           batch_size=batch_size, bulk=bulk ) )
+
+
+def get_docs( col: ShardedCollection, doc_ids: List,
+              fields: Optional[List[str]] = None ) -> List[Doc]:
+    """Documents with the given ids, in that order, with one pipeline of HMGETs (one per
+    stored part) per shard. Ids of documents that don't exist (anymore) are skipped"""
+    if len(doc_ids) == 0:
+        return []
+
+    per_shard = split_by_shard( col, enumerate( doc_ids ), lambda pair: pair[1] )
+    parts = idx.doc_parts( col.cfg, fields )
+
+    def fetch( i: int, shard: Collection ) -> List[List[Optional[bytes]]]:
+        if len(per_shard[i]) == 0:
+            return [ [] for _ in parts ]
+        with shard.redis.pipeline( transaction=False ) as pipe:
+            for part in parts:
+                pipe.hmget( idx.doc_part_key( shard.cfg, part ),
+                            [ doc_id for _, doc_id in per_shard[i] ] )
+            return pipe.execute()
+
+    raws_by_part = [ [ None ] * len(doc_ids) for _ in parts ]
+    fetched = col.scatter( fetch )
+
+    for pairs, shard_raws in zip( per_shard, fetched ):
+        for raws, part_raws in zip( raws_by_part, shard_raws ):
+            for (pos, _), raw in zip( pairs, part_raws ):
+                raws[pos] = raw
+
+    return coll.decode_docs( col.cfg, parts, raws_by_part, fields )
+
+
+def run_search( col: ShardedCollection, search_expr: Expr, planned: bool = True,
+                stats: Optional[Dict] = None, track_bytes: bool = False ) -> Set[Key]:
+    """Ids of documents matching search_expr on any shard, see search.run_search.
+    stats get the sums over all shards"""
+    per_shard = [ {} for _ in col.shards ]
+    ret = set()
+    for ids in col.scatter( lambda i, shard: sch.run_search(
+            shard, search_expr, planned=planned, stats=per_shard[i],
+            track_bytes=track_bytes ) ):
+        ret.update( ids )
+    add_stats( stats, per_shard )
+    return ret
+
+
+def search_page( col: ShardedCollection, search_expr: Expr, offset: int = 0,
+                 limit: Optional[int] = 20, sort_by: Optional[Field] = None,
+                 desc: bool = False, hydrate: bool = True,
+                 fields: Optional[List[str]] = None, planned: bool = True,
+                 stats: Optional[Dict] = None, track_bytes: bool = False ) -> SearchPage:
+    """Run search returning only a page of results, see search.search_page.
+
+    Every shard returns its first offset + limit ids, and the page is cut from their
+    merge: by (score, id) when sorting by sort_by, else by id, or with bitmap postings
+    (whose pages are in ordinal order) by rank within the shard, then shard"""
+    sch.check_page( offset, limit )
+    end = None if limit is None else offset + limit
+    per_shard = [ {} for _ in col.shards ]
+    pages = col.scatter( lambda i, shard: sch.page_ids(
+        shard, search_expr, 0, end, sort_by, desc, with_scores=True, planned=planned,
+        stats=per_shard[i], track_bytes=track_bytes ) )
+    add_stats( stats, per_shard )
+
+    total = sum( shard_total for shard_total, _ in pages )
+    if sort_by is not None:
+        merged = sorted( ( (score, doc_id) for _, ids in pages for doc_id, score in ids ),
+                         reverse=desc )
+        ids = [ doc_id for _, doc_id in merged ]
+    elif col.cfg.bitmap:
+        merged = sorted( (rank, i, doc_id) for i, (_, ids) in enumerate( pages )
+                         for rank, doc_id in enumerate( ids ) )
+        ids = [ doc_id for _, _, doc_id in merged ]
+    else:
+        ids = sorted( doc_id for _, ids in pages for doc_id in ids )
+
+    ids = ids[offset:end]
+    docs = get_docs( col, ids, fields ) if hydrate else None
+    return SearchPage( total, ids, docs )
+
+
+def facet_counts( col: ShardedCollection, search_expr: Optional[Expr], fields: List[Field],
+                  top_n: Optional[int] = 10, planned: bool = True,
+                  stats: Optional[Dict] = None,
+                  track_bytes: bool = False ) -> Dict[str, List[Tuple[str, int]]]:
+    """Most frequent values of facet fields among matching documents of all shards, see
+    search.facet_counts. Shards send the counts of all values so the merged top_n is exact"""
+    shard_stats = [ {} for _ in col.shards ]
+    per_shard = col.scatter( lambda i, shard: sch.facet_counts(
+        shard, search_expr, fields, top_n=None, planned=planned, stats=shard_stats[i],
+        track_bytes=track_bytes ) )
+    add_stats( stats, shard_stats )
+
+    ret = {}
+    for fld in fields:
+        counts = Counter()
+        for shard_counts in per_shard:
+            counts.update( dict( shard_counts[str(fld)] ) )
+        items = sorted( counts.items(), key=lambda item: (-item[1], item[0]) )
+        ret[str(fld)] = items if top_n is None else items[:top_n]
+
+    return ret
+
+
+def add_stats( stats: Optional[Dict], per_shard: List[Dict[str, int]] ):
+    """Update stats, if given, with the sums of the search stats of the shards"""
+    if stats is None:
+        return
+    totals = Counter()
+    for shard_stats in per_shard:
+        totals.update( shard_stats )
+    stats.update( totals )
@@ -8,6 +8,7 @@ import search as sch
 import indexing as idx
 from common import f
 import collection as coll
+import ingest
 from collection import Collection, CollectionConfig
 from util import clear_collection
 import common as com
@@ -53,11 +54,7 @@ def create_and_populte_quijote( redis_conn ):
     """Load the full text of el quijote and store as independent lines"""
     # %%
 
-    with open( "/home/teo/_data/red-search/quijote.txt", "rt", encoding="iso-8859-1") as f_in:
-        lines = f_in.readlines()
-
-    print( len(lines) )
-    docs = [ {"text": line, "id": i, "par_num": i} for i, line in enumerate(lines) ]
+    path = "/home/teo/_data/red-search/quijote.txt"
     # %%
     cfg = CollectionConfig(name='qxt',
                            id_fld='id',
@@ -71,7 +68,9 @@ def create_and_populte_quijote( redis_conn ):
     # %%
     clear_collection(col)
     # %%
-    com.timeit( lambda: coll.index_documents(col, docs, batch_size=100) )
+    com.timeit( lambda: ingest.index_lines(col, path, batch_size=100, encoding="iso-8859-1",
+                                           to_doc=lambda i, line: {"text": line, "id": i,
+                                                                   "par_num": i}) )
     # %%
 
 
@@ -125,9 +124,12 @@ def search_testing(col: Collection):
     red = col.redis
     # with col.redis.pipeline() as pipe:
     # for i in range(3): red.ping()
-    ctx = sch.SearchContext(col, col.redis)
     reload(com)
-    ret = com.timeit(lambda: expr.eval(ctx))
+    ret = com.timeit(lambda: expr.matching_tokens(col))
+    print( len( ret), 'tokens' )
+    # %%
+    expr_scan = sch.ContainsApprox("cobre", max_typos=2, engine='scan')
+    ret = com.timeit(lambda: expr_scan.matching_tokens(col))
     print( len( ret), 'tokens' )
     # pipe.execute()
     # %%
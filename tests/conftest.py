@@ -0,0 +1,154 @@
+"""Fixtures for the test suite
+
+Tests run against real redis-server processes when the binary is found (on PATH, or
+given with the REDIS_SERVER environment variable), one process per connection a test asks
+for, so that shards really are separate servers. Otherwise they fall back to fakeredis,
+with a separate fake server per connection.
+
+    pip install -r requirements-test.txt
+    python -m pytest tests
+"""
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from typing import List
+
+import pytest
+import redis
+import redis.asyncio
+
+sys.path.insert( 0, os.path.dirname( os.path.dirname( os.path.abspath( __file__ ) ) ) )
+
+# pylint: disable=wrong-import-position
+from collection import Collection
+from common import CollectionConfig
+import collection as coll
+from search import And, Or, Not, FacetEq, NumRange, ContainsToken, ContainsApprox
+
+REDIS_SERVER = os.environ.get( "REDIS_SERVER" ) or shutil.which( "redis-server" )
+
+# number of redis-server processes started, and so of connections a test can ask for
+MAX_SERVERS = 3
+
+DOCS = [ { 'id': 1, 'description': 'acidic and highly alcoholic', 'ingredients': ['vodka', 'rum'],
+           'main_color': 'transparent', 'num_ingredients': 4 },
+         { 'id': 2, 'description': 'sweet and bitter', 'ingredients': ['cointreau', 'rum'],
+           'main_color': 'white', 'num_ingredients': 6 },
+         { 'id': 3, 'description': 'sweat and tears', 'ingredients': ['gin', 'tonic'],
+           'main_color': 'transparent', 'num_ingredients': 2 },
+         { 'id': 4, 'description': 'a swat of lime', 'ingredients': ['rum', 'lime', 'mint'],
+           'main_color': 'green', 'num_ingredients': 5 },
+         { 'id': 5, 'description': 'dry and bitter', 'ingredients': ['gin', 'vermouth'],
+           'main_color': 'transparent', 'num_ingredients': 3 } ]
+
+
+# expressions the backends (sharded, in memory...) are checked against a plain Collection with
+EXPRS = [ FacetEq( 'ingredients', 'rum' ),
+          Or( FacetEq( 'ingredients', 'gin' ), ContainsToken( 'sweet' ) ),
+          And( FacetEq( 'main_color', 'transparent' ), NumRange( 'num_ingredients', 3, 10 ) ),
+          And( FacetEq( 'main_color', 'transparent' ), Not( FacetEq( 'ingredients', 'rum' ) ) ),
+          ContainsApprox( 'swet', 1 ),
+          And( FacetEq( 'ingredients', 'absinthe' ), NumRange( 'num_ingredients', 50, 60 ) ),
+          ContainsToken( 'nothing' ) ]
+
+
+def cocktails_cfg( **kwargs ) -> CollectionConfig:
+    """Config of the cocktails collection of DOCS"""
+    return CollectionConfig( 'cocktails', 'id', ['ingredients', 'main_color'],
+                             ['description'], ['num_ingredients'], ['a', 'and', 'of'],
+                             **kwargs )
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind( ('127.0.0.1', 0) )
+        return sock.getsockname()[1]
+
+
+def _start_server() -> tuple:
+    port = _free_port()
+    proc = subprocess.Popen( [ REDIS_SERVER, '--port', str(port), '--save', '',
+                               '--appendonly', 'no' ],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL )
+    conn = redis.Redis( port=port )
+    for _ in range( 100 ):
+        try:
+            conn.ping()
+            return proc, conn
+        except redis.ConnectionError:
+            time.sleep( 0.05 )
+
+    proc.terminate()
+    raise RuntimeError( f"redis-server didn't start on port {port}" )
+
+
+@pytest.fixture( scope="session" )
+def _servers():
+    started = []
+    yield started
+    for proc, _ in started:
+        proc.terminate()
+        proc.wait()
+
+
+@pytest.fixture
+def make_redis( _servers ):
+    """Factory of connections to empty, separate Redis servers"""
+    n_used = 0
+
+    def make() -> redis.Redis:
+        nonlocal n_used
+        if REDIS_SERVER is None:
+            fakeredis = pytest.importorskip( "fakeredis" )
+            return fakeredis.FakeRedis( server=fakeredis.FakeServer() )
+
+        if n_used >= MAX_SERVERS:
+            raise RuntimeError( f"tests can use at most {MAX_SERVERS} servers" )
+        if n_used == len(_servers):
+            _servers.append( _start_server() )
+        conn = _servers[n_used][1]
+        n_used += 1
+        conn.flushall()
+        conn.script_flush()
+        # a new pool, so nothing cached per pool (loaded scripts, fuzzy indexes) carries over
+        return redis.Redis( port=conn.connection_pool.connection_kwargs['port'] )
+
+    return make
+
+
+def async_redis( conn: redis.Redis ):
+    """asyncio connection to the same server as conn, to be made inside the event loop"""
+    kwargs = conn.connection_pool.connection_kwargs
+    if 'server' in kwargs:
+        fakeredis = pytest.importorskip( "fakeredis" )
+        return fakeredis.FakeAsyncRedis( server=kwargs['server'] )
+    return redis.asyncio.Redis( port=kwargs['port'] )
+
+
+@pytest.fixture
+def red( make_redis ) -> redis.Redis:
+    """Connection to an empty Redis server"""
+    return make_redis()
+
+
+@pytest.fixture
+def shard_conns( make_redis ) -> List[redis.Redis]:
+    """Connections to 3 separate, empty Redis servers"""
+    return [ make_redis() for _ in range( 3 ) ]
+
+
+@pytest.fixture( params=EXPRS, ids=str )
+def expr( request ):
+    """Each of EXPRS"""
+    return request.param
+
+
+@pytest.fixture
+def cocktails( red ) -> Collection:
+    """Collection with DOCS indexed"""
+    col = Collection( red ).configure( cocktails_cfg() )
+    coll.index_documents( col, DOCS )
+    return col
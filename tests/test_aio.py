@@ -0,0 +1,82 @@
+"""The asyncio API gives the same results as the synchronous one"""
+import asyncio
+
+import pytest
+
+import aio
+import search as sch
+from aio import AsyncCollection
+from search import FacetEq, ContainsToken
+
+from conftest import DOCS, cocktails_cfg, async_redis
+
+
+@pytest.fixture
+def run_async( make_redis ):
+    """Runner of coroutines fun( col ) on an AsyncCollection with DOCS indexed, on a
+    server of its own"""
+    red = make_redis()
+
+    def run( fun, **kwargs ):
+        async def main():
+            ared = async_redis( red )
+            col = await AsyncCollection( ared ).configure( cocktails_cfg( **kwargs ) )
+            await aio.index_documents( col, DOCS )
+            try:
+                return await fun( col )
+            finally:
+                await ared.aclose()
+
+        return asyncio.run( main() )
+
+    return run
+
+
+def test_searches( run_async, cocktails, expr ):
+    fields = [ 'ingredients', 'main_color' ]
+
+    async def searches( col ):
+        return ( await aio.run_search( col, expr ),
+                 await aio.search_page( col, expr, 1, 2, sort_by='num_ingredients', desc=True ),
+                 await aio.facet_counts( col, expr, fields ) )
+
+    ids, page, counts = run_async( searches )
+    assert ids == sch.run_search( cocktails, expr )
+    single = sch.search_page( cocktails, expr, 1, 2, sort_by='num_ingredients', desc=True )
+    assert ( page.total, page.ids, page.docs ) == ( single.total, single.ids, single.docs )
+    assert counts == sch.facet_counts( cocktails, expr, fields )
+
+
+def test_concurrent_searches( run_async ):
+    exprs = [ FacetEq( 'ingredients', ingr ) for ingr in ( 'rum', 'gin', 'lime', 'absinthe' ) ]
+
+    async def searches( col ):
+        return await asyncio.gather( *( aio.run_search( col, expr ) for expr in exprs ) )
+
+    assert run_async( searches ) == [ { b'1', b'2', b'4' }, { b'3', b'5' }, { b'4' }, set() ]
+
+
+def test_get_docs( run_async ):
+    async def get( col ):
+        return await col.get_docs( [ '3', '999', '1' ], [ 'id', 'main_color' ] ), \
+            await col.get_all_docs()
+
+    some, all_docs = run_async( get, separate_flds=[ 'description' ] )
+    assert some == [ { 'id': 3, 'main_color': 'transparent' },
+                     { 'id': 1, 'main_color': 'transparent' } ]
+    assert all_docs == { str( doc['id'] ).encode(): doc for doc in DOCS }
+
+
+@pytest.mark.parametrize( "kwargs", [ {}, { 'scored_text': True }, { 'postings': 'bitmap' } ] )
+def test_update_and_delete( run_async, cocktails, kwargs ):
+    async def write( col ):
+        await col.update_document( { 'id': 2, 'description': 'dry', 'ingredients': [ 'gin' ] } )
+        deleted = await col.delete_document( '4' ), await col.delete_document( '4' )
+        return deleted, await aio.run_search( col, FacetEq( 'ingredients', 'rum' ) ), \
+            await aio.run_search( col, ContainsToken( 'dry' ) ), \
+            await col.get_docs( [ '2', '4' ] )
+
+    deleted, rum, dry, docs = run_async( write, **kwargs )
+    assert deleted == ( True, False )
+    assert ( rum, dry ) == ( { b'1' }, { b'2', b'5' } )
+    assert docs == [ { 'id': 2, 'description': 'dry', 'ingredients': [ 'gin' ] } ]
@@ -0,0 +1,57 @@
+"""Bitmap postings over dense document ordinals"""
+import pytest
+
+import collection as coll
+import search as sch
+from collection import Collection
+from common import key_ordinals
+from search import FacetEq
+
+from conftest import DOCS, EXPRS, cocktails_cfg
+
+FIELDS = [ 'ingredients', 'main_color' ]
+
+
+@pytest.fixture
+def bitmap( make_redis ):
+    col = Collection( make_redis() ).configure( cocktails_cfg( postings='bitmap' ) )
+    coll.index_documents( col, DOCS )
+    return col
+
+
+def test_postings_are_bitmaps( bitmap ):
+    red = bitmap.redis
+    assert red.type( 'cocktails/docs/f:ingredients/v:rum' ) == b'string'
+    assert red.type( 'cocktails/docs/t:sweet' ) == b'string'
+    assert red.hgetall( key_ordinals( bitmap.name ) ) == \
+        { str( doc['id'] ).encode(): str( i ).encode() for i, doc in enumerate( DOCS ) }
+    # reindexing keeps ordinals, new documents get the next one
+    coll.index_documents( bitmap, [ DOCS[1], { 'id': 6, 'ingredients': [ 'rum' ] } ] )
+    assert red.hmget( key_ordinals( bitmap.name ), [ '2', '6' ] ) == [ b'1', b'5' ]
+
+
+def test_same_results_as_sets( bitmap, cocktails, expr ):
+    assert sch.run_search( bitmap, expr ) == sch.run_search( cocktails, expr )
+    assert sch.facet_counts( bitmap, expr, FIELDS ) == sch.facet_counts( cocktails, expr, FIELDS )
+    page = sch.search_page( bitmap, expr, 1, 2 )
+    single = sch.search_page( cocktails, expr, 0, None, hydrate=False )
+    assert page.total == single.total
+    # unsorted pages come in ordinal order, here that of DOCS
+    ids = sorted( single.ids, key=lambda doc_id: int( doc_id ) )[1:3]
+    assert ( page.ids, page.docs ) == ( ids, cocktails.get_docs( ids ) )
+
+
+def test_writes( bitmap, cocktails ):
+    for col in ( bitmap, cocktails ):
+        col.update_document( { 'id': 2, 'description': 'dry', 'ingredients': [ 'gin' ] } )
+        assert col.delete_document( '4' )
+        assert not col.delete_document( '77' )
+
+    for expr in EXPRS:
+        assert sch.run_search( bitmap, expr ) == sch.run_search( cocktails, expr )
+    assert sch.facet_counts( bitmap, None, FIELDS ) == sch.facet_counts( cocktails, None, FIELDS )
+
+
+def test_sorting_not_supported( bitmap ):
+    with pytest.raises( ValueError ):
+        sch.search_page( bitmap, FacetEq( 'main_color', 'transparent' ), sort_by='num_ingredients' )
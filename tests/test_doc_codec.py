@@ -0,0 +1,64 @@
+"""Document codecs and fields stored apart from the rest of the document"""
+import pytest
+
+import collection as coll
+import search as sch
+from collection import Collection
+from common import key_doc_field
+from doc_codec import CODECS, ZlibCodec, get_codec, train_zdict
+from search import FacetEq
+
+from conftest import DOCS, cocktails_cfg
+
+RUM = FacetEq( 'ingredients', 'rum' )
+
+
+@pytest.mark.parametrize( "name", list( CODECS ) )
+def test_round_trip( name ):
+    codec = get_codec( name )
+    doc = dict( DOCS[0], description='año ñandú', ratio=0.5, tags=[], extra=None )
+    assert codec.decode( codec.encode( doc ) ) == doc
+
+
+def test_zdict():
+    docs = [ dict( doc, description=doc['description'] * 3 ) for doc in DOCS ] * 4
+    zdict = train_zdict( docs, size=256 )
+    assert 0 < len( zdict ) <= 256
+    plain, primed = ZlibCodec(), ZlibCodec( zdict )
+    doc = DOCS[1]
+    assert primed.decode( primed.encode( doc ) ) == doc
+    assert len( primed.encode( doc ) ) < len( plain.encode( doc ) )
+    with pytest.raises( ValueError ):
+        get_codec( 'pickle' )
+
+
+@pytest.mark.parametrize( "codec", [ 'json', 'marshal', ZlibCodec( train_zdict( DOCS ) ) ] )
+def test_collection( red, codec ):
+    col = Collection( red ).configure( cocktails_cfg( codec=codec ) )
+    coll.index_documents( col, DOCS )
+    assert col.get_docs( [ '2', '999', '1' ] ) == [ DOCS[1], DOCS[0] ]
+    assert col.get_all_docs() == { str( doc['id'] ).encode(): doc for doc in DOCS }
+    assert sch.search_page( col, RUM, 0, 2 ).docs == DOCS[:2]
+
+
+def test_separate_fields( red ):
+    col = Collection( red ).configure( cocktails_cfg( separate_flds=[ 'description' ] ) )
+    coll.index_documents( col, DOCS )
+    assert red.hget( key_doc_field( col.name, 'description' ), '3' ) == b'"sweat and tears"'
+    assert b'sweat' not in red.hget( 'cocktails/docs', '3' )
+
+    assert col.get_docs( [ '3', '1' ] ) == [ DOCS[2], DOCS[0] ]
+    assert col.get_docs( [ '3' ], [ 'id', 'main_color' ] ) == \
+        [ { 'id': 3, 'main_color': 'transparent' } ]
+    assert col.get_docs( [ '3' ], [ 'description' ] ) == [ { 'description': 'sweat and tears' } ]
+    assert sch.search_page( col, RUM, 0, 1, fields=[ 'id', 'description' ] ).docs == \
+        [ { 'id': 1, 'description': 'acidic and highly alcoholic' } ]
+
+    # updates without the field drop it, deletes remove it
+    col.update_document( { 'id': 3, 'main_color': 'blue' } )
+    assert col.get_docs( [ '3' ] ) == [ { 'id': 3, 'main_color': 'blue' } ]
+    assert col.delete_document( '1' )
+    assert red.hget( key_doc_field( col.name, 'description' ), '1' ) is None
+
+    with pytest.raises( ValueError ):
+        cocktails_cfg( separate_flds=[ 'id' ] )
@@ -0,0 +1,66 @@
+"""Approximate token lookup with the in-process SymSpell index"""
+import collection as coll
+import fuzzy
+import search as sch
+from collection import Collection
+from fuzzy import FuzzyIndex, edit_distance
+from result_cache import ResultCache
+from search import ContainsApprox, ContainsToken
+from util import clear_collection
+
+from conftest import DOCS, cocktails_cfg
+
+
+def test_edit_distance():
+    assert edit_distance( 'sweet', 'sweet', 2 ) == 0
+    assert edit_distance( 'swet', 'sweet', 2 ) == 1
+    assert edit_distance( 'sewet', 'sweet', 2 ) == 1
+    assert edit_distance( 'dry', 'sweet', 1 ) == 2
+
+
+def test_lookup():
+    index = FuzzyIndex( max_dist=2 )
+    assert index.add_tokens( [ 'sweet', 'sweat', 'swat', 'dry', 'sweet' ] ) == 4
+    assert index.lookup( 'swet', 1 ) == [ 'swat', 'sweat', 'sweet' ]
+    assert index.lookup( 'drys', 1 ) == [ 'dry' ]
+
+
+def test_approx_search( cocktails ):
+    assert sch.run_search( cocktails, ContainsApprox( 'swet', 1 ) ) == { b'2', b'3', b'4' }
+
+
+def test_index_reloaded_after_clear( cocktails ):
+    approx = ContainsApprox( 'swet', 1 )
+    assert sch.run_search( cocktails, approx ) == { b'2', b'3', b'4' }
+
+    clear_collection( cocktails )
+    # as many writes as before the clear, so the generation counter is the same again
+    coll.index_documents( cocktails, [ { 'id': 79, 'description': 'swept',
+                                         'ingredients': [ 'rum' ] } ] )
+
+    assert sch.run_search( cocktails, ContainsToken( 'swept' ) ) == { b'79' }
+    assert sch.run_search( cocktails, approx ) == { b'79' }
+    assert fuzzy.get_index( cocktails ).tokens == { 'swept' }
+
+
+def test_one_index_per_server( make_redis ):
+    col1 = Collection( make_redis() ).configure( cocktails_cfg() )
+    col2 = Collection( make_redis() ).configure( cocktails_cfg() )
+    coll.index_documents( col1, DOCS[:2] )
+    coll.index_documents( col2, DOCS[2:] )
+
+    assert fuzzy.get_index( col1 ) is not fuzzy.get_index( col2 )
+    assert sch.run_search( col1, ContainsApprox( 'swet', 1 ) ) == { b'2' }
+    assert sch.run_search( col2, ContainsApprox( 'swet', 1 ) ) == { b'3', b'4' }
+
+
+def test_cached_right_after_write( cocktails ):
+    cache = ResultCache()
+    approx = ContainsApprox( 'swet', 1 )
+    assert sch.run_search( cocktails, approx, cache=cache ) == { b'2', b'3', b'4' }
+
+    coll.index_documents( cocktails, [ { 'id': 80, 'description': 'swet mojito' } ] )
+    # the index picks up new tokens right away, so results cached for the new generation
+    # are complete
+    assert sch.run_search( cocktails, ContainsApprox( 'mojto', 1 ), cache=cache ) == { b'80' }
+    assert sch.run_search( cocktails, approx, cache=cache ) == { b'2', b'3', b'4', b'80' }
@@ -0,0 +1,115 @@
+"""Bulk, streaming and parallel ingestion"""
+import json
+
+import pytest
+
+import collection as coll
+import indexing as idx
+import ingest
+import search as sch
+from collection import Collection
+from search import FacetEq
+
+from conftest import DOCS, REDIS_SERVER, cocktails_cfg
+
+RUM = FacetEq( 'ingredients', 'rum' )
+
+
+def dump( red ) -> dict:
+    """Contents of all keys but the random epoch"""
+    readers = { b'set': red.smembers, b'hash': red.hgetall, b'string': red.get,
+                b'zset': lambda key: red.zrange( key, 0, -1, withscores=True ) }
+    return { key: readers[red.type( key )]( key ) for key in red.scan_iter()
+             if not key.endswith( b'/epoch' ) }
+
+
+@pytest.mark.parametrize( "kwargs", [ {}, { 'scored_text': True }, { 'postings': 'bitmap' } ] )
+def test_bulk_same_keys( make_redis, kwargs ):
+    one_by_one, bulk = make_redis(), make_redis()
+    coll.index_documents( Collection( one_by_one ).configure( cocktails_cfg( **kwargs ) ),
+                          DOCS, batch_size=2 )
+    coll.index_documents( Collection( bulk ).configure( cocktails_cfg( **kwargs ) ),
+                          DOCS, batch_size=2, bulk=True )
+    assert dump( bulk ) == dump( one_by_one )
+
+
+def test_bulk_skips_patterns_of_known_tokens( cocktails, monkeypatch ):
+    with_pats = []
+    index_pats = idx.index_pats
+    monkeypatch.setattr( idx, 'index_pats',
+                         lambda pipe, cfg, tok: with_pats.append( tok ) or
+                         index_pats( pipe, cfg, tok ) )
+    coll.index_documents( cocktails, [ { 'id': 6, 'description': 'sweet and sour' } ],
+                          bulk=True )
+    assert with_pats == [ 'sour' ]
+
+
+def test_stream_jsonl( cocktails, tmp_path ):
+    path = tmp_path / "docs.jsonl"
+    lines = [ json.dumps( { 'id': 10 + i, 'ingredients': [ 'rum' ] } ) for i in range( 5 ) ]
+    path.write_text( "\n".join( lines[:2] + [ "{not json", "" ] + lines[2:] ) + "\n" )
+
+    progress = []
+    res = ingest.index_jsonl( cocktails, str( path ), batch_size=2,
+                              progress=lambda res, n_done: progress.append( n_done ) )
+    assert res == [ ingest.BatchResult( 0, 2, None ), ingest.BatchResult( 1, 2, None ),
+                    ingest.BatchResult( 2, 1, None ) ]
+    assert progress == [ 2, 4, 5 ]
+    assert sch.run_search( cocktails, RUM ) == { b'1', b'2', b'4', b'10', b'11', b'12', b'13',
+                                                 b'14' }
+
+
+def test_stream_bounded( cocktails ):
+    n_read = 0
+
+    def docs():
+        nonlocal n_read
+        for i in range( 10 ):
+            n_read += 1
+            yield { 'id': 100 + i, 'ingredients': [ 'gin' ] }
+
+    # only the batch being indexed has been read when its progress is reported
+    seen = []
+    ingest.index_stream( cocktails, docs(), batch_size=3,
+                         progress=lambda res, n_done: seen.append( (n_done, n_read) ) )
+    assert seen == [ (3, 3), (6, 6), (9, 9), (10, 10) ]
+
+
+def test_index_lines_reports_failed_batches( cocktails, tmp_path ):
+    path = tmp_path / "lines.txt"
+    path.write_text( "sweet rum\nsour gin\nno id\n" )
+
+    def to_doc( i, line ):
+        if line.startswith( 'no id' ):
+            return { 'description': line }
+        return { 'id': 200 + i, 'description': line }
+
+    res = ingest.index_lines( cocktails, str( path ), to_doc, batch_size=2 )
+    assert [ (r.batch_no, r.n_docs, r.error is None) for r in res ] == \
+        [ (0, 2, True), (1, 0, False) ]
+    assert sch.run_search( cocktails, sch.ContainsToken( 'sour' ) ) == { b'201' }
+
+
+def test_parallel_reports_failed_batches( cocktails ):
+    # with fakeredis workers write to fake servers of their own, only outcomes are checked
+    docs = DOCS[:2] + [ { 'description': 'no id' } ] + DOCS[3:]
+    res = ingest.index_documents_parallel( cocktails, docs, n_workers=2, batch_size=2,
+                                           ordered=True )
+    assert [ (r.batch_no, r.n_docs) for r in res ] == [ (0, 2), (1, 0), (2, 1) ]
+    assert res[1].error.startswith( 'KeyError' )
+
+
+@pytest.mark.skipif( REDIS_SERVER is None, reason="workers need a redis-server to connect to" )
+@pytest.mark.parametrize( "ordered", [ True, False ] )
+def test_parallel( red, ordered ):
+    col = Collection( red ).configure( cocktails_cfg() )
+    docs = [ { 'id': i, 'description': f'doc {i}', 'ingredients': [ 'rum' if i % 2 else 'gin' ] }
+             for i in range( 100 ) ]
+    res = ingest.index_documents_parallel( col, iter( docs ), n_workers=3, batch_size=7,
+                                           ordered=ordered, max_in_flight=4 )
+    assert sorted( r.batch_no for r in res ) == list( range( 15 ) )
+    if ordered:
+        assert [ r.batch_no for r in res ] == list( range( 15 ) )
+    assert all( r.error is None for r in res ) and sum( r.n_docs for r in res ) == 100
+    assert len( sch.run_search( col, RUM ) ) == 50
+    assert len( col.get_all_docs() ) == 100
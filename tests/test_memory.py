@@ -0,0 +1,116 @@
+"""The in-process backend and snapshots of Redis collections"""
+import pytest
+
+import collection as coll
+import search as sch
+from collection import Collection
+from memory import MemoryCollection, load_snapshot
+from result_cache import ResultCache
+from search import FacetEq
+
+from conftest import DOCS, EXPRS, cocktails_cfg
+
+
+@pytest.fixture
+def memory():
+    mcol = MemoryCollection().configure( cocktails_cfg() )
+    mcol.index_documents( DOCS )
+    return mcol
+
+
+@pytest.mark.parametrize( "planned", [ True, False ] )
+def test_same_results_as_redis( memory, cocktails, expr, planned ):
+    assert sch.run_search( memory, expr, planned=planned ) == \
+        sch.run_search( cocktails, expr, planned=planned )
+
+    page = sch.search_page( memory, expr, 0, 2, sort_by='num_ingredients' )
+    single = sch.search_page( cocktails, expr, 0, 2, sort_by='num_ingredients' )
+    assert ( page.total, page.ids, page.docs ) == ( single.total, single.ids, single.docs )
+
+
+@pytest.mark.parametrize( "postings", [ 'set', 'bitmap' ] )
+def test_snapshot( red, cocktails, expr, postings ):
+    col = Collection( red ).configure( cocktails_cfg( postings=postings ).with_name( 'snap' ) )
+    coll.index_documents( col, DOCS )
+    snapshot = load_snapshot( col )
+    assert snapshot.is_local and snapshot.cfg.postings == 'set'
+    assert sch.run_search( snapshot, expr ) == sch.run_search( cocktails, expr )
+    assert snapshot.get_all_docs() == cocktails.get_all_docs()
+
+
+def test_facet_counts_of_snapshot_after_delete( cocktails ):
+    # doc 3 is the last one with tonic, its facet value set is gone
+    assert cocktails.delete_document( '3' )
+    snapshot = load_snapshot( cocktails )
+    fields = [ 'ingredients', 'main_color' ]
+    assert sch.facet_counts( snapshot, None, fields, top_n=None ) == \
+        sch.facet_counts( cocktails, None, fields, top_n=None )
+
+
+def test_ranked_search( red ):
+    col = Collection( red ).configure( cocktails_cfg( scored_text=True ) )
+    coll.index_documents( col, DOCS )
+    mcol = MemoryCollection().configure( cocktails_cfg( scored_text=True ) )
+    mcol.index_documents( DOCS )
+    for query in ( 'bitter', 'sweet and bitter', 'lime' ):
+        assert [ doc_id for doc_id, _ in sch.ranked_search( mcol, query ) ] == \
+            [ doc_id for doc_id, _ in sch.ranked_search( col, query ) ]
+
+
+def test_writes( memory, cocktails ):
+    for col in ( memory, cocktails ):
+        col.update_document( { 'id': 2, 'description': 'dry', 'ingredients': [ 'gin' ] } )
+        assert col.delete_document( '4' )
+        assert not col.delete_document( '4' )
+
+    for expr in EXPRS:
+        assert sch.run_search( memory, expr ) == sch.run_search( cocktails, expr )
+    assert memory.get_docs( [ '2', '4' ] ) == cocktails.get_docs( [ '2', '4' ] )
+
+
+def test_result_cache( memory ):
+    cache = ResultCache()
+    rum = FacetEq( 'ingredients', 'rum' )
+    assert sch.run_search( memory, rum, cache=cache ) == { b'1', b'2', b'4' }
+    assert sch.run_search( memory, rum, cache=cache ) == { b'1', b'2', b'4' }
+    assert ( cache.hits, cache.misses ) == ( 1, 1 )
+
+    assert memory.delete_document( '2' )
+    assert sch.run_search( memory, rum, cache=cache ) == { b'1', b'4' }
+    # another collection with the same name and as many writes doesn't share entries
+    other = MemoryCollection().configure( cocktails_cfg() )
+    other.index_documents( DOCS[1:2] )
+    other.gen = memory.gen
+    assert sch.run_search( other, rum, cache=cache ) == { b'2' }
+    assert cache.hits == 1
+
+    with pytest.raises( ValueError ):
+        sch.run_search( memory, rum, cache=ResultCache( redis_ttl=60, local=False ) )
+
+
+@pytest.mark.parametrize( "desc", [ False, True ] )
+def test_sorted_pages( memory, cocktails, desc ):
+    transparent = FacetEq( 'main_color', 'transparent' )
+    for offset, limit in ( (0, 0), (0, 2), (1, 3), (4, 10) ):
+        page = sch.search_page( memory, transparent, offset, limit, sort_by='num_ingredients',
+                                desc=desc )
+        single = sch.search_page( cocktails, transparent, offset, limit,
+                                  sort_by='num_ingredients', desc=desc )
+        assert ( page.total, page.ids ) == ( single.total, single.ids )
+
+    with memory.context() as ctx:
+        assert ctx.run_page( transparent, 0, 2, 'cocktails/docs/n:num_ingredients', desc,
+                             with_scores=True ) == \
+            ( 3, [ (b'1', 4.0), (b'5', 3.0) ] if desc else [ (b'3', 2.0), (b'5', 3.0) ] )
+
+
+def test_scripts( memory ):
+    with memory.context() as ctx:
+        key = ctx.script_store( 'num_range', [ 'cocktails/docs/n:num_ingredients' ], [ '(3', '5' ] )
+        assert ctx.members( key ) == { b'1', b'4' }
+        key = ctx.script_store( 'approx_match', [], [ 'cocktails', 'sw?t' ] )
+        assert ctx.members( key ) == { b'4' }
+        with pytest.raises( ValueError ):
+            ctx.script_store( 'assign_ordinals', [], [] )
+        with pytest.raises( ValueError ):
+            ctx.run_script( FacetEq( 'ingredients', 'rum' ), 'bitmap_ids', [] )
@@ -0,0 +1,48 @@
+"""Planning of And / Or expressions from the cardinalities of their leaves"""
+import search as sch
+from search import And, Or, Not, FacetEq, ContainsToken, Empty, AllDocs
+
+RUM = FacetEq( 'ingredients', 'rum' )
+LIME = FacetEq( 'ingredients', 'lime' )
+GIN = FacetEq( 'ingredients', 'gin' )
+TRANSPARENT = FacetEq( 'main_color', 'transparent' )
+MISSING = ContainsToken( 'nothing' )
+
+
+def test_flatten():
+    flat = And( RUM, And( LIME, Or( GIN, Or( TRANSPARENT, MISSING ) ) ) ).flatten()
+    assert str( flat ) == str( And( RUM, LIME, Or( GIN, TRANSPARENT, MISSING ) ) )
+    assert Not( Not( RUM ) ).flatten() is RUM
+
+
+def test_and_smallest_first( cocktails ):
+    acidic = ContainsToken( 'acidic' )
+    planned = sch.plan_expr( cocktails, And( TRANSPARENT, RUM, acidic ) )
+    assert isinstance( planned, And )
+    assert planned.children[0] is acidic
+    assert sch.run_search( cocktails, planned, planned=False ) == { b'1' }
+
+
+def test_empty_leaves( cocktails ):
+    assert isinstance( sch.plan_expr( cocktails, And( RUM, And( LIME, MISSING ) ) ), Empty )
+    assert str( sch.plan_expr( cocktails, Or( RUM, MISSING, And( GIN, MISSING ) ) ) ) == \
+        str( RUM )
+    assert isinstance( sch.plan_expr( cocktails, Or( Not( MISSING ), GIN ) ), AllDocs )
+    assert str( sch.plan_expr( cocktails, And( Not( MISSING ), GIN ) ) ) == str( GIN )
+
+    # nothing runs on the server for an expression planned to be empty
+    stats = {}
+    assert sch.run_search( cocktails, And( RUM, MISSING ), stats=stats ) == set()
+    assert stats == {}
+
+
+def test_single_multi_key_intersection( cocktails ):
+    stats = {}
+    assert sch.run_search( cocktails, And( And( TRANSPARENT, RUM ), Or( GIN, RUM ) ),
+                           stats=stats ) == { b'1' }
+    # the nested And is flattened into one SINTERSTORE, plus one SUNIONSTORE for the Or
+    assert stats['tmp_keys'] == 2
+
+
+def test_same_results_unplanned( cocktails, expr ):
+    assert sch.run_search( cocktails, expr ) == sch.run_search( cocktails, expr, planned=False )
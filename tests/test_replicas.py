@@ -0,0 +1,68 @@
+"""Routing of searches and document reads to read replicas"""
+import pytest
+
+import collection as coll
+import replicas
+import search as sch
+from collection import Collection
+from replicas import ReadRouter
+from search import AllDocs
+
+from conftest import DOCS, cocktails_cfg
+
+
+@pytest.fixture
+def servers( shard_conns ):
+    """Primary and 2 replicas, which hold (different) copies as if they lagged"""
+    primary, *reps = shard_conns
+    for red, docs in zip( shard_conns, ( DOCS, DOCS[:2], DOCS[2:] ) ):
+        coll.index_documents( Collection( red ).configure( cocktails_cfg() ), docs )
+    return primary, reps
+
+
+def test_round_robin( servers ):
+    primary, reps = servers
+    col = Collection( primary, replicas=reps ).configure( cocktails_cfg() )
+    assert [ sch.run_search( col, AllDocs() ) for _ in range( 4 ) ] == \
+        [ { b'1', b'2' }, { b'3', b'4', b'5' } ] * 2
+    # temporary keys are written and deleted on the replicas
+    assert sch.search_page( col, AllDocs(), 0, 2, sort_by='num_ingredients' ).ids == \
+        [ b'1', b'2' ]
+    assert all( list( red.scan_iter( 't/*' ) ) == [] for red in reps )
+
+
+def test_pages_read_from_one_replica( servers ):
+    primary, reps = servers
+    col = Collection( primary, replicas=reps ).configure( cocktails_cfg() )
+    for _ in range( 2 ):
+        page = sch.search_page( col, AllDocs(), 0, 10 )
+        assert [ str( doc['id'] ).encode() for doc in page.docs ] == page.ids
+
+
+def test_writes_go_to_primary( servers ):
+    primary, reps = servers
+    col = Collection( primary, replicas=reps, read_your_writes_secs=60 ).configure(
+        cocktails_cfg() )
+    assert len( sch.run_search( col, AllDocs() ) ) == 2
+    col.index_document( { 'id': 6, 'ingredients': [ 'rum' ] } )
+    assert all( red.hget( 'cocktails/docs', '6' ) is None for red in reps )
+    # right after a write reads go to the primary
+    assert sch.run_search( col, AllDocs() ) == { b'1', b'2', b'3', b'4', b'5', b'6' }
+    assert col.get_docs( [ '6' ] ) == [ { 'id': 6, 'ingredients': [ 'rum' ] } ]
+
+
+def test_least_latency( monkeypatch ):
+    fast, slow = object(), object()
+    router = ReadRouter( [ slow, fast ], 'least_latency' )
+    # every replica is tried first
+    assert { router.pick(), router.pick() } == { slow, fast }
+    router.observe( slow, 0.5 )
+    router.observe( fast, 0.1 )
+    assert [ router.pick() for _ in range( 3 ) ] == [ fast ] * 3
+
+    # until the estimate of the slow one goes stale
+    monkeypatch.setattr( replicas, 'LATENCY_REFRESH_SECS', 0.0 )
+    assert router.pick() is slow
+
+    with pytest.raises( ValueError ):
+        ReadRouter( [ fast ], 'random' )
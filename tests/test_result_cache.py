@@ -0,0 +1,46 @@
+"""Cached search results are only served while the collection is unchanged"""
+import collection as coll
+import search as sch
+from result_cache import ResultCache
+from search import FacetEq, And, ContainsToken
+from util import clear_collection
+
+RUM = FacetEq( 'ingredients', 'rum' )
+
+
+def test_hits_and_canonical_keys( cocktails ):
+    cache = ResultCache()
+    expr = And( RUM, ContainsToken( 'bitter' ) )
+    assert sch.run_search( cocktails, expr, cache=cache ) == { b'2' }
+    same = And( ContainsToken( 'bitter' ), RUM )
+    assert sch.run_search( cocktails, same, cache=cache ) == { b'2' }
+    assert ( cache.hits, cache.misses ) == ( 1, 1 )
+
+
+def test_invalidated_by_writes( cocktails ):
+    cache = ResultCache()
+    assert sch.run_search( cocktails, RUM, cache=cache ) == { b'1', b'2', b'4' }
+    assert cocktails.delete_document( '2' )
+    assert sch.run_search( cocktails, RUM, cache=cache ) == { b'1', b'4' }
+    assert cache.hits == 0
+
+
+def test_invalidated_by_clear( cocktails ):
+    local, shared = ResultCache(), ResultCache( redis_ttl=60, local=False )
+    for cache in ( local, shared ):
+        assert sch.run_search( cocktails, RUM, cache=cache ) == { b'1', b'2', b'4' }
+
+    clear_collection( cocktails )
+    # one write, as many as before the clear, so the generation counter is the same again
+    coll.index_documents( cocktails, [ { 'id': 77, 'ingredients': [ 'rum' ] } ] )
+
+    assert sch.run_search( cocktails, RUM ) == { b'77' }
+    assert sch.run_search( cocktails, RUM, cache=local ) == { b'77' }
+    assert sch.run_search( cocktails, RUM, cache=shared ) == { b'77' }
+
+
+def test_shared_through_redis( cocktails ):
+    first, second = ResultCache( redis_ttl=60 ), ResultCache( redis_ttl=60 )
+    assert sch.run_search( cocktails, RUM, cache=first ) == { b'1', b'2', b'4' }
+    assert sch.run_search( cocktails, RUM, cache=second ) == { b'1', b'2', b'4' }
+    assert second.hits == 1
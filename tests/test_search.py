@@ -0,0 +1,86 @@
+"""Pages, search stats and document lengths kept for ranked search"""
+import pytest
+
+import collection as coll
+import search as sch
+from collection import Collection
+from common import key_doc_len, key_text_stats
+from search import Or, FacetEq, ContainsToken
+
+from conftest import DOCS, cocktails_cfg
+
+RUM = FacetEq( 'ingredients', 'rum' )
+
+
+@pytest.mark.parametrize( "sort_by", [ None, 'num_ingredients' ] )
+def test_empty_page( cocktails, sort_by ):
+    page = sch.search_page( cocktails, RUM, 0, 0, sort_by=sort_by )
+    assert ( page.total, page.ids, page.docs ) == ( 3, [], [] )
+
+
+@pytest.mark.parametrize( "offset, limit", [ (-1, 2), (0, -1) ] )
+def test_bad_page( cocktails, offset, limit ):
+    with pytest.raises( ValueError ):
+        sch.search_page( cocktails, RUM, offset, limit )
+
+
+def test_stats( cocktails ):
+    stats = {}
+    expr = Or( RUM, ContainsToken( 'bitter' ) )
+    assert sch.run_search( cocktails, expr, stats=stats ) == { b'1', b'2', b'4', b'5' }
+    assert stats == { 'tmp_keys': 1, 'tmp_bytes': 0 }
+
+
+def test_doc_lengths_after_script_flush( red ):
+    col = Collection( red ).configure( cocktails_cfg( scored_text=True ) )
+    coll.index_documents( col, DOCS )
+    col.update_document( { 'id': 3, 'description': 'sweat' } )
+    # e.g. a failover to a replica that never had the scripts loaded
+    red.script_flush()
+
+    col.update_document( { 'id': 1, 'description': 'acidic acidic vodka' } )
+    assert col.delete_document( '2' )
+
+    assert red.zscore( key_doc_len( col.name ), '1' ) == 3
+    assert red.zscore( key_doc_len( col.name ), '2' ) is None
+    lengths = red.zrange( key_doc_len( col.name ), 0, -1, withscores=True )
+    assert int( red.hget( key_text_stats( col.name ), 'total_len' ) ) == \
+        sum( length for _, length in lengths )
+    assert sch.ranked_search( col, 'acidic' )[0][0] == b'1'
+
+
+@pytest.mark.parametrize( "old_server", [ False, True ] )
+def test_facet_counts_of_large_results( red, old_server ):
+    if old_server:
+        # SINTERCARD is only there since Redis 7.0
+        fakeredis = pytest.importorskip( "fakeredis" )
+        red = fakeredis.FakeRedis( server=fakeredis.FakeServer( version=(6, 2) ) )
+    col = Collection( red ).configure( cocktails_cfg() )
+    coll.index_documents( col, DOCS )
+    # more results than values, so each value's set is intersected with them
+    expr = Or( RUM, FacetEq( 'ingredients', 'gin' ) )
+    assert sch.facet_counts( col, expr, [ 'main_color' ], top_n=2 ) == \
+        { 'main_color': [ ('transparent', 3), ('green', 1) ] }
+
+
+def test_ranked_search_filtered( red ):
+    col = Collection( red ).configure( cocktails_cfg( scored_text=True ) )
+    coll.index_documents( col, DOCS )
+    ranked = sch.ranked_search( col, 'bitter sweet' )
+    assert [ doc_id for doc_id, _ in ranked ] == [ b'2', b'5' ]
+    # filtering leaves the scores of the other docs as they are
+    assert sch.ranked_search( col, 'bitter sweet',
+                              filter_expr=FacetEq( 'main_color', 'transparent' ) ) == ranked[1:]
+    assert sch.ranked_search( col, 'bitter sweet', require_all=True ) == ranked[:1]
+
+
+@pytest.mark.parametrize( "kwargs", [ {}, { 'scored_text': True, 'separate_flds': ['description'] },
+                                      { 'postings': 'bitmap' } ] )
+def test_delete_document( red, kwargs ):
+    col = Collection( red ).configure( cocktails_cfg( **kwargs ) )
+    coll.index_documents( col, DOCS )
+    assert col.delete_document( '2' )
+    assert not col.delete_document( '2' )
+    assert not col.delete_document( '999' )
+    assert col.get_docs( [ '1', '2' ] ) == DOCS[:1]
+    assert sch.run_search( col, RUM ) == { b'1', b'4' }
@@ -0,0 +1,78 @@
+"""Sharded collections: routing by id and merging of the results of the shards"""
+import pytest
+
+import fuzzy
+import search as sch
+import sharding
+from sharding import ShardedCollection
+from search import Or, FacetEq, ContainsToken, ContainsApprox
+
+from conftest import DOCS, cocktails_cfg
+
+
+@pytest.fixture
+def sharded( shard_conns ):
+    scol = ShardedCollection( shard_conns ).configure( cocktails_cfg() )
+    sharding.index_documents( scol, DOCS )
+    yield scol
+    scol.close()
+
+
+def test_docs_routed_by_id( sharded ):
+    assert len( { sharded.shard_idx( str( doc['id'] ) ) for doc in DOCS } ) > 1
+    for doc in DOCS:
+        doc_id = str( doc['id'] )
+        assert sharded.shard_for( doc_id ).get_docs( [ doc_id ] ) == [ doc ]
+        others = [ shard for shard in sharded.shards if shard is not sharded.shard_for( doc_id ) ]
+        assert all( shard.get_docs( [ doc_id ] ) == [] for shard in others )
+
+
+def test_union_of_shards( sharded, cocktails, expr ):
+    assert sharding.run_search( sharded, expr ) == sch.run_search( cocktails, expr )
+
+
+@pytest.mark.parametrize( "offset", [ 0, 1, 3 ] )
+def test_pages_merged( sharded, cocktails, expr, offset ):
+    page = sharding.search_page( sharded, expr, offset, 2 )
+    single = sch.search_page( cocktails, expr, offset, 2 )
+    assert ( page.total, page.ids, page.docs ) == ( single.total, single.ids, single.docs )
+
+    page = sharding.search_page( sharded, expr, offset, 2, sort_by='num_ingredients', desc=True )
+    single = sch.search_page( cocktails, expr, offset, 2, sort_by='num_ingredients', desc=True )
+    assert ( page.total, page.ids ) == ( single.total, single.ids )
+
+
+def test_facet_counts_merged( sharded, cocktails, expr ):
+    # top_n is cut after adding up the shards, so it is exact
+    fields = [ 'ingredients', 'main_color' ]
+    assert sharding.facet_counts( sharded, expr, fields, top_n=2 ) == \
+        sch.facet_counts( cocktails, expr, fields, top_n=2 )
+
+
+def test_approx_finds_tokens_of_all_shards( sharded ):
+    exact = Or( [ ContainsToken( tok ) for tok in ( 'sweet', 'sweat', 'swat' ) ] )
+    assert sharding.run_search( sharded, exact ) == { b'2', b'3', b'4' }
+    assert sharding.run_search( sharded, ContainsApprox( 'swet', 1 ) ) == { b'2', b'3', b'4' }
+    # each shard has its own index, with its own tokens
+    for shard in sharded.shards:
+        tokens = { tok.decode( 'utf8' ) for tok in shard.redis.smembers(
+            f"{shard.name}/text_tokens" ) }
+        assert fuzzy.get_index( shard ).tokens == tokens
+
+
+def test_get_docs_keeps_order( sharded ):
+    assert sharded.get_docs( [ '4', '999', '1', '3' ], [ 'id' ] ) == \
+        [ { 'id': 4 }, { 'id': 1 }, { 'id': 3 } ]
+
+
+def test_stats_add_up_over_shards( sharded ):
+    expr = Or( FacetEq( 'ingredients', 'rum' ), FacetEq( 'main_color', 'transparent' ) )
+    n_tmp_keys = 0
+    for shard in sharded.shards:
+        shard_stats = {}
+        sch.run_search( shard, expr, stats=shard_stats )
+        n_tmp_keys += shard_stats.get( 'tmp_keys', 0 )
+
+    stats = {}
+    sharding.run_search( sharded, expr, stats=stats )
+    assert stats['tmp_keys'] == n_tmp_keys > 1
@@ -0,0 +1,40 @@
+"""The tokenizer gives the same tokens on its fast path as a plain translate and split"""
+import re
+
+import pytest
+
+from tokenizer import Tokenizer
+
+from conftest import cocktails_cfg
+
+ACCENTS = str.maketrans( dict( zip( "áéíóúàèìòùñç", "aeiouaeiounc" ) ) )
+TEXTS = [ "En un lugar de la Mancha, de cuyo nombre no quiero acordarme",
+          "ÁRBOL, camión y PEÑA... año 1605!", "naïve Straße über-fast, 3x4=12",
+          "", "   ", "a\x00b and\x00c", "çà et là" ]
+
+
+def reference( text: str, transl_tbl, stop_words ) -> list:
+    return [ tok for tok in re.sub( '[^a-z0-9]', ' ', text.lower().translate( transl_tbl ) ).split()
+             if tok not in stop_words ]
+
+
+@pytest.mark.parametrize( "transl_tbl, fast", [ (ACCENTS, True),
+                                                 (str.maketrans( { 'ß': 'ss' } ), False),
+                                                 (str.maketrans( { 'a': 'e' } ), False) ] )
+def test_same_tokens( transl_tbl, fast ):
+    stop_words = { 'de', 'la', 'y' }
+    tokenizer = Tokenizer( transl_tbl, stop_words )
+    assert tokenizer.fast == fast
+    expected = [ reference( text, transl_tbl, stop_words ) for text in TEXTS ]
+    assert [ tokenizer.tokenize( text ) for text in TEXTS ] == expected
+    assert tokenizer.tokenize_many( TEXTS ) == expected
+    assert tokenizer.tokenize_many( TEXTS[:-2] ) == expected[:-2]
+
+
+def test_interned_and_counted():
+    tokenizer = cocktails_cfg().tokenizer
+    assert tokenizer.fast
+    first, second = tokenizer.tokenize_many( [ "Ron con limón", "limon y ron" ] )
+    assert first == [ 'ron', 'con', 'limon' ] and second == [ 'limon', 'y', 'ron' ]
+    assert first[0] is second[2] and first[2] is second[0]
+    assert tokenizer.token_counts( "a rum, and rum of RUM" ) == { 'rum': 3 }
@@ -0,0 +1,49 @@
+"""Versions of a collection: reindexing, switching and dropping them"""
+import collection as coll
+import search as sch
+import versions
+from collection import Collection
+from search import FacetEq
+
+from conftest import DOCS, cocktails_cfg
+
+RUM = FacetEq( 'ingredients', 'rum' )
+
+
+def test_reindex( cocktails ):
+    assert cocktails.version == 0
+    versions.reindex( cocktails, DOCS[:2], drop_old=False )
+    assert cocktails.version == 1 and cocktails.name == 'cocktails/v1'
+    assert sch.run_search( cocktails, RUM ) == { b'1', b'2' }
+    # other collection objects pick up the switch too
+    other = Collection( cocktails.redis ).configure( cocktails_cfg() )
+    assert sch.run_search( other, RUM ) == { b'1', b'2' }
+
+    # version 0 is still there until dropped, and can be pinned
+    old = Collection( cocktails.redis ).configure( cocktails_cfg(), version=0 )
+    assert sch.run_search( old, RUM ) == { b'1', b'2', b'4' }
+    assert versions.drop_version( cocktails, 0 ) > 0
+    assert sch.run_search( old, RUM ) == set()
+    assert sch.run_search( cocktails, RUM ) == { b'1', b'2' }
+    assert cocktails.redis.get( 'cocktails/current' ) == b'1'
+
+
+def test_switch_during_search( cocktails, monkeypatch ):
+    new_col = versions.new_version( cocktails )
+    coll.index_documents( new_col, [ { 'id': 9, 'description': 'new',
+                                       'ingredients': [ 'rum' ] } ] )
+    plan_expr = sch.plan_expr
+
+    def plan_and_switch( col, expr ):
+        ret = plan_expr( col, expr )
+        versions.switch_version( col, new_col, drop_old=False )
+        return ret
+
+    monkeypatch.setattr( sch, 'plan_expr', plan_and_switch )
+    page = sch.search_page( cocktails, RUM, 0, 10 )
+    # the whole search ran on the version current when it started
+    assert ( page.total, page.ids, page.docs ) == ( 3, [ b'1', b'2', b'4' ],
+                                                    [ DOCS[0], DOCS[1], DOCS[3] ] )
+    assert cocktails.name == new_col.name
+    monkeypatch.undo()
+    assert sch.search_page( cocktails, RUM, 0, 10 ).ids == [ b'9' ]
@@ -0,0 +1,72 @@
+"""Tokenization of text fields, shared by indexing and queries"""
+
+import re
+import sys
+import string
+from collections import Counter
+from typing import List, Set, Dict, Iterable
+
+# separator used to lowercase many texts with a single call
+_SEP = '\x00'
+
+
+class Tokenizer:
+    """Lowercases text, maps accented characters through a translation table, splits
+    it into runs of [a-z0-9] and drops stop words. Tokens are interned, so repeated
+    tokens across a batch of documents share one string object.
+
+    When the table only maps characters outside [a-z0-9] to single characters in it
+    (the usual accent stripping), tokens are matched before translating and only the
+    few non ascii ones get translated, instead of translating the whole text"""
+    TOKEN_RE = re.compile( '[a-z0-9]+' )
+
+    def __init__(self, transl_tbl: Dict[int, str], stop_words: Set[str]):
+        self.transl_tbl = transl_tbl
+        self.stop_words = stop_words
+
+        alnum = string.ascii_lowercase + string.digits
+        targets = [ chr(val) if isinstance( val, int ) else val for val in transl_tbl.values() ]
+        self.fast = ( all( chr(key) not in alnum for key in transl_tbl ) and
+                      all( val is not None and len(val) == 1 and val in alnum
+                           for val in targets ) )
+        if self.fast:
+            extra = ''.join( re.escape( chr(key) ) for key in transl_tbl )
+            self.token_re = re.compile( f'[a-z0-9{extra}]+' )
+        else:
+            self.token_re = self.TOKEN_RE
+
+    def tokenize(self, text: str) -> List[str]:
+        """Produce a list of tokens from a text"""
+        return self._tokens( text.lower() )
+
+    def tokenize_many(self, texts: Iterable[str]) -> List[List[str]]:
+        """Tokens of each of many texts, lowercasing all of them in one go"""
+        texts = list( texts )
+        lowered = _SEP.join( texts ).lower().split( _SEP )
+        if len(lowered) != len(texts):
+            # some text contains the separator itself
+            return [ self.tokenize( text ) for text in texts ]
+
+        return [ self._tokens( text ) for text in lowered ]
+
+    def token_counts(self, text: str) -> Counter:
+        """Number of occurrences of every token in a text"""
+        return Counter( self.tokenize( text ) )
+
+    def _tokens(self, lowered: str) -> List[str]:
+        stop_words = self.stop_words
+        intern = sys.intern
+        if not self.fast:
+            return [ intern(tok) for tok in
+                     self.token_re.findall( lowered.translate( self.transl_tbl ) )
+                     if tok not in stop_words ]
+
+        ret = []
+        transl_tbl = self.transl_tbl
+        for tok in self.token_re.findall( lowered ):
+            if not tok.isascii():
+                tok = tok.translate( transl_tbl )
+            if tok not in stop_words:
+                ret.append( intern(tok) )
+
+        return ret
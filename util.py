@@ -1,12 +1,111 @@
 """A few handy utils"""
+import re
+from typing import Callable, Optional
+
+from redis import Redis
 from collection import Collection
+from common import batches_from_list, key_facet_values, key_all_ids, key_ordinals
+
+
+def clear_collection( col: Collection, batch_size: int = 1000 ) -> int:
+    """Delete all keys belonging to a collection, all of its versions included.
+    Uses SCAN and batched UNLINK so it doesn't block the server; returns number of keys
+    deleted"""
+    n_deleted = unlink_keys( col.redis, glob_escape( col.base_name ) + "/*",
+                             batch_size=batch_size )
+    print( f"Deleted {n_deleted} keys for collection {col.base_name}")
+    col.refresh_version( force=True )
+    return n_deleted
+
+
+def rebuild_facet_registry( col: Collection, batch_size: int = 1000 ) -> int:
+    """Fill the per field sets of known facet values ({col}/facet_vals/{fld}) from the
+    existing facet value sets, for collections indexed before the registry was kept.
+    Uses SCAN; returns number of values found"""
+    n_vals = 0
+    for fld in col.cfg.facet_flds:
+        prefix = f"{col.name}/docs/f:{fld}/v:"
+        vals = [ key.decode('utf8')[len(prefix):] for key in
+                 col.redis.scan_iter( match=glob_escape( prefix ) + "*", count=batch_size ) ]
+        for batch in batches_from_list( vals, batch_size ):
+            col.redis.sadd( key_facet_values( col.name, fld ), *batch )
+        n_vals += len(vals)
+
+    return n_vals
+
+
+def rebuild_all_ids( col: Collection, batch_size: int = 1000 ) -> int:
+    """Fill the set of all document ids ({col}/all_ids) NOT is evaluated against, for
+    collections indexed before it was kept. With bitmap postings the bits of the ordinals
+    of the documents are set. Uses HSCAN; returns number of documents found"""
+    key = key_all_ids( col.name )
+    doc_ids = [ doc_id for doc_id, _ in
+                col.redis.hscan_iter( f"{col.name}/docs", count=batch_size ) ]
+    with col.redis.pipeline( transaction=False ) as pipe:
+        for batch in batches_from_list( doc_ids, batch_size ):
+            if col.cfg.bitmap:
+                for ordinal in col.redis.hmget( key_ordinals( col.name ), batch ):
+                    pipe.setbit( key, int( ordinal ), 1 )
+            else:
+                pipe.sadd( key, *batch )
+            pipe.execute()
+
+    return len(doc_ids)
+
+
+def unlink_keys( red: Redis, match: str, batch_size: int = 1000,
+                 skip: Optional[Callable[[bytes], bool]] = None ) -> int:
+    """UNLINK keys matching a glob pattern, found with SCAN, batch_size keys at a time,
+    except those for which skip(key) is true. Returns number of keys deleted"""
+    n_deleted = 0
+    batch = []
+    for key in red.scan_iter( match=match, count=batch_size ):
+        if skip is not None and skip( key ):
+            continue
+        batch.append( key )
+        if len(batch) >= batch_size:
+            n_deleted += red.unlink( *batch )
+            batch = []
+
+    if len(batch) > 0:
+        n_deleted += red.unlink( *batch )
+
+    return n_deleted
+
+
+def glob_escape( text: str ) -> str:
+    """Escape characters with a special meaning in SCAN / KEYS patterns"""
+    return re.sub( r'([*?\[\]\\])', r'\\\1', text )
+
+
+def sweep_tmp_keys( red: Redis, batch_size: int = 1000 ) -> int:
+    """Delete search temporary keys (t/*) without an expiry, left behind by processes that
+    crashed or predate temp key expiry. Meant to be called once at startup.
+    Uses SCAN so it doesn't block the server; returns number of keys deleted"""
+    n_deleted = 0
+    batch = []
+    for key in red.scan_iter( match="t/*", count=batch_size ):
+        batch.append( key )
+        if len(batch) >= batch_size:
+            n_deleted += _unlink_persistent( red, batch )
+            batch = []
+
+    if len(batch) > 0:
+        n_deleted += _unlink_persistent( red, batch )
+
+    print( f"Deleted {n_deleted} orphan temporary keys" )
+    return n_deleted
+
+
+def _unlink_persistent( red: Redis, keys ) -> int:
+    """Unlink those of the keys that have no expiry set"""
+    with red.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.ttl( key )
+        ttls = pipe.execute()
 
+    persistent = [ key for key, ttl in zip(keys, ttls) if ttl == -1 ]
+    if len(persistent) > 0:
+        red.unlink( *persistent )
 
-def clear_collection( col: Collection ):
-    """Delete all keys belonging to a collection"""
-    # %%
-    keys = col.redis.keys(f"{col.name}/*")
-    print( f"Deleting {len(keys)} keys for collection {col.name}")
-    if len(keys) > 0:
-        col.redis.delete( *keys )
-    # %%
+    return len(persistent)
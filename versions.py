@@ -0,0 +1,96 @@
+"""Versioned collection key namespaces, for zero downtime reindexing
+
+Every version of a collection keeps its keys under its own prefix, {name}/v{n}, and
+{name}/current holds the version that is served. A reindex builds a new version while
+searches keep using the current one, then switches to it by setting the pointer, which
+is atomic. Collection objects notice the switch within collection.VERSION_CHECK_SECS.
+
+The old version is dropped in the background after a grace period, long enough for
+searches started on it to finish, using SCAN and batched UNLINK so that the server is
+never blocked deleting a large collection.
+
+Version 0 stands for collections indexed before versions existed, with their keys directly
+under {name}.
+"""
+import re
+import sys
+import threading
+import time
+from typing import Iterable, Optional
+
+import collection as coll
+from collection import Collection, VERSION_CHECK_SECS
+from common import Doc, key_current_version, key_last_version, versioned_name
+from util import unlink_keys, glob_escape
+from log_util import info_log_fun
+from logging import INFO, getLogger
+
+l_info = info_log_fun("versions", sys.stdout )  # pylint: disable=invalid-name
+getLogger("versions").setLevel(INFO)
+
+# seconds an old version is kept after switching away from it, before dropping it
+DROP_DELAY_SECS = 10 * VERSION_CHECK_SECS
+
+
+def new_version( col: Collection ) -> Collection:
+    """A collection for a new, empty version of col. It is not served until
+    switch_version is called with it"""
+    version = col.redis.incr( key_last_version( col.base_name ) )
+    return Collection( col.redis ).configure( col.base_cfg, version=version )
+
+
+def switch_version( col: Collection, new_col: Collection, drop_old: bool = True,
+                    drop_delay: float = DROP_DELAY_SECS ) -> Optional[threading.Thread]:
+    """Start serving new_col's version of col. With drop_old the previously current
+    version is dropped in a background thread after drop_delay seconds, the thread is
+    returned"""
+    old = col.redis.set( key_current_version( col.base_name ), new_col.version, get=True )
+    old_version = int( old or 0 )
+    col.refresh_version( force=True )
+    l_info( f"{col.base_name}: switched from version {old_version} to {new_col.version}" )
+
+    if not drop_old or old_version == new_col.version:
+        return None
+
+    return drop_version_background( col, old_version, delay=drop_delay )
+
+
+def reindex( col: Collection, docs: Iterable[Doc], drop_old: bool = True,
+             **kwargs ) -> Optional[threading.Thread]:
+    """Index docs into a new version of col and switch to it once done. Searches use
+    the current version meanwhile. kwargs are passed to collection.index_documents"""
+    new_col = new_version( col )
+    coll.index_documents( new_col, docs, **kwargs )
+    return switch_version( col, new_col, drop_old=drop_old )
+
+
+def drop_version( col: Collection, version: int, batch_size: int = 1000 ) -> int:
+    """Delete all keys of a version of col, without blocking the server. Returns number
+    of keys deleted"""
+    if version == int( col.redis.get( key_current_version( col.base_name ) ) or 0 ):
+        raise ValueError( f"{col.base_name}: version {version} is current, can't drop it" )
+
+    prefix = versioned_name( col.base_name, version )
+    skip = None
+    if version == 0:
+        # unversioned keys share their prefix with the pointer, counter and other versions
+        own = re.compile( re.escape( col.base_name ) + r'/(current|last_version|v\d+/)' )
+        skip = lambda key: own.match( key.decode( 'utf8', 'replace' ) ) is not None
+
+    n_deleted = unlink_keys( col.redis, glob_escape( prefix ) + "/*", batch_size=batch_size,
+                             skip=skip )
+    l_info( f"{col.base_name}: dropped version {version}, {n_deleted} keys" )
+    return n_deleted
+
+
+def drop_version_background( col: Collection, version: int,
+                             delay: float = DROP_DELAY_SECS ) -> threading.Thread:
+    """Drop a version of col in a daemon thread, after waiting delay seconds"""
+    def drop():
+        time.sleep( delay )
+        drop_version( col, version )
+
+    thread = threading.Thread( target=drop, name=f"drop {col.base_name} v{version}",
+                               daemon=True )
+    thread.start()
+    return thread